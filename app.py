@@ -1,26 +1,235 @@
+import time
+
+# Before anything else, so the startup time we log includes the imports.
+STARTED = time.monotonic()
+
+import functools
 import json
 import logging
 import pprint
-from typing import Any, Dict, Tuple
+import queue
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
 
 import flask
+import psycopg2
 from werkzeug.exceptions import BadRequest
+from werkzeug.local import LocalProxy
 
+import google_client
 import placebo
+import slack_client
+import socket_mode
+import tenants
 import util
+import webhooks
 
 log = logging.getLogger('placebo.app')
 app = flask.Flask(__name__)
-placebo_app = placebo.Placebo()
+
+# Connecting to Postgres, Google and Slack happens in the background, so we can start taking
+# requests right away. Each tenant starts up on its own, so one that can't (say, its Slack token was
+# revoked) doesn't hold up the rest. Until a tenant has started, it's not in placebos, and its ready
+# event isn't set.
+all_tenants = tenants.load()
+placebos: Dict[str, placebo.Placebo] = {}
+ready = {tenant.id: threading.Event() for tenant in all_tenants}
+# The Placebo for the tenant (i.e. the Slack team) that sent the current request. requires_placebo
+# sets it.
+placebo_app: placebo.Placebo = LocalProxy(lambda: flask.g.placebo_app)
+# Requests that came in before their tenant was ready, and can be handled late: (path, form) pairs,
+# by tenant.
+warmup_queues: Dict[str, 'queue.Queue[Tuple[str, Dict[str, str]]]'] = {
+    tenant.id: queue.Queue() for tenant in all_tenants}
+# How long a request waits for startup to finish before we give up on it. It has to leave time to
+# answer within Slack's three-second deadline.
+WARMUP_WAIT_SECONDS = 2.0
+# If startup fails (say, Postgres is unreachable), try again after this long.
+INIT_RETRY_SECONDS = 5.0
+
+
+def initialize() -> None:
+    imported = time.monotonic()
+    for tenant in all_tenants:
+        threading.Thread(target=initialize_tenant, args=[tenant, imported], daemon=True).start()
+
+
+def initialize_tenant(tenant: tenants.Tenant, imported: float) -> None:
+    tenants.current.set(tenant.id)
+    while True:
+        try:
+            placebos[tenant.id] = placebo.Placebo(tenant)
+            break
+        except Exception:
+            log.exception('Error starting up %s; trying again in %s seconds.',
+                          tenant.id or 'Placebo', INIT_RETRY_SECONDS)
+            time.sleep(INIT_RETRY_SECONDS)
+    ready[tenant.id].set()
+    log.info('Started up %s in %.2f seconds (%.2f importing, %.2f initializing).',
+             tenant.id or 'Placebo', time.monotonic() - STARTED, imported - STARTED,
+             time.monotonic() - imported)
+    drain_warmup_queue(tenant.id)
+    app_token = tenant.config.get('PLACEBO_SLACK_APP_TOKEN')
+    if app_token:
+        socket_mode.SocketMode(app, tenant, app_token).start()
+
+
+def drain_warmup_queue(tenant_id: str) -> None:
+    # Called once the tenant is ready, and again for anything queued after that (see
+    # requires_placebo).
+    while True:
+        try:
+            path, form = warmup_queues[tenant_id].get_nowait()
+        except queue.Empty:
+            return
+        replay(path, form)
+
+
+def replay(path: str, form: Dict[str, str]) -> None:
+    log.info('Handling %s from before we were ready.', path)
+    try:
+        with app.test_request_context(path, method='POST', data=form):
+            response = app.full_dispatch_request()
+        if form.get('response_url') and response.is_json:
+            # The original request got a placeholder, so send the real answer this way.
+            webhooks.post_async(f'Answering {path} from before we were ready',
+                                form['response_url'], response.get_json())
+    except Exception:
+        log.exception('Error handling %s from before we were ready.', path)
+
+
+def requires_placebo(route: Callable[[], flask.Response]) -> Callable[[], flask.Response]:
+    @functools.wraps(route)
+    def wrapper() -> flask.Response:
+        tenant_id = request_tenant()
+        if tenant_id not in ready:
+            raise BadRequest(f'Unknown team {tenant_id}')
+        if ready[tenant_id].wait(WARMUP_WAIT_SECONDS):
+            flask.g.placebo_app = placebos[tenant_id]
+            # Request threads are reused, so this has to be undone afterward.
+            token = tenants.current.set(tenant_id)
+            try:
+                return route()
+            finally:
+                tenants.current.reset(token)
+        if flask.request.method == 'GET':
+            return "Sorry, I'm just starting up. Reload this page in a few seconds!"
+        form = flask.request.form
+        if 'payload' in form or form.get('text'):
+            # Nothing here needs an immediate answer, so just handle it once we're ready.
+            warmup_queues[tenant_id].put((flask.request.path, form.to_dict()))
+            if ready[tenant_id].is_set():
+                # We timed out waiting just before startup finished, and it may have emptied the
+                # queue before this went in, so nothing else is going to handle it.
+                util.future(drain_warmup_queue, [tenant_id])
+            if 'payload' in form:
+                return flask.make_response("", 200)
+            return ephemeral("I'm just starting up -- I'll get to that in a moment.")
+        # This would open a modal, but the trigger ID will expire before we can.
+        return ephemeral("Sorry, I'm just starting up. Try again in a few seconds!")
+    return wrapper
+
+
+def request_tenant() -> str:
+    if tenants.DEFAULT in ready:
+        return tenants.DEFAULT
+    # Slash commands say which team they're from directly, and interactions in their payload. The
+    # OAuth callback has it in the state we started the flow with, and anything else (like GET
+    # /stats) can say ?team=...
+    form = flask.request.form
+    if 'team_id' in form:
+        return form['team_id']
+    if 'payload' in form:
+        return json.loads(form['payload'])['team']['id']
+    if 'state' in flask.request.args:
+        return flask.request.args['state'].split(':', 1)[0]
+    # Drive change notifications have it in the channel token, the same way.
+    if 'X-Goog-Channel-Token' in flask.request.headers:
+        return flask.request.headers['X-Goog-Channel-Token'].split(':', 1)[0]
+    return flask.request.args.get('team', '')
+
+
+@app.route('/ready')
+def is_ready() -> flask.Response:
+    # Ready once every tenant is, or with ?team=..., once that one is. A tenant whose database
+    # can't be reached isn't ready either.
+    team = flask.request.args.get('team')
+    token_seconds_left = {}
+    leaders = {}
+    database_errors = []
+    for tenant_id, p in placebos.items():
+        try:
+            token_seconds_left[tenant_id] = p.google.token_seconds_left()
+            leaders[tenant_id] = p.db.leader()
+        except psycopg2.Error:
+            log.warning("Couldn't reach the database for %s.", tenant_id or 'Placebo',
+                        exc_info=True)
+            database_errors.append(tenant_id)
+    all_ready = all(event.is_set() and tenant_id not in database_errors
+                    for tenant_id, event in ready.items() if team is None or tenant_id == team)
+    status = {
+        'ready': all_ready,
+        'tenants': list(placebos),
+        'starting': [tenant_id for tenant_id, event in ready.items() if not event.is_set()],
+        'database_errors': database_errors,
+        # Seconds left on each tenant's Google access token, which should never get near zero.
+        'google_token_seconds_left': token_seconds_left,
+        'http_cache': google_client.HTTP_CACHE.stats(),
+        # Which process is running each tenant's job queue, and how long ago it checked in.
+        'job_queue_leader': leaders,
+        'worker_id': next(iter(placebos.values())).db.worker_id if placebos else None,
+        # Each tenant's Sheets and Drive circuit breakers, in this process.
+        'google_backends': {
+            tenant_id: {name: circuit.state for name, circuit in p.google.breakers.items()}
+            for tenant_id, p in placebos.items()},
+    }
+    return flask.make_response(flask.jsonify(status), 200 if all_ready else 503)
+
+
+# If we don't answer within 3 seconds, Slack sends the same request again, even though we did get it
+# the first time. We remember every request for this long, and ignore repeats.
+DEDUPE_WINDOW_SECONDS = 15 * 60
+
+
+def handle_once(key: str, handle: Callable[[], flask.Response]) -> flask.Response:
+    # The key is recorded before handling the request, so a retry that comes in while we're still
+    # working on the original is ignored. If handling it fails, though, the key is forgotten again,
+    # so that Slack's retry gets handled instead of dropped.
+    retry_num = flask.request.headers.get('X-Slack-Retry-Num')
+    retry_reason = flask.request.headers.get('X-Slack-Retry-Reason')
+    if not placebo_app.db.first_delivery(key, DEDUPE_WINDOW_SECONDS):
+        log.info('Ignoring duplicate %s (retry %s, %s).', key, retry_num, retry_reason)
+        return flask.make_response("", 200)
+    if retry_num:
+        log.info('Got retry %s of %s (%s) without the original.', retry_num, key, retry_reason)
+    try:
+        response = handle()
+    except BaseException:
+        placebo_app.db.forget_delivery(key)
+        raise
+    if response.status_code >= 500:
+        placebo_app.db.forget_delivery(key)
+    return response
+
+
+def deduplicated(route: Callable[[], flask.Response]) -> Callable[[], flask.Response]:
+    # For slash commands: every invocation gets its own trigger ID, which a retry reuses.
+    @functools.wraps(route)
+    def wrapper() -> flask.Response:
+        form = flask.request.form
+        return handle_once(f"{form['command']}:{form['trigger_id']}", route)
+    return wrapper
 
 
 @app.route('/unlock', methods=['POST'])
+@requires_placebo
+@deduplicated
 def unlock() -> flask.Response:
     text = flask.request.form['text']
     if not text:
         trigger_id = flask.request.form['trigger_id']
         user_id = flask.request.form['user_id']
-        rounds = placebo_app.google.all_rounds()
+        rounds = util.future(placebo_app.all_rounds)
         placebo_app.slack.unlock_modal(trigger_id, user_id, rounds, placebo_app.last_round)
         return flask.make_response("", 200)
 
@@ -34,24 +243,36 @@ def unlock() -> flask.Response:
 
 
 @app.route('/correct', methods=['POST'])
+@requires_placebo
+@deduplicated
 def correct() -> flask.Response:
     text = flask.request.form['text']
     if not text:
         trigger_id = flask.request.form['trigger_id']
         user_id = flask.request.form['user_id']
-        puzzles_by_round, default_puzzle = placebo_app.google.unsolved_puzzles_by_round(
-            flask.request.form['channel_name'])
-        placebo_app.slack.correct_modal(trigger_id, user_id, puzzles_by_round, default_puzzle)
+        puzzles = util.future(placebo_app.correct_modal_options,
+                              [flask.request.form['channel_name']])
+        placebo_app.slack.correct_modal(trigger_id, user_id, puzzles)
         return flask.make_response("", 200)
     try:
-        puzzle_name, solution = split_correct(text)
+        solutions = [split_correct(part) for part in text.split(';') if part.strip()]
+        if not solutions:
+            raise ValueError('Nothing but semicolons')
     except ValueError:
-        return ephemeral('Try it like this: `/correct Puzzle Name PUZZLE SOLUTION`')
+        return ephemeral('Try it like this: `/correct Puzzle Name PUZZLE SOLUTION`, or for '
+                         'several at once, `/correct Puzzle One ONE; Puzzle Two TWO`')
+    if len(solutions) > 1:
+        # The response URL is for telling the QM about any puzzles that couldn't be found.
+        placebo_app.solved_puzzles(solutions, flask.request.form['response_url'])
+        return ephemeral(f'Marking {len(solutions)} puzzles solved...')
+    [(puzzle_name, solution)] = solutions
     placebo_app.solved_puzzle(puzzle_name, solution)
     return ephemeral(f'Marking {puzzle_name} solved...')
 
 
 @app.route('/newround', methods=['POST'])
+@requires_placebo
+@deduplicated
 def newround() -> flask.Response:
     text = flask.request.form['text']
     if not text:
@@ -68,25 +289,53 @@ def newround() -> flask.Response:
     return ephemeral(f'Adding {name}...')
 
 
+@app.route('/sweep', methods=['POST'])
+@requires_placebo
+@deduplicated
+def sweep() -> flask.Response:
+    placebo_app.sweep(flask.request.form['response_url'])
+    return ephemeral('Archiving idle channels for solved puzzles...')
+
+
+@app.route('/stats', methods=['GET', 'POST'])
+@requires_placebo
+def stats() -> flask.Response:
+    # These are kept up to date as we go, so this never needs to read the tracker. GET is for JSON;
+    # POST is the slash command.
+    hunt_stats = placebo_app.db.hunt_stats()
+    if flask.request.method == 'GET':
+        return flask.jsonify(hunt_stats)
+    return ephemeral(slack_client.stats_text(hunt_stats))
+
+
 @app.route('/interact', methods=['POST'])
+@requires_placebo
 def interact() -> flask.Response:
     payload = json.loads(flask.request.form['payload'])
     log.debug(pprint.pformat(payload))
     try:
         type = payload['type']
-        if type == 'view_submission':
-            return view_submission(payload['view'])
-        elif type == 'view_closed':
-            placebo_app.view_closed(payload['view']['id'])
-            return flask.make_response("", 200)
-        elif type == 'block_actions':
-            return block_actions(payload)
-        raise BadRequest(f'Unexpected type {type}')
+        if type in {'view_submission', 'view_closed'}:
+            key = f"{type}:{payload['view']['id']}"
+        else:
+            key = f"{type}:{payload['trigger_id']}"
+        return handle_once(key, lambda: handle_interaction(type, payload))
     except BadRequest:
         logging.exception(pprint.pformat(payload))
         raise
 
 
+def handle_interaction(type: str, payload: Dict[str, Any]) -> flask.Response:
+    if type == 'view_submission':
+        return view_submission(payload['view'])
+    elif type == 'view_closed':
+        placebo_app.view_closed(payload['view']['id'])
+        return flask.make_response("", 200)
+    elif type == 'block_actions':
+        return block_actions(payload)
+    raise BadRequest(f'Unexpected type {type}')
+
+
 def view_submission(view: Dict[str, Any]) -> flask.Response:
     callback_id = view['callback_id']
     fields = {}
@@ -129,6 +378,7 @@ def block_actions(payload: Dict[str, Any]) -> flask.Response:
 
 
 @app.route('/google_oauth')
+@requires_placebo
 def google_oauth() -> str:
     if 'error' in flask.request.args:
         error = flask.request.args['error']
@@ -138,6 +388,19 @@ def google_oauth() -> str:
     return 'Authorized!'
 
 
+@app.route('/drive_notify', methods=['POST'])
+@requires_placebo
+def drive_notify() -> flask.Response:
+    # Drive calls this when the tracker changes, once Placebo._watch_tracker has asked it to.
+    headers = flask.request.headers
+    if not placebo_app.tracker_changed(headers.get('X-Goog-Channel-Token', ''),
+                                       headers.get('X-Goog-Resource-State', '')):
+        log.warning('Ignoring a Drive notification with the wrong token (channel %s).',
+                    headers.get('X-Goog-Channel-ID'))
+        return flask.make_response("", 403)
+    return flask.make_response("", 200)
+
+
 def ephemeral(text: str) -> flask.Response:
     return flask.jsonify({'response_type': 'ephemeral', 'text': text})
 
@@ -169,3 +432,7 @@ def split_correct(text: str) -> Tuple[str, str]:
 
 def is_url(word: str) -> bool:
     return word.startswith('http') and '/' in word
+
+
+# Last, so all the routes are in place before we might replay anything.
+threading.Thread(target=initialize, daemon=True).start()
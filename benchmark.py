@@ -0,0 +1,291 @@
+# Microbenchmarks for the code that reads the tracker, at hunt scale. Everything runs against
+# synthetic API responses, with no network, so the numbers only reflect our own parsing and lookup.
+#
+#   python benchmark.py --output before.json
+#   ... make changes ...
+#   python benchmark.py --compare before.json
+#
+# Results are saved as JSON, keyed by "benchmark/rows", so runs from different commits can be
+# compared. --compare exits nonzero if anything got slower by more than --threshold.
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import google_client
+import util
+
+HEADER = ['Round', 'Puzzle', 'Priority', 'URL', 'Doc', 'Channel', 'Status', 'Answer']
+RANGE_PATTERN = re.compile(r"'?Puzzle List'?!([A-Z])(\d*):([A-Z])(\d*)")
+
+
+def tracker_rows(puzzles: int, rounds: int, seed: int = 0) -> List[List[str]]:
+    # A tracker laid out the way a real one is during a hunt: the header, the Hunt row, then each
+    # round's meta and puzzles together, a few blank rows, and the Event puzzles at the bottom.
+    rng = random.Random(seed)
+    rows = [HEADER, ['Hunt', 'The Hunt', '', 'https://hunt.example.com/', '', '', '']]
+    for r in range(rounds):
+        round_name = f'Round {r} of the Hunt'
+        count = puzzles // rounds + (1 if r < puzzles % rounds else 0)
+        for p in range(count):
+            name = f'Meta for round {r}' if p == 0 else f'Puzzle {r}-{p}: A Synthetic Title'
+            slug = util.canonicalize(name).lower()
+            status = rng.choice(['Not started', 'In progress', 'Solved', 'Backsolved'])
+            rows.append([round_name, name, rng.choice('-LMH'), f'https://hunt.example.com/{slug}',
+                         f'https://docs.google.com/spreadsheets/d/{slug}/edit', f'#{slug}',
+                         status, 'ANSWER' if 'solved' in status.lower() else ''])
+    rows.extend([[''] * 7] * 3)
+    rows.extend([['Event', f'Event {e}', '', '', '', f'#event-{e}', 'Not started']
+                 for e in range(5)])
+    return rows
+
+
+def column_index(letter: str) -> int:
+    return ord(letter) - ord('A')
+
+
+class FakeRequest:
+    def __init__(self, method: str, **kwargs: Any):
+        self.method = method
+        self.kwargs = kwargs
+
+
+class FakeSheets:
+    # Just enough of the Sheets API's spreadsheets() resource for google_client.Google.
+
+    def values(self) -> 'FakeSheets':
+        return self
+
+    def get(self, **kwargs: Any) -> FakeRequest:
+        return FakeRequest('values.get' if 'range' in kwargs else 'get', **kwargs)
+
+    def batchUpdate(self, **kwargs: Any) -> FakeRequest:
+        return FakeRequest('batchUpdate', **kwargs)
+
+
+class FakeClient:
+    # Stands in for google_client.LoggedInClient, answering every request from the same rows. The
+    # responses are built once and kept, so the benchmarks only time our side. Updates are ignored
+    # unless apply_updates is set, in which case inserted rows and their values are applied to the
+    # rows (and the kept responses dropped).
+
+    def __init__(self, rows: List[List[str]], apply_updates: bool = False):
+        self.rows = rows
+        self.apply_updates = apply_updates
+        self.sheets = FakeSheets()
+        self.responses: Dict[Tuple[Any, ...], google_client.Response] = {}
+
+    def log_and_send(self, desc: str, request: FakeRequest) -> google_client.Response:
+        if request.method == 'batchUpdate':
+            if self.apply_updates:
+                self.update(request.kwargs['body']['requests'])
+            return {}
+        if request.method == 'get':
+            key: Tuple[Any, ...] = ('grid',)
+            if key not in self.responses:
+                self.responses[key] = self.grid()
+            return self.responses[key]
+        key = (request.kwargs['range'], request.kwargs.get('majorDimension', 'ROWS'))
+        if key not in self.responses:
+            self.responses[key] = self.values(*key)
+        return self.responses[key]
+
+    def update(self, requests: List[Dict[str, Any]]) -> None:
+        for request in requests:
+            if 'insertDimension' in request:
+                self.rows.insert(request['insertDimension']['range']['startIndex'], [''] * 8)
+            elif 'start' in request.get('updateCells', {}):
+                start = request['updateCells']['start']
+                row = self.rows[start['rowIndex']]
+                for i, cell in enumerate(request['updateCells']['rows'][0]['values']):
+                    row[start['columnIndex'] + i] = next(iter(cell['userEnteredValue'].values()))
+        self.responses.clear()
+
+    def grid(self) -> google_client.Response:
+        white = google_client.PLAIN_BACKGROUND.to_dict()
+        return {'sheets': [{'data': [{'rowData': [
+            {'values': [{'formattedValue': row[0], 'effectiveFormat': {'backgroundColor': white}}]}
+            if row[0] else {}
+            for row in self.rows]}]}]}
+
+    def values(self, a1: str, major_dimension: str) -> google_client.Response:
+        match = RANGE_PATTERN.fullmatch(a1)
+        if not match:
+            raise ValueError(f'Unsupported range {a1}')
+        first_col, first_row, last_col, last_row = match.groups()
+        rows = self.rows[int(first_row or 1) - 1:int(last_row) if last_row else None]
+        # Like the real API, trailing empty cells are left off.
+        cells = [trim(row[column_index(first_col):column_index(last_col) + 1]) for row in rows]
+        if major_dimension == 'COLUMNS':
+            width = column_index(last_col) - column_index(first_col) + 1
+            cells = [trim([row[i] if i < len(row) else '' for row in cells]) for i in range(width)]
+        return {'values': cells}
+
+
+def trim(cells: List[str]) -> List[str]:
+    cells = list(cells)
+    while cells and cells[-1] == '':
+        cells.pop()
+    return cells
+
+
+def fake_google(rows: List[List[str]], apply_updates: bool = False) -> google_client.Google:
+    google = google_client.Google.__new__(google_client.Google)
+    google._client = FakeClient(rows, apply_updates)
+    google.puzzle_list_spreadsheet_id = 'tracker'
+    google.puzzle_list_sheet_id = 0
+    google.sharded = False
+    google._rounds = None
+    google._index = None
+    google.watch_url = None
+    return google
+
+
+def benchmarks(rows: List[List[str]]) -> Dict[str, Callable[[], Any]]:
+    google = fake_google(rows)
+    puzzles = [row for row in rows[2:] if len(row) > 5 and row[1]]
+    middle = puzzles[len(puzzles) // 2]
+    last_round = [row for row in puzzles if row[0] != 'Event'][-1][0]
+    channel_cells = [row[5] for row in puzzles]
+    new_row = ('New Round', 'New Puzzle', 'M', 'https://hunt.example.com/new', '', '#new',
+               'Not started')
+
+    def add_row(cell_values: google_client.Row) -> Callable[[], Any]:
+        # The fake tracker never changes, so start each call without a round registry, which times
+        # loading it from the Round column.
+        def f() -> Any:
+            google._rounds = None
+            return google._add_row(cell_values, None)
+        return f
+
+    # This one's tracker does take the rows, so the registry it loads on the first call stays good
+    # and each call after that times just the check of two cells. (The round's rows pile up, but
+    # the registry doesn't care how many a round has.)
+    warm = fake_google([list(row) + [''] * (8 - len(row)) for row in rows], apply_updates=True)
+
+    return {
+        'lookup': lambda: google.lookup(middle[1]),
+        'lookup_missing': lambda: google.lookup('Nothing Like This'),
+        'exists': lambda: google.exists(middle[1]),
+        'all_rounds': google.all_rounds,
+        'all_rows': google.all_rows,
+        'unsolved_puzzles_by_round': lambda: google.unsolved_puzzles_by_round(middle[5][1:]),
+        'link_to_channel': lambda: [google_client.link_to_channel(c) for c in channel_cells],
+        'add_row_existing_round': add_row((last_round,) + new_row[1:]),
+        'add_row_new_round': add_row(new_row),
+        'add_row_warm_registry': lambda: warm._add_row((last_round,) + new_row[1:], None),
+    }
+
+
+def time_it(f: Callable[[], Any], repeat: int, min_seconds: float) -> Dict[str, float]:
+    # Calls f in batches big enough to take min_seconds, and reports per-call times from the
+    # fastest and the median batch.
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            f()
+        if time.perf_counter() - start >= min_seconds:
+            break
+        number *= 2
+    batches = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            f()
+        batches.append((time.perf_counter() - start) / number)
+    return {
+        'min_us': min(batches) * 1e6,
+        'median_us': statistics.median(batches) * 1e6,
+        'calls': number * repeat,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes: List[int], rounds: int, repeat: int, min_seconds: float,
+        only: Optional[str]) -> Dict[str, Any]:
+    results = {}
+    for size in sizes:
+        rows = tracker_rows(size, min(rounds, size))
+        for name, f in benchmarks(rows).items():
+            if only and not re.search(only, name):
+                continue
+            key = f'{name}/{size}'
+            results[key] = time_it(f, repeat, min_seconds)
+            print(f"{key:40} {results[key]['min_us']:12.1f} us", file=sys.stderr)
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'rounds': rounds,
+        'results': results,
+    }
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> bool:
+    # Prints a table of the changes, and returns whether anything got slower than the threshold.
+    print(f"{'benchmark':40} {baseline.get('commit') or 'baseline':>12} "
+          f"{current.get('commit') or 'current':>12}   ratio")
+    regressed = False
+    for key, result in current['results'].items():
+        before = baseline['results'].get(key)
+        if before is None:
+            print(f"{key:40} {'-':>12} {result['min_us']:12.1f}")
+            continue
+        ratio = result['min_us'] / before['min_us']
+        flag = ''
+        if ratio > threshold:
+            flag = '  SLOWER'
+            regressed = True
+        print(f"{key:40} {before['min_us']:12.1f} {result['min_us']:12.1f} {ratio:7.2f}{flag}")
+    return regressed
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Times the code that reads the tracker, against synthetic responses.')
+    parser.add_argument('--sizes', default='100,1000,3000',
+                        help='comma-separated numbers of puzzles on the tracker')
+    parser.add_argument('--rounds', type=int, default=50, help='number of rounds')
+    parser.add_argument('--repeat', type=int, default=5, help='timed batches per benchmark')
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help='minimum duration of each timed batch')
+    parser.add_argument('--only', help='regex; only run benchmarks whose names match')
+    parser.add_argument('--output', help='file to save the results to (default: stdout)')
+    parser.add_argument('--compare', help='results from an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='with --compare, the slowdown ratio that counts as a regression')
+    args = parser.parse_args()
+
+    results = run([int(s) for s in args.sizes.split(',')], args.rounds, args.repeat,
+                  args.min_seconds, args.only)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    elif not args.compare:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        return 1 if compare(baseline, results, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+log = logging.getLogger('placebo.breaker')
+
+# A backend trips after this many failed or slow requests in a row.
+FAILURES_TO_TRIP = 3
+# Once it's tripped, wait this long before letting a request through to see if it's recovered.
+RESET_SECONDS = 60.0
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half open'
+
+
+class Unavailable(Exception):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f'{name} is unavailable; trying again in {retry_after:.0f} seconds.')
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    # Keeps track of whether a backend is healthy, so that when it's failing or slow, we can stop
+    # waiting on it and work around it instead. Every request's outcome and latency is recorded;
+    # FAILURES_TO_TRIP bad ones in a row (errors, or anything slower than slow_seconds) open the
+    # circuit, and check() then refuses requests. After RESET_SECONDS, one request is let through:
+    # if it's good, the circuit closes again, and if not, it stays open for another round.
+
+    def __init__(self, name: str, slow_seconds: float,
+                 on_change: Optional[Callable[['CircuitBreaker'], None]] = None):
+        self.name = name
+        self.slow_seconds = slow_seconds
+        self.on_change = on_change
+        self.state = CLOSED
+        self.bad_in_a_row = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def retry_after(self) -> float:
+        # How long until a request will be let through: 0 unless the circuit is open.
+        with self.lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self.opened_at + RESET_SECONDS - time.monotonic())
+
+    def available(self) -> bool:
+        return self.retry_after() == 0.0
+
+    def check(self) -> None:
+        # Call before each request. Raises Unavailable if it shouldn't be sent.
+        with self.lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN:
+                wait = self.opened_at + RESET_SECONDS - time.monotonic()
+                if wait <= 0:
+                    # Let this one through as a trial. Everything else waits to hear how it went.
+                    self.state = HALF_OPEN
+                    return
+            else:
+                # The trial is still out. If it goes badly, the circuit stays open for another
+                # RESET_SECONDS from then, so there's no use trying again any sooner.
+                wait = RESET_SECONDS
+            raise Unavailable(self.name, wait)
+
+    def record(self, seconds: float, ok: bool) -> None:
+        # Call after each request that check() let through.
+        bad = not ok or seconds > self.slow_seconds
+        with self.lock:
+            was = self.state
+            if bad:
+                self.bad_in_a_row += 1
+                if self.state == HALF_OPEN or (
+                        self.state == CLOSED and self.bad_in_a_row >= FAILURES_TO_TRIP):
+                    self.state = OPEN
+                    self.opened_at = time.monotonic()
+            else:
+                self.bad_in_a_row = 0
+                self.state = CLOSED
+            changed = (was == CLOSED) != (self.state == CLOSED)
+        if bad:
+            log.warning('%s request %s after %.1f seconds.', self.name,
+                        'was slow' if ok else 'failed', seconds)
+        if changed:
+            log.warning('%s is %s.', self.name, 'back' if self.state == CLOSED else 'unavailable')
+            if self.on_change:
+                self.on_change(self)
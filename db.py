@@ -0,0 +1,637 @@
+import datetime
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+import psycopg2
+from psycopg2 import extensions, extras
+
+import util
+
+log = logging.getLogger('placebo.db')
+
+T = TypeVar('T')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS credentials (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS in_progress_messages (
+    view_id TEXT PRIMARY KEY,
+    ts TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id BIGSERIAL PRIMARY KEY,
+    kind TEXT NOT NULL,
+    args TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    claimed_by TEXT,
+    claimed_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+    error TEXT
+);
+-- A job that's retrying something later isn't claimed until then.
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS run_after TIMESTAMPTZ;
+CREATE INDEX IF NOT EXISTS jobs_unclaimed ON jobs (id) WHERE claimed_at IS NULL;
+CREATE INDEX IF NOT EXISTS jobs_running ON jobs (claimed_by)
+    WHERE claimed_at IS NOT NULL AND finished_at IS NULL;
+CREATE TABLE IF NOT EXISTS deliveries (
+    key TEXT PRIMARY KEY,
+    seen_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS deliveries_seen_at ON deliveries (seen_at);
+CREATE TABLE IF NOT EXISTS puzzle_stats (
+    key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    round_key TEXT NOT NULL,
+    unlocked_at TIMESTAMPTZ,
+    solved BOOLEAN NOT NULL DEFAULT false,
+    solved_at TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS puzzle_stats_open ON puzzle_stats (round_key) WHERE NOT solved;
+CREATE TABLE IF NOT EXISTS round_stats (
+    key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp(),
+    open_puzzles INTEGER NOT NULL DEFAULT 0,
+    solved_puzzles INTEGER NOT NULL DEFAULT 0,
+    last_solved_at TIMESTAMPTZ
+);
+CREATE TABLE IF NOT EXISTS puzzles (
+    row_index INTEGER NOT NULL UNIQUE DEFERRABLE INITIALLY DEFERRED,
+    round TEXT NOT NULL,
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    doc_url TEXT NOT NULL,
+    channel TEXT,
+    status TEXT NOT NULL,
+    answer TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS puzzles_key ON puzzles (key);
+CREATE INDEX IF NOT EXISTS puzzles_channel ON puzzles (channel);
+CREATE TABLE IF NOT EXISTS leader (
+    only_row BOOLEAN PRIMARY KEY DEFAULT true CHECK (only_row),
+    worker_id TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    heartbeat_at TIMESTAMPTZ NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pending_unlocks (
+    id BIGSERIAL PRIMARY KEY,
+    attachment TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_timelines (
+    job_id BIGINT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    recorded_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    queued_seconds DOUBLE PRECISION NOT NULL,
+    seconds DOUBLE PRECISION NOT NULL,
+    spans TEXT NOT NULL
+);
+'''
+
+# Every process LISTENs on this (suffixed with the tenant's schema), and enqueueing a job NOTIFYs
+# it, so idle workers wake right away.
+JOBS_CHANNEL = 'placebo_jobs'
+# Key for the advisory lock a worker holds while it runs a job, along with a hash of the tenant's
+# schema. Whoever holds it is the only one running anything for that tenant, which keeps the
+# one-job-at-a-time guarantee across processes. (The value is arbitrary; it's just "plac" in
+# ASCII.)
+WORKER_LOCK_KEY = 0x706c6163
+# Even without a notification, check for jobs this often, in case one was missed or another
+# process was holding the lock.
+POLL_SECONDS = 5.0
+# Key for the advisory lock held by the process that owns the tenant's job queue, its leader. Only
+# the leader claims jobs; every other process is a standby, serving requests and enqueueing jobs,
+# and ready to take over. (It's WORKER_LOCK_KEY plus one.)
+LEADER_LOCK_KEY = 0x706c6164
+# How often the leader records that it's still alive, and how often a standby checks on it.
+LEADER_HEARTBEAT_SECONDS = 2.0
+# A leader that hasn't recorded a heartbeat in this long is presumed wedged or unreachable, and a
+# standby cuts off its session to take over.
+LEADER_TIMEOUT_SECONDS = 15.0
+# The heartbeat comes from the worker loop, between jobs, so a leader in the middle of one isn't
+# presumed wedged until the job has been running this long.
+JOB_TIMEOUT_SECONDS = 5 * 60.0
+# A puzzle's row_index is its place on the tracker: just the row index when everything is on the
+# Puzzle List tab, or when the tracker is sharded into a tab per round, the row index on its tab
+# plus ROWS_PER_TAB times the tab's number. Either way, rows sort in tracker order.
+ROWS_PER_TAB = 10000
+
+
+def connect(schema: str) -> extensions.connection:
+    conn = psycopg2.connect(os.environ['DATABASE_URL'], sslmode='require')
+    with conn.cursor() as cursor:
+        cursor.execute(f'CREATE SCHEMA IF NOT EXISTS {schema}; SET search_path TO {schema};')
+    conn.commit()
+    return conn
+
+
+@dataclass
+class Job:
+    id: int
+    kind: str
+    args: Dict[str, Any]
+    # How long it waited to be claimed (not counting any delay it was enqueued with).
+    queued_seconds: float = 0.0
+
+
+class Database:
+    # Shared state that has to be visible to every gunicorn worker: anything a request handled by
+    # one process might need while handling a later request in another.
+
+    def __init__(self, schema: str) -> None:
+        self.schema = schema
+        self.conn = connect(schema)
+        # psycopg2 connections can be shared between threads, but transactions can't, so take turns.
+        self.lock = threading.Lock()
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        try:
+            self.execute(SCHEMA)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+    def execute(self, query: str, args: Tuple[Any, ...] = ()) -> List[Tuple[Any, ...]]:
+        def run(cursor: extensions.cursor) -> List[Tuple[Any, ...]]:
+            cursor.execute(query, args)
+            return cursor.fetchall() if cursor.description else []
+        return self.transaction(run)
+
+    def transaction(self, work: Callable[[extensions.cursor], T]) -> T:
+        # Calls work with a cursor, and commits once it returns (or rolls back if it raises). If the
+        # connection turns out to be gone -- Postgres restarted, or the network dropped it while it
+        # was idle -- it's replaced, and work is tried again on the new one. That's safe as long as
+        # the commit hadn't been sent: nothing was committed, so nothing is done twice. If it had,
+        # there's no telling whether it went through, so the error is raised.
+        with self.lock:
+            for attempt in range(2):
+                committing = False
+                try:
+                    if self.conn.closed:
+                        self.conn = connect(self.schema)
+                    with self.conn.cursor() as cursor:
+                        result = work(cursor)
+                    committing = True
+                    self.conn.commit()
+                    return result
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    if not self.conn.closed:
+                        # Something like a deadlock or a timeout; the connection is fine.
+                        self.conn.rollback()
+                        raise
+                    if committing or attempt:
+                        raise
+                    log.warning('Lost the connection to Postgres. Reconnecting.')
+                except BaseException:
+                    if not self.conn.closed:
+                        self.conn.rollback()
+                    raise
+        raise AssertionError('unreachable')
+
+    def get_state(self, name: str) -> Optional[str]:
+        rows = self.execute('SELECT value FROM state WHERE name = %s;', (name,))
+        return rows[0][0] if rows else None
+
+    def set_state(self, name: str, value: str) -> None:
+        self.execute('INSERT INTO state (name, value) VALUES (%s, %s) '
+                     'ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value;', (name, value))
+
+    def delete_state(self, name: str) -> None:
+        self.execute('DELETE FROM state WHERE name = %s;', (name,))
+
+    def put_in_progress_message(self, view_id: str, ts: str) -> None:
+        self.execute('INSERT INTO in_progress_messages (view_id, ts) VALUES (%s, %s) '
+                     'ON CONFLICT (view_id) DO UPDATE SET ts = EXCLUDED.ts;', (view_id, ts))
+
+    def pop_in_progress_message(self, view_id: str) -> Optional[str]:
+        rows = self.execute('DELETE FROM in_progress_messages WHERE view_id = %s RETURNING ts;',
+                            (view_id,))
+        return rows[0][0] if rows else None
+
+    def first_delivery(self, key: str, window_seconds: float) -> bool:
+        # True the first time we see a key, and False if we've already seen it in the last
+        # window_seconds. Older keys are forgotten, which keeps the table small.
+        self.execute("DELETE FROM deliveries WHERE seen_at < now() - %s * interval '1 second';",
+                     (window_seconds,))
+        rows = self.execute('INSERT INTO deliveries (key) VALUES (%s) '
+                            'ON CONFLICT (key) DO NOTHING RETURNING key;', (key,))
+        return bool(rows)
+
+    def forget_delivery(self, key: str) -> None:
+        # For a delivery we couldn't handle, so the next one of the same key isn't a repeat.
+        self.execute('DELETE FROM deliveries WHERE key = %s;', (key,))
+
+    # Hunt statistics, kept up to date as puzzles are unlocked and solved, so that answering
+    # questions about them doesn't need the tracker. Puzzles and rounds are keyed by canonical name.
+    # Puzzles that were already in the tracker when we started counting have no timestamps.
+
+    def record_round(self, round_name: str) -> None:
+        self.execute('INSERT INTO round_stats (key, name) VALUES (%s, %s) '
+                     'ON CONFLICT (key) DO NOTHING;', (util.canonicalize(round_name), round_name))
+
+    def record_unlock(self, puzzle_name: str, round_name: str) -> None:
+        self.execute(
+            'WITH new AS ('
+            '    INSERT INTO puzzle_stats (key, name, round_key, unlocked_at) '
+            '    VALUES (%s, %s, %s, now()) ON CONFLICT (key) DO NOTHING RETURNING round_key) '
+            'INSERT INTO round_stats (key, name, open_puzzles) SELECT round_key, %s, 1 FROM new '
+            'ON CONFLICT (key) DO UPDATE SET open_puzzles = round_stats.open_puzzles + 1;',
+            (util.canonicalize(puzzle_name), puzzle_name, util.canonicalize(round_name),
+             round_name))
+
+    def record_solve(self, puzzle_name: str) -> None:
+        # The name may be only part of the puzzle's name, as it can be for the tracker lookup:
+        # prefer an exact match, then the shortest name containing it.
+        key = util.canonicalize(puzzle_name)
+        self.execute(
+            'WITH solved AS ('
+            '    UPDATE puzzle_stats SET solved = true, solved_at = now() '
+            '    WHERE NOT solved AND key = ('
+            '        SELECT key FROM puzzle_stats WHERE NOT solved AND strpos(key, %s) > 0 '
+            '        ORDER BY key = %s DESC, length(key) LIMIT 1) '
+            '    RETURNING round_key, solved_at) '
+            'UPDATE round_stats SET open_puzzles = open_puzzles - 1, '
+            '    solved_puzzles = solved_puzzles + 1, last_solved_at = solved.solved_at '
+            'FROM solved WHERE round_stats.key = solved.round_key;', (key, key))
+
+    def seed_stats(self, puzzles: Iterable[Tuple[str, str, bool]]) -> None:
+        # Takes (round name, puzzle name, solved) for everything already in the tracker, then
+        # recounts. A round with no puzzles yet has an empty puzzle name. It's all one transaction,
+        # a few statements no matter how big the tracker is.
+        rounds: Dict[str, str] = {}
+        puzzle_rows: Dict[str, Tuple[str, str, bool]] = {}
+        for round_name, puzzle_name, solved in puzzles:
+            round_key = util.canonicalize(round_name)
+            rounds.setdefault(round_key, round_name)
+            if puzzle_name:
+                # A puzzle someone marked solved by hand counts as solved, with no timestamp. (If
+                # it's listed twice, it's solved if either row says so.)
+                key = util.canonicalize(puzzle_name)
+                name, first_round_key, was_solved = puzzle_rows.get(
+                    key, (puzzle_name, round_key, False))
+                puzzle_rows[key] = (name, first_round_key, was_solved or solved)
+
+        def seed(cursor: extensions.cursor) -> None:
+            # Rounds are listed in the order they were created, and these all go in at once, so
+            # each gets a microsecond more than the last to keep them in tracker order.
+            extras.execute_values(
+                cursor, 'INSERT INTO round_stats (key, name, created_at) VALUES %s '
+                'ON CONFLICT (key) DO NOTHING;',
+                [(key, name, i) for i, (key, name) in enumerate(rounds.items())],
+                template="(%s, %s, clock_timestamp() + %s * interval '1 microsecond')",
+                page_size=1000)
+            extras.execute_values(
+                cursor, 'INSERT INTO puzzle_stats (key, name, round_key, solved) VALUES %s '
+                'ON CONFLICT (key) DO UPDATE SET solved = puzzle_stats.solved OR EXCLUDED.solved;',
+                [(key, name, round_key, solved)
+                 for key, (name, round_key, solved) in puzzle_rows.items()],
+                page_size=1000)
+            cursor.execute(
+                'UPDATE round_stats SET '
+                '    open_puzzles = (SELECT count(*) FROM puzzle_stats p '
+                '                    WHERE p.round_key = round_stats.key AND NOT p.solved), '
+                '    solved_puzzles = (SELECT count(*) FROM puzzle_stats p '
+                '                      WHERE p.round_key = round_stats.key AND p.solved), '
+                '    last_solved_at = (SELECT max(solved_at) FROM puzzle_stats p '
+                '                      WHERE p.round_key = round_stats.key);')
+        self.transaction(seed)
+
+    def hunt_stats(self) -> Dict[str, Any]:
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        def when(t: Optional[datetime.datetime]) -> Dict[str, Any]:
+            return {'at': t.isoformat() if t else None,
+                    'seconds_ago': (now - t).total_seconds() if t else None}
+
+        rounds = []
+        by_key = {}
+        last_solved_at = None
+        for key, name, open_puzzles, solved_puzzles, round_last_solved_at in self.execute(
+                'SELECT key, name, open_puzzles, solved_puzzles, last_solved_at FROM round_stats '
+                'ORDER BY created_at;'):
+            by_key[key] = {
+                'round': name,
+                'open': open_puzzles,
+                'solved': solved_puzzles,
+                'last_solved': when(round_last_solved_at),
+                'open_puzzles': [],
+            }
+            rounds.append(by_key[key])
+            if round_last_solved_at and (
+                    not last_solved_at or round_last_solved_at > last_solved_at):
+                last_solved_at = round_last_solved_at
+        for round_key, name, unlocked_at in self.execute(
+                'SELECT round_key, name, unlocked_at FROM puzzle_stats WHERE NOT solved '
+                'ORDER BY unlocked_at NULLS FIRST;'):
+            by_key[round_key]['open_puzzles'].append({'name': name, 'unlocked': when(unlocked_at)})
+        return {'rounds': rounds, 'last_solved': when(last_solved_at)}
+
+    # While Drive is sending us notifications of changes to the tracker, reads of it can be cached
+    # until the next one. The version counts the changes, so every process can tell whether what
+    # it cached is still current.
+
+    def drive_watch(self) -> Optional[Dict[str, Any]]:
+        # The Drive notification channel for the tracker: its id, resource_id, address, and
+        # expiration (in epoch seconds). It may have expired.
+        value = self.get_state('drive_watch')
+        return json.loads(value) if value else None
+
+    def set_drive_watch(self, watch: Dict[str, Any]) -> None:
+        self.set_state('drive_watch', json.dumps(watch))
+
+    def tracker_version(self) -> Optional[int]:
+        # None unless the tracker is being watched, in which case nothing should be cached.
+        rows = self.execute("SELECT watch.value, coalesce(version.value, '0') FROM state watch "
+                            "LEFT JOIN state version ON version.name = 'tracker_version' "
+                            "WHERE watch.name = 'drive_watch';")
+        if not rows or json.loads(rows[0][0])['expiration'] <= time.time():
+            return None
+        return int(rows[0][1])
+
+    def tracker_changed(self) -> None:
+        self.execute("INSERT INTO state (name, value) VALUES ('tracker_version', '1') "
+                     "ON CONFLICT (name) DO UPDATE SET value = (state.value::bigint + 1)::text;")
+
+    # A mirror of the tracker's rows, so reads like populating a modal or finding a puzzle's row
+    # don't need the Google Sheet. It's written through as we change the tracker, and replaced
+    # wholesale from time to time to pick up changes people make by hand, so it can be a little
+    # stale: anything that writes to a row it found here should check the row first.
+
+    def puzzles_synced_seconds_ago(self) -> Optional[float]:
+        rows = self.execute("SELECT extract(epoch FROM now() - value::timestamptz) FROM state "
+                            "WHERE name = 'puzzles_synced_at';")
+        return float(rows[0][0]) if rows else None
+
+    def puzzles_synced(self) -> bool:
+        return self.puzzles_synced_seconds_ago() is not None
+
+    def replace_puzzles(
+            self, rows: Iterable[Tuple[int, str, str, str, Optional[str], str, str]]) -> None:
+        # Takes (row index, round, name, doc URL, channel name, status, answer) for every row of
+        # the tracker.
+        values = [(row_index, round_name, name, util.canonicalize(name), doc_url, channel, status,
+                   answer)
+                  for row_index, round_name, name, doc_url, channel, status, answer in rows]
+
+        def replace(cursor: extensions.cursor) -> None:
+            cursor.execute('DELETE FROM puzzles;')
+            extras.execute_values(
+                cursor, 'INSERT INTO puzzles (row_index, round, name, key, doc_url, channel, '
+                'status, answer) VALUES %s;', values, page_size=1000)
+            cursor.execute("INSERT INTO state (name, value) VALUES ('puzzles_synced_at', "
+                           "now()::text) ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value;")
+        self.transaction(replace)
+
+    def insert_puzzle(self, row_index: int, round_name: str, name: str, channel: Optional[str],
+                      status: str) -> None:
+        # The rows below it on the same tab move down one.
+        self.execute('UPDATE puzzles SET row_index = row_index + 1 '
+                     'WHERE row_index >= %s AND row_index / %s = %s / %s; '
+                     'INSERT INTO puzzles (row_index, round, name, key, doc_url, channel, status, '
+                     "answer) VALUES (%s, %s, %s, %s, '', %s, %s, '');",
+                     (row_index, ROWS_PER_TAB, row_index, ROWS_PER_TAB, row_index, round_name,
+                      name, util.canonicalize(name), channel, status))
+
+    def set_puzzle_doc_url(self, name: str, doc_url: str) -> None:
+        self.execute('UPDATE puzzles SET doc_url = %s WHERE key = %s;',
+                     (doc_url, util.canonicalize(name)))
+
+    def mark_puzzle_solved(self, row_index: int, answer: str) -> None:
+        self.execute("UPDATE puzzles SET status = 'Solved', answer = %s WHERE row_index = %s;",
+                     (answer, row_index))
+
+    def lookup_puzzle(self, puzzle_name: str) -> Optional[Tuple[int, str, Optional[str]]]:
+        # Same as Google.lookup: (row index, doc URL, channel name) for the one puzzle whose name
+        # contains this one.
+        key = util.canonicalize(puzzle_name)
+        rows = self.execute("SELECT row_index, doc_url, channel FROM puzzles "
+                            "WHERE strpos(key, %s) > 0 AND name <> '';", (key,))
+        if not rows:
+            return None
+        elif len(rows) == 1:
+            return rows[0]
+        else:
+            raise KeyError(f'{len(rows)} rows matching {key}')
+
+    def all_rounds(self) -> List[str]:
+        rows = self.execute("SELECT round FROM puzzles "
+                            "WHERE row_index >= 2 AND round NOT IN ('', 'Hunt', 'Meta') "
+                            "GROUP BY round ORDER BY min(row_index);")
+        return [round_name for round_name, in rows]
+
+    def unsolved_puzzles_by_round(
+            self, channel_name: str) -> Tuple[Dict[str, List[str]], Optional[str]]:
+        result: Dict[str, List[str]] = {}
+        for round_name, name in self.execute(
+                "SELECT round, name FROM puzzles WHERE row_index >= 2 AND name <> '' "
+                "AND status NOT IN ('', 'Solved', 'Backsolved') ORDER BY row_index;"):
+            result.setdefault(round_name, []).append(name)
+        default = self.execute('SELECT name FROM puzzles WHERE row_index >= 2 AND channel = %s '
+                               'ORDER BY row_index DESC LIMIT 1;', (channel_name,))
+        return result, default[0][0] if default else None
+
+    def solved_channels(self) -> List[str]:
+        rows = self.execute("SELECT channel FROM puzzles WHERE row_index >= 2 "
+                            "AND status IN ('Solved', 'Backsolved') AND channel IS NOT NULL "
+                            "ORDER BY row_index;")
+        return [channel for channel, in rows]
+
+    def enqueue(self, kind: str, args: Dict[str, Any],
+                delay_seconds: Optional[float] = None) -> None:
+        # With a delay, the job waits at least that long before it can be claimed.
+        self.execute("INSERT INTO jobs (kind, args, run_after) "
+                     "VALUES (%s, %s, now() + %s * interval '1 second'); "
+                     f'NOTIFY {JOBS_CHANNEL}_{self.schema};',
+                     (kind, json.dumps(args), delay_seconds))
+
+    def enqueue_unless_pending(self, kind: str, delay_seconds: Optional[float] = None) -> None:
+        # For housekeeping jobs with no arguments: one waiting to run is as good as several. (One
+        # that's already running isn't, since it may have read whatever it reads too early.)
+        self.execute("INSERT INTO jobs (kind, args, run_after) "
+                     "SELECT %s, %s, now() + %s * interval '1 second' WHERE NOT EXISTS ("
+                     '    SELECT 1 FROM jobs WHERE kind = %s AND claimed_at IS NULL); '
+                     f'NOTIFY {JOBS_CHANNEL}_{self.schema};', (kind, '{}', delay_seconds, kind))
+
+    # Unlock announcements waiting to go out, oldest first. (See Slack.announce_unlock.)
+
+    def add_pending_unlock(self, attachment: Dict[str, Any]) -> None:
+        self.execute('INSERT INTO pending_unlocks (attachment) VALUES (%s);',
+                     (json.dumps(attachment),))
+
+    def pending_unlocks(self) -> List[Tuple[int, Dict[str, Any]]]:
+        return [(id, json.loads(attachment)) for id, attachment in self.execute(
+            'SELECT id, attachment FROM pending_unlocks ORDER BY id;')]
+
+    def remove_pending_unlocks(self, through_id: int) -> None:
+        self.execute('DELETE FROM pending_unlocks WHERE id <= %s;', (through_id,))
+
+    def leader(self) -> Optional[Tuple[str, float]]:
+        # The leader's worker ID, and how many seconds ago its last heartbeat was.
+        rows = self.execute('SELECT worker_id, extract(epoch FROM now() - heartbeat_at) '
+                            'FROM leader;')
+        return (rows[0][0], float(rows[0][1])) if rows else None
+
+    def record_timeline(self, job_id: int, kind: str, queued_seconds: float, seconds: float,
+                        spans_json: str) -> None:
+        self.execute('INSERT INTO job_timelines (job_id, kind, queued_seconds, seconds, spans) '
+                     'VALUES (%s, %s, %s, %s, %s) ON CONFLICT (job_id) DO NOTHING;',
+                     (job_id, kind, queued_seconds, seconds, spans_json))
+
+
+class JobConsumer:
+    # Claims jobs one at a time on its own connection, since it needs a session-level lock and a
+    # LISTEN that would otherwise get tangled up with everyone else's transactions. The leader lock
+    # is held on the same connection, so cutting off that one session is enough to free up both.
+
+    def __init__(self, worker_id: str, schema: str) -> None:
+        self.worker_id = worker_id
+        self.schema = schema
+        self.conn: Optional[extensions.connection] = None
+        self.leading = False
+        self.heartbeat_at = 0.0
+
+    def lead(self) -> bool:
+        # Becomes the leader if no one else is. Returns whether we're the leader now.
+        if self.leading:
+            return True
+        [(locked,)] = self._query('SELECT pg_try_advisory_lock(%s, hashtext(%s));',
+                                  (LEADER_LOCK_KEY, self.schema))
+        if locked:
+            self._query('INSERT INTO leader (worker_id, pid, heartbeat_at) '
+                        'VALUES (%s, pg_backend_pid(), now()) '
+                        'ON CONFLICT (only_row) DO UPDATE SET worker_id = EXCLUDED.worker_id, '
+                        '    pid = EXCLUDED.pid, heartbeat_at = EXCLUDED.heartbeat_at;',
+                        (self.worker_id,))
+            self.leading = True
+            self.heartbeat_at = time.monotonic()
+        return self.leading
+
+    def heartbeat_if_due(self) -> None:
+        # Tells the standbys we're still alive. It's sent on this connection, the session holding
+        # the leader lock, and only if the leader row still names that session, so it stops as
+        # soon as we're not really the leader.
+        if not self.leading or time.monotonic() - self.heartbeat_at < LEADER_HEARTBEAT_SECONDS:
+            return
+        if not self._query('UPDATE leader SET heartbeat_at = now() '
+                           'WHERE worker_id = %s AND pid = pg_backend_pid() RETURNING 1;',
+                           (self.worker_id,)):
+            log.warning('Another process took over the job queue.')
+            self.reset()
+            return
+        self.heartbeat_at = time.monotonic()
+
+    def depose_if_stale(self) -> Optional[str]:
+        # If the leader's heartbeat is overdue, and it isn't partway through a job that hasn't yet
+        # been running for JOB_TIMEOUT_SECONDS, terminates its session, which releases its locks,
+        # so that we can take over. Returns its worker ID if so. (Checking that the session still
+        # holds this tenant's leader lock makes sure it's the right one, since PIDs get reused.)
+        rows = self._query("SELECT worker_id, pg_terminate_backend(pid) FROM leader "
+                           "WHERE heartbeat_at < now() - %s * interval '1 second' "
+                           "AND worker_id <> %s AND EXISTS ("
+                           "    SELECT 1 FROM pg_locks WHERE pg_locks.pid = leader.pid "
+                           "    AND locktype = 'advisory' AND classid = %s::oid "
+                           "    AND objid = hashtext(%s)::oid AND objsubid = 2 AND granted) "
+                           "AND NOT EXISTS ("
+                           "    SELECT 1 FROM jobs WHERE claimed_by = leader.worker_id "
+                           "    AND claimed_at IS NOT NULL AND finished_at IS NULL "
+                           "    AND claimed_at > now() - %s * interval '1 second');",
+                           (LEADER_TIMEOUT_SECONDS, self.worker_id, LEADER_LOCK_KEY, self.schema,
+                            JOB_TIMEOUT_SECONDS))
+        return rows[0][0] if rows and rows[0][1] else None
+
+    def _connect(self) -> extensions.connection:
+        if self.conn is None or self.conn.closed:
+            self.conn = connect(self.schema)
+            self.conn.autocommit = True
+            with self.conn.cursor() as cursor:
+                cursor.execute(f'LISTEN {JOBS_CHANNEL}_{self.schema};')
+        return self.conn
+
+    def _query(self, query: str, args: Tuple[Any, ...] = ()) -> List[Tuple[Any, ...]]:
+        with self._connect().cursor() as cursor:
+            cursor.execute(query, args)
+            return cursor.fetchall() if cursor.description else []
+
+    def claim(self) -> Optional[Job]:
+        # Returns the oldest unclaimed job, holding the worker lock, or None (not holding it) if
+        # there's nothing to do or another process is busy. Call finish() when the job is done.
+        [(locked,)] = self._query('SELECT pg_try_advisory_lock(%s, hashtext(%s));',
+                                  (WORKER_LOCK_KEY, self.schema))
+        if not locked:
+            return None
+        try:
+            # Anything claimed but not finished belonged to a worker that died mid-job, or it would
+            # still be holding the lock. It may have been half done, so don't try it again.
+            for job_id, kind, claimed_by in self._query(
+                    "UPDATE jobs SET finished_at = now(), error = 'abandoned' "
+                    'WHERE claimed_at IS NOT NULL AND finished_at IS NULL '
+                    'RETURNING id, kind, claimed_by;'):
+                log.error('Job %s (%s) was abandoned by %s.', job_id, kind, claimed_by)
+            rows = self._query(
+                'UPDATE jobs SET claimed_by = %s, claimed_at = now() '
+                'WHERE id = (SELECT id FROM jobs WHERE claimed_at IS NULL '
+                '            AND (run_after IS NULL OR run_after <= now()) ORDER BY id LIMIT 1) '
+                'RETURNING id, kind, args, '
+                '    extract(epoch FROM claimed_at - coalesce(run_after, created_at));',
+                (self.worker_id,))
+        except BaseException:
+            self._unlock()
+            raise
+        if not rows:
+            self._unlock()
+            return None
+        [(job_id, kind, args, queued_seconds)] = rows
+        return Job(job_id, kind, json.loads(args), float(queued_seconds))
+
+    def finish(self, job: Job, error: Optional[str] = None) -> None:
+        try:
+            self._query('UPDATE jobs SET finished_at = now(), error = %s WHERE id = %s;',
+                        (error, job.id))
+        finally:
+            self._unlock()
+
+    def _unlock(self) -> None:
+        if self.conn is not None and not self.conn.closed:
+            self._query('SELECT pg_advisory_unlock(%s, hashtext(%s));',
+                        (WORKER_LOCK_KEY, self.schema))
+
+    def wait(self) -> None:
+        # Blocks until a job is enqueued anywhere, or a delayed job comes due, or for POLL_SECONDS
+        # at most. The leader only waits until its next heartbeat is due.
+        [(due_seconds,)] = self._query(
+            'SELECT extract(epoch FROM min(run_after) - now()) FROM jobs '
+            'WHERE claimed_at IS NULL AND run_after > now();')
+        timeout = POLL_SECONDS if due_seconds is None else min(float(due_seconds), POLL_SECONDS)
+        if self.leading:
+            timeout = min(timeout, self.heartbeat_at + LEADER_HEARTBEAT_SECONDS - time.monotonic())
+        timeout = max(timeout, 0.0)
+        conn = self._connect()
+        select.select([conn], [], [], timeout)
+        conn.poll()
+        conn.notifies.clear()
+
+    def reset(self) -> None:
+        # After a connection error, start over with a fresh connection. (Closing the old one also
+        # releases the locks, if we had them, so we're not the leader anymore.)
+        self.leading = False
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+        self.conn = None
@@ -0,0 +1,45 @@
+# Stands in for Drive, to try out tracker change notifications without a public HTTPS address. Set
+# PLACEBO_DRIVE_WATCH_URL to the local server's /drive_notify (for example,
+# http://localhost:5000/drive_notify), and once Placebo has recorded its channel, this sends the
+# notification Drive would send when someone edits the tracker.
+#
+#   python drive_notify.py               # a change
+#   python drive_notify.py --state sync  # what Drive sends when a channel is first set up
+#   python drive_notify.py --schema tenant_t0123  # a tenant other than the default one
+
+import argparse
+import json
+import sys
+
+import requests
+
+import db
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Send Placebo a Drive change notification.')
+    parser.add_argument('--schema', default='public', help="the tenant's Postgres schema")
+    parser.add_argument('--state', default='update', help='X-Goog-Resource-State to send')
+    parser.add_argument('--address', help='where to send it (default: the recorded channel)')
+    args = parser.parse_args()
+
+    conn = db.connect(args.schema)
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT name, value FROM state "
+                       "WHERE name IN ('drive_watch', 'drive_watch_token');")
+        state = dict(cursor.fetchall())
+    if 'drive_watch' not in state:
+        sys.exit('No tracker watch recorded yet. Is PLACEBO_DRIVE_WATCH_URL set?')
+    watch = json.loads(state['drive_watch'])
+    response = requests.post(args.address or watch['address'], headers={
+        'X-Goog-Channel-ID': watch['id'],
+        'X-Goog-Channel-Token': state['drive_watch_token'],
+        'X-Goog-Resource-ID': watch['resource_id'] or 'stand-in',
+        'X-Goog-Resource-State': args.state,
+        'X-Goog-Message-Number': '1',
+    })
+    print(response.status_code)
+
+
+if __name__ == '__main__':
+    main()
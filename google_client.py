@@ -1,19 +1,32 @@
+import contextlib
+import datetime
 import json
 import logging
 import os
 import pprint
 import re
-from typing import Any, Dict, Iterable, List, Optional, Tuple, TypeVar, Union
+import secrets
+import threading
+import time
+import urllib.parse
+from dataclasses import dataclass
+from typing import (TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple,
+                    TypeVar, Union)
 
 import httplib2
-import psycopg2
 from google.oauth2.credentials import Credentials
-from google_auth_httplib2 import AuthorizedHttp
-from google_auth_oauthlib.flow import Flow
-from googleapiclient import discovery, http
+from google_auth_httplib2 import AuthorizedHttp, Request
+from googleapiclient import errors, http
 from googleapiclient.http import DEFAULT_HTTP_TIMEOUT_SEC
-from psycopg2 import extensions
 
+if TYPE_CHECKING:
+    # This one is slow to import and only needed for the OAuth flow, so it's imported when used.
+    from google_auth_oauthlib.flow import Flow
+
+import breaker
+import db
+import tenants
+import timeline
 import util
 
 log = logging.getLogger('placebo.google_client')
@@ -48,6 +61,43 @@ ROUND_COLORS = [
     util.Color(red=0.64, green=0.76, blue=0.96),  # light cornflower blue 2
 ]
 
+# Discovery documents for the APIs we use. They're bundled, rather than fetched every time we start
+# up, since they're big and fetching them can take long enough to make the first command after a
+# restart miss Slack's deadline. To update one, save (for example)
+# https://www.googleapis.com/discovery/v1/apis/drive/v3/rest over discovery/drive.v3.json.
+DISCOVERY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'discovery')
+
+# Responses to GET requests are cached in memory, and httplib2 revalidates them with If-None-Match,
+# so a repeated read whose response had an ETag costs a 304 instead of the whole body again. It's
+# shared by every connection, and bounded so it can't grow without limit over a long hunt.
+HTTP_CACHE = util.LruCache(int(os.environ.get('PLACEBO_HTTP_CACHE_BYTES', 8 * 1024 * 1024)))
+# httplib2 isn't thread-safe, and we send requests from several threads at once (e.g. while marking
+# a puzzle solved), so each request borrows a connection of its own from this pool and returns it
+# when it's done. That way a thread started for one step of a solve reuses a connection someone
+# else already opened, instead of starting over with a new TCP and TLS handshake. They're shared by
+# all tenants, and the pool keeps at most HTTP_POOL_SIZE idle ones.
+_http_pool: List[httplib2.Http] = []
+_http_pool_lock = threading.Lock()
+HTTP_POOL_SIZE = 16
+# An access token lasts an hour. Placebo renews it in the background once it has less than this
+# left, so no request has to wait on a refresh (or the Postgres write that saves the new token).
+TOKEN_REFRESH_MARGIN_SECONDS = 10 * 60
+# The most calls Drive accepts in one batch request.
+DRIVE_BATCH_LIMIT = 100
+# A Sheets or Drive request that takes longer than this counts against that backend's circuit
+# breaker, the same as one that fails. See breaker.CircuitBreaker.
+GOOGLE_SLOW_SECONDS = 10.0
+# How long we ask Drive to send notifications of changes to the tracker. A day is the most it allows
+# for a file; the channel is renewed before then.
+WATCH_SECONDS = 24 * 60 * 60
+
+# The tracker's main tab: every puzzle's row, or when the tracker is sharded, the index of rounds.
+PUZZLE_LIST = 'Puzzle List'
+# The Status values that mean a puzzle is done.
+SOLVED_STATUSES = frozenset({'Solved', 'Backsolved'})
+# The header row we give each round's tab, when the tracker is sharded.
+SHARD_HEADER = ['Round', 'Puzzle', 'Priority', 'URL', 'Doc', 'Channel', 'Status', 'Answer']
+
 T = TypeVar('T')
 
 # This is a little disappointing, but we only have two other options: a recursive definition, like
@@ -55,13 +105,24 @@ T = TypeVar('T')
 # which isn't yet supported by mypy and generates spurious type errors, or a TypedDict, which would
 # have to be spelled out exhaustively and isn't worth the bulk.
 Response = Dict[str, Any]
+# A puzzle's tracker row: (row index, doc URL, channel name).
+Lookup = Tuple[int, str, Optional[str]]
 
 
 class LoggedOutClient:
-    def __init__(self):
-        self.flow = Flow.from_client_config(
-            json.loads(os.environ['PLACEBO_GOOGLE_CLIENT_SECRETS']),
-            scopes=[SCOPE], redirect_uri='https://control-group.herokuapp.com/google_oauth')
+    def __init__(self, state: Optional[str] = None):
+        self._flow: Optional['Flow'] = None
+        self._state = state
+
+    @property
+    def flow(self) -> 'Flow':
+        if self._flow is None:
+            from google_auth_oauthlib.flow import Flow
+            self._flow = Flow.from_client_config(
+                json.loads(os.environ['PLACEBO_GOOGLE_CLIENT_SECRETS']),
+                scopes=[SCOPE], redirect_uri='https://control-group.herokuapp.com/google_oauth',
+                state=self._state)
+        return self._flow
 
     @property
     def sheets(self):
@@ -71,6 +132,10 @@ class LoggedOutClient:
     def files(self):
         raise TypeError('Not logged in.')
 
+    @property
+    def drive(self):
+        raise TypeError('Not logged in.')
+
     def save_credentials(self) -> None:
         raise TypeError('Not logged in.')
 
@@ -78,100 +143,413 @@ class LoggedOutClient:
         raise TypeError('Not logged in.')
 
 
+class SharedCredentials(Credentials):
+    # Credentials used by several threads at once. google-auth refreshes the token from whichever
+    # thread needs it: our background refresh, or AuthorizedHttp, either before sending a request
+    # with an expired token or after getting a 401. Those all come through refresh(), so that's
+    # where they take turns. A thread that waited on someone else's refresh uses the token they got
+    # instead of refreshing again.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Reentrant, so refresh_if_expiring can hold it while checking the expiry and refreshing.
+        self.refresh_lock = threading.RLock()
+
+    @classmethod
+    def from_info(cls, info: Dict[str, Any]) -> 'SharedCredentials':
+        # Takes what credentials_info returns.
+        info = dict(info)
+        # The constructor doesn't take the expiry, so it's set separately.
+        expiry = info.pop('expiry', None)
+        credentials = cls(**info)
+        if expiry:
+            credentials.expiry = datetime.datetime.fromisoformat(expiry)
+        return credentials
+
+    def refresh(self, request: Request) -> None:
+        token = self.token
+        with self.refresh_lock:
+            if self.token != token and self.valid:
+                return
+            super().refresh(request)
+
+
+def credentials_info(credentials: Credentials) -> Dict[str, Any]:
+    info = {name: getattr(credentials, name) for name in
+            ['token', 'refresh_token', 'token_uri', 'client_id', 'client_secret', 'scopes']}
+    expiry = credentials.expiry
+    info['expiry'] = expiry.isoformat() if expiry else None
+    return info
+
+
 class LoggedInClient:
-    def __init__(self, credentials: Credentials, conn: extensions.connection):
+    def __init__(self, credentials: SharedCredentials, database: db.Database,
+                 breakers: Dict[str, breaker.CircuitBreaker]):
         self.credentials = credentials
-        self.conn = conn
-        # This is roughly googleapiclient.http.build_http(), but with a cache.
-        http = httplib2.Http(cache='.cache', timeout=DEFAULT_HTTP_TIMEOUT_SEC)
-        http.redirect_codes -= {308}
-        # And this is roughly what discovery.build(... credentials=credentials) does, but with our
-        # cache-enabled http.
-        auth_http = AuthorizedHttp(credentials=credentials, http=http)
-        self.sheets = discovery.build('sheets', 'v4', http=auth_http).spreadsheets()
-        self.files = discovery.build('drive', 'v3', http=auth_http).files()
+        self.db = database
+        # One circuit breaker per backend, 'sheets' and 'drive'. They belong to the Google object,
+        # so they outlive a client replaced by logging in again.
+        self.breakers = breakers
+        # Building the services doesn't send anything, so this connection goes right back.
+        with pooled_http() as connection:
+            auth_http = self.authorized_http(connection)
+            self.sheets = build_service('sheets', 'v4', auth_http).spreadsheets()
+            self.drive = build_service('drive', 'v3', auth_http)
+        self.files = self.drive.files()
+
+    def authorized_http(self, connection: httplib2.Http) -> AuthorizedHttp:
+        # This is roughly what discovery.build(... credentials=credentials) does, but with our
+        # cache-enabled, pooled http.
+        return AuthorizedHttp(credentials=self.credentials, http=connection)
 
     @classmethod
-    def from_loading_credentials(cls, conn: extensions.connection) -> Optional['LoggedInClient']:
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM credentials WHERE name = 'google_credentials';")
-        row = cursor.fetchone()
-        if not row:
+    def from_loading_credentials(cls, database: db.Database,
+                                 breakers: Dict[str, breaker.CircuitBreaker]
+                                 ) -> Optional['LoggedInClient']:
+        rows = database.execute(
+            "SELECT value FROM credentials WHERE name = 'google_credentials';")
+        if not rows:
             return None
-        creds_json = row[0]
-        credentials = Credentials(**json.loads(creds_json))
-        return LoggedInClient(credentials, conn)
+        credentials = SharedCredentials.from_info(json.loads(rows[0][0]))
+        return LoggedInClient(credentials, database, breakers)
 
     def save_credentials(self) -> None:
-        creds_json = json.dumps(
-            {name: getattr(self.credentials, name) for name in
-             ['token', 'refresh_token', 'token_uri', 'client_id', 'client_secret', 'scopes']})
-        cursor = self.conn.cursor()
-        cursor.execute(
+        creds_json = json.dumps(credentials_info(self.credentials))
+        # Through Database, which takes turns with every other thread using its connection.
+        self.db.execute(
             "INSERT INTO credentials (name, value) VALUES ('google_credentials', %s) "
             "ON CONFLICT (name) DO UPDATE SET value = %s;", (creds_json, creds_json))
-        self.conn.commit()
+
+    def token_seconds_left(self) -> Optional[float]:
+        # None if we don't know when the token expires, e.g. if it hasn't been used yet.
+        expiry = self.credentials.expiry
+        if expiry is None:
+            return None
+        # google-auth keeps the expiry as a naive UTC datetime.
+        return (expiry - datetime.datetime.utcnow()).total_seconds()
+
+    def refresh_if_expiring(self) -> Optional[float]:
+        # Refreshes the token if it's close to expiring, and returns its remaining lifetime.
+        with self.credentials.refresh_lock:
+            seconds_left = self.token_seconds_left()
+            if seconds_left is None or seconds_left < TOKEN_REFRESH_MARGIN_SECONDS:
+                log.info('Refreshing the Google access token.')
+                with pooled_http() as connection:
+                    self.credentials.refresh(Request(connection))
+                self.save_credentials()
+                seconds_left = self.token_seconds_left()
+            return seconds_left
 
     def log_and_send(self, desc: str, request: http.HttpRequest) -> Response:
         log.info(desc)
         log.debug(pprint.pformat(request))
-        response = request.execute()
+        token = self.credentials.token
+        circuit = self.breakers[backend(request)]
+        circuit.check()
+        start = time.monotonic()
+        ok = False
+        try:
+            with timeline.span(desc), pooled_http() as connection:
+                response = request.execute(http=self.authorized_http(connection))
+            ok = True
+        except errors.HttpError as e:
+            # A 4xx is our mistake, not a sign the backend is struggling -- except a 429, which
+            # means it wants us to back off.
+            ok = e.resp.status < 500 and e.resp.status != 429
+            raise
+        finally:
+            circuit.record(time.monotonic() - start, ok)
         log.debug(pprint.pformat(response))
-        self.save_credentials()  # They may have been refreshed in the process.
+        log.debug('HTTP cache: %s', HTTP_CACHE.stats())
+        if self.credentials.token != token:
+            # It was refreshed in the process, which the background refresh usually prevents.
+            self.save_credentials()
         return response
 
     @property
-    def flow(self) -> Flow:
+    def flow(self) -> 'Flow':
         raise TypeError('Already logged in.')
 
 
+def backend(request: Union[http.HttpRequest, http.BatchHttpRequest]) -> str:
+    # Which circuit breaker a request counts against.
+    uri = getattr(request, 'uri', None) or getattr(request, '_batch_uri', '')
+    return 'sheets' if urllib.parse.urlparse(uri).hostname == 'sheets.googleapis.com' else 'drive'
+
+
+@contextlib.contextmanager
+def pooled_http() -> Iterator[httplib2.Http]:
+    with _http_pool_lock:
+        connection = _http_pool.pop() if _http_pool else None
+    if connection is None:
+        # This is roughly googleapiclient.http.build_http(), but with a cache.
+        connection = httplib2.Http(cache=HTTP_CACHE, timeout=DEFAULT_HTTP_TIMEOUT_SEC)
+        connection.redirect_codes -= {308}
+    try:
+        yield connection
+    finally:
+        with _http_pool_lock:
+            if len(_http_pool) < HTTP_POOL_SIZE:
+                _http_pool.append(connection)
+
+
+def build_service(api: str, version: str, auth_http: AuthorizedHttp):
+    from googleapiclient import discovery
+    with open(os.path.join(DISCOVERY_DIR, f'{api}.{version}.json')) as f:
+        return discovery.build_from_document(f.read(), http=auth_http)
+
+
 Row = Tuple[str, str, str, str, str, str, str]
 
 
+@dataclass(frozen=True)
+class Tab:
+    # A tab of the tracker with puzzles on it. Normally there's just one, the Puzzle List, number 0.
+    # When the tracker is sharded, each round gets a tab of its own instead, and the Puzzle List's
+    # rows (below its headers) are an index of them: round name, a link to the tab, and the tab's
+    # sheet ID. They're numbered from 1 in the order they're listed there, and a row index on tab
+    # n is offset by n * db.ROWS_PER_TAB, so a single int still says where a puzzle is.
+    number: int
+    sheet_id: int
+    title: str
+    # How many rows come before the first puzzle.
+    header_rows: int
+    round_name: str = ''
+    color: Optional[util.Color] = None
+
+    def a1(self, cells: str) -> str:
+        title = self.title.replace("'", "''")
+        return f"'{title}'!{cells}"
+
+    def row_index(self, tab_row_index: int) -> int:
+        return self.number * db.ROWS_PER_TAB + tab_row_index
+
+
+@dataclass
+class RoundRows:
+    # Where a round's rows are on the Puzzle List, and its color.
+    color: Optional[util.Color]
+    first_row: int
+    last_row: int
+
+
+class RoundRegistry:
+    # Every round on the Puzzle List, so that a new row can be placed without downloading the whole
+    # Round column each time. It's loaded from the column once, then kept up to date as we insert
+    # rows. Before each insert, Google checks just the two cells the placement depends on, and
+    # reloads it if they've changed.
+
+    def __init__(self, rounds: Dict[str, RoundRows], new_round_row: int):
+        # By canonical round name. (The header rows and any blank rows are in here too, keyed by
+        # whatever their Round cell says, which keeps the preset colors in the same order as
+        # always.)
+        self.rounds = rounds
+        # Where a new round goes.
+        self.new_round_row = new_round_row
+
+    @classmethod
+    def from_rows(cls, rows: List[Response]) -> 'RoundRegistry':
+        # Takes the rowData of the Round column.
+        round_names = [(row['values'][0].get('formattedValue', '') if 'values' in row else '')
+                       for row in rows]
+        rounds: Dict[str, RoundRows] = {}
+        for row_index, round_name in enumerate(round_names):
+            round_key = util.canonicalize(round_name)
+            if round_key in rounds:
+                rounds[round_key].last_row = row_index
+            else:
+                rounds[round_key] = RoundRows(None, row_index, row_index)
+        for place in rounds.values():
+            # A round's color is the one on its last row.
+            row = rows[place.last_row]
+            color = row['values'][0].get('effectiveFormat', {}).get(
+                'backgroundColor') if 'values' in row else None
+            place.color = util.Color.from_dict(color) if color else None
+        # A new round goes at the bottom of the table. That is, before the first blank cell not in
+        # the header.
+        try:
+            new_round_row = round_names.index('', 2)
+        except ValueError:
+            # There are no blank round cells after the header? Insert it right above the Event
+            # puzzles.
+            try:
+                new_round_row = round_names.index('Event')
+            except ValueError:
+                # No blank round cells *and* no Event puzzles? Okay... just add it at the end.
+                new_round_row = len(round_names)
+        return cls(rounds, new_round_row)
+
+    def check_row(self, round_key: str) -> int:
+        # The first of two rows whose Round cells show whether the registry still has this round in
+        # the right place: its last row and the next, or for a new round, the rows on either side of
+        # where it'll go.
+        if round_key in self.rounds:
+            return self.rounds[round_key].last_row
+        return self.new_round_row - 1
+
+    def matches(self, round_key: str, first: str, second: str) -> bool:
+        first, second = util.canonicalize(first), util.canonicalize(second)
+        if round_key in self.rounds:
+            return first == round_key and second != round_key
+        return first != '' and second in {'', 'event'}
+
+    def insert(self, round_key: str, row_index: int, color: util.Color) -> None:
+        # Records a row inserted at row_index, which moves down everything from there on.
+        for place in self.rounds.values():
+            if place.first_row >= row_index:
+                place.first_row += 1
+            if place.last_row >= row_index:
+                place.last_row += 1
+        if self.new_round_row >= row_index:
+            self.new_round_row += 1
+        if round_key in self.rounds:
+            self.rounds[round_key].last_row = max(self.rounds[round_key].last_row, row_index)
+        else:
+            self.rounds[round_key] = RoundRows(color, row_index, row_index)
+
+
+class Puzzle:
+    # One row of the tracker, parsed once, with what the queries below need worked out up front:
+    # the channel name from the link and whether it's solved, plus the canonical name the first
+    # time it's asked for (not every query needs it, and it's the most expensive part). A read
+    # makes one of these per row, thousands on a big tracker, so it has slots instead of a
+    # __dict__.
+    __slots__ = ('row_index', 'width', 'round_name', 'name', '_key', 'doc_url', 'channel',
+                 'status', 'answer', 'solved')
+
+    def __init__(self, row_index: int, cells: List[str]) -> None:
+        # The cells start from the Round column. The API leaves off trailing blank cells, and the
+        # read may not have asked for every column; either way, anything missing is blank.
+        count = len(cells)
+        self.row_index = row_index
+        # How many cells there were, up to the last one that isn't blank.
+        self.width = count
+        self.round_name = cells[0] if count > 0 else ''
+        self.name = cells[1] if count > 1 else ''
+        self._key: Optional[str] = None
+        self.doc_url = cells[4] if count > 4 else ''
+        link = cells[5] if count > 5 else ''
+        self.channel = link_to_channel(link) if link else None
+        self.status = cells[6] if count > 6 else ''
+        self.answer = cells[7] if count > 7 else ''
+        self.solved = self.status in SOLVED_STATUSES
+
+    @property
+    def key(self) -> str:
+        if self._key is None:
+            self._key = util.canonicalize(self.name)
+        return self._key
+
+    def lookup(self) -> Lookup:
+        return self.row_index, self.doc_url, self.channel
+
+
 class Google:
-    def __init__(self):
-        self.client: Union[LoggedInClient, LoggedOutClient] = LoggedOutClient()
-        self.conn = psycopg2.connect(os.environ['DATABASE_URL'], sslmode='require')
+    def __init__(self, tenant: tenants.Tenant, database: db.Database):
+        self.tenant_id = tenant.id
+        self.db = database
+        self._client: Union[LoggedInClient, LoggedOutClient] = LoggedOutClient()
+        config = tenant.config
 
         # Here and throughout, a "spreadsheet" is the entire sharable unit, and a "sheet" is the
         # page (tabs at the bottom). This is kind of unfortunate but matches the names used in
         # Google Sheets and its API.
-        if os.environ.get('PLACEBO_TESTING') == '1':
-            self.puzzle_list_spreadsheet_id = os.environ[
+        if config.get('PLACEBO_TESTING') == '1':
+            self.puzzle_list_spreadsheet_id = config[
                 'PLACEBO_PUZZLE_LIST_SPREADSHEET_ID_TESTING']
-            self.puzzle_list_sheet_id = os.environ['PLACEBO_PUZZLE_LIST_SHEET_ID_TESTING']
-            self.puzzles_folder_id = os.environ['PLACEBO_PUZZLES_FOLDER_ID_TESTING']
-            self.solved_folder_id = os.environ['PLACEBO_SOLVED_FOLDER_ID_TESTING']
+            self.puzzle_list_sheet_id = config['PLACEBO_PUZZLE_LIST_SHEET_ID_TESTING']
+            self.puzzles_folder_id = config['PLACEBO_PUZZLES_FOLDER_ID_TESTING']
+            self.solved_folder_id = config['PLACEBO_SOLVED_FOLDER_ID_TESTING']
         else:
-            self.puzzle_list_spreadsheet_id = os.environ['PLACEBO_PUZZLE_LIST_SPREADSHEET_ID']
-            self.puzzle_list_sheet_id = os.environ['PLACEBO_PUZZLE_LIST_SHEET_ID']
-            self.puzzles_folder_id = os.environ['PLACEBO_PUZZLES_FOLDER_ID']
-            self.solved_folder_id = os.environ['PLACEBO_SOLVED_FOLDER_ID']
-        self.puzzle_template_id = os.environ['PLACEBO_PUZZLE_TEMPLATE_ID']
+            self.puzzle_list_spreadsheet_id = config['PLACEBO_PUZZLE_LIST_SPREADSHEET_ID']
+            self.puzzle_list_sheet_id = config['PLACEBO_PUZZLE_LIST_SHEET_ID']
+            self.puzzles_folder_id = config['PLACEBO_PUZZLES_FOLDER_ID']
+            self.solved_folder_id = config['PLACEBO_SOLVED_FOLDER_ID']
+        self.puzzle_template_id = config['PLACEBO_PUZZLE_TEMPLATE_ID']
+        # Whether each round's puzzles go on a tab of their own. See Tab.
+        self.sharded = config.get('PLACEBO_SHARD_TRACKER') == '1'
+        self._rounds: Optional[RoundRegistry] = None
+        # When sharded, the tabs listed on the index and how many rows it has, kept like the
+        # registry: checked against the index as part of each read of the tracker, and reloaded if
+        # they don't match.
+        self._index: Optional[Tuple[List[Tab], int]] = None
+        # Where Drive sends notifications of changes to the tracker, if it's watched. (See
+        # Placebo._watch_tracker.)
+        self.watch_url = config.get('PLACEBO_DRIVE_WATCH_URL')
+        # (db.tracker_version, every row) from the last read while the tracker was being watched.
+        self._tracker_cache: Optional[Tuple[int, List[Puzzle]]] = None
+        slow_seconds = float(config.get('PLACEBO_GOOGLE_SLOW_SECONDS', GOOGLE_SLOW_SECONDS))
+        self.breakers = {name: breaker.CircuitBreaker(name, slow_seconds)
+                         for name in ('sheets', 'drive')}
+
+    @property
+    def client(self) -> Union[LoggedInClient, LoggedOutClient]:
+        if isinstance(self._client, LoggedOutClient):
+            # Another worker may have finished the OAuth flow since we checked.
+            self._client = (LoggedInClient.from_loading_credentials(self.db, self.breakers)
+                            or self._client)
+        return self._client
 
     @property
     def sheets(self):
         return self.client.sheets
 
+    @property
+    def logged_in(self) -> bool:
+        return isinstance(self.client, LoggedInClient)
+
+    def token_seconds_left(self) -> Optional[float]:
+        client = self.client
+        return client.token_seconds_left() if isinstance(client, LoggedInClient) else None
+
+    def refresh_token_if_expiring(self) -> Optional[float]:
+        client = self.client
+        return client.refresh_if_expiring() if isinstance(client, LoggedInClient) else None
+
+    def unavailable(self) -> Optional[breaker.Unavailable]:
+        # If Sheets or Drive has tripped its circuit breaker, the error a request to it would raise
+        # (for whichever will be back later, if both are out).
+        waits = [(circuit.retry_after(), circuit.name) for circuit in self.breakers.values()
+                 if not circuit.available()]
+        if not waits:
+            return None
+        retry_after, name = max(waits)
+        return breaker.Unavailable(name, retry_after)
+
+    def cached_round_color(self, round_name: str) -> Optional[util.Color]:
+        # The round's color as of the last time we read or added a row, without asking Sheets.
+        place = self._rounds.rounds.get(util.canonicalize(round_name)) if self._rounds else None
+        return place.color if place else None
+
     @property
     def files(self):
         return self.client.files
 
     def start_oauth_if_necessary(self) -> Optional[str]:
-        maybe_client = LoggedInClient.from_loading_credentials(self.conn)
-        if maybe_client:
-            self.client = maybe_client
+        if isinstance(self.client, LoggedInClient):
             log.info('Google OAuth creds already present.')
             return None
         log.info('Starting the Google OAuth flow...')
+        # The callback could go to any worker, so the state is saved where they can all check it.
+        # It starts with the tenant, so the callback can be routed to the right one.
+        state = f'{self.tenant_id}:{secrets.token_urlsafe(16)}'
         authorization_url, _ = self.client.flow.authorization_url(
-            access_type='offline', include_granted_scopes='true', login_hint=USER)
+            state=state, access_type='offline', include_granted_scopes='true', login_hint=USER)
+        self.db.execute(
+            "INSERT INTO credentials (name, value) VALUES ('google_oauth_state', %s) "
+            "ON CONFLICT (name) DO UPDATE SET value = %s;", (state, state))
         return authorization_url
 
     def finish_oauth(self, callback_url: str) -> None:
-        self.client.flow.fetch_token(authorization_response=callback_url)
-        self.client = LoggedInClient(self.client.flow.credentials, self.conn)
-        self.client.save_credentials()
+        [state] = urllib.parse.parse_qs(urllib.parse.urlparse(callback_url).query)['state']
+        rows = self.db.execute("SELECT value FROM credentials WHERE name = 'google_oauth_state';")
+        if not rows or rows[0][0] != state:
+            raise ValueError('Unexpected OAuth state; try the latest link.')
+        flow = LoggedOutClient(state=state).flow
+        flow.fetch_token(authorization_response=callback_url)
+        credentials = SharedCredentials.from_info(credentials_info(flow.credentials))
+        self._client = LoggedInClient(credentials, self.db, self.breakers)
+        self._client.save_credentials()
 
     def create_puzzle_spreadsheet(self, puzzle_name: str) -> str:
         request = self.client.files.copy(fileId=self.puzzle_template_id, body={
@@ -184,61 +562,177 @@ class Google:
         return url
 
     def add_row(self, round_name: str, puzzle_name: str, priority: str, puzzle_url: str,
-                channel: str, round_color: Optional[util.Color]) -> util.Color:
+                channel: str, round_color: Optional[util.Color]) -> Tuple[int, util.Color]:
         assert priority in {'-', 'L', 'M', 'H'}
         assert not channel.startswith('#')
         slack_link = channel_to_link(channel)
         cell_values = (round_name, puzzle_name, priority, puzzle_url, '🤖 One sec...', slack_link,
                        'Not started')
-        round_color = self._add_row(cell_values, round_color)
-        return round_color
+        return self._add_row(cell_values, round_color)
 
-    def add_empty_row(self, round_name: str, round_color: Optional[util.Color]) -> util.Color:
+    def add_empty_row(self, round_name: str,
+                      round_color: Optional[util.Color]) -> Tuple[int, util.Color]:
         cell_values = (round_name, '', '', '', '', '', '')
-        round_color = self._add_row(cell_values, round_color)
-        return round_color
+        return self._add_row(cell_values, round_color)
 
-    def _add_row(self, cell_values: Row, round_color: util.Color) -> util.Color:
-        # Find the last row that matches this round; we'll insert below it.
-        request = self.sheets.get(spreadsheetId=self.puzzle_list_spreadsheet_id,
-                                  ranges='Puzzle List!A:A', includeGridData=True)
-        response = self.client.log_and_send('Looking up the Round column', request)
-        rows = response['sheets'][0]['data'][0]['rowData']
-        round_names = [(row['values'][0].get('formattedValue', '') if 'values' in row else '')
-                       for row in rows]
-        canon_rounds = [util.canonicalize(r) for r in round_names]
+    def _add_row(self, cell_values: Row, round_color: util.Color) -> Tuple[int, util.Color]:
+        # Returns the index of the new row, and the round's color.
+        if self.sharded:
+            return self._add_sharded_row(cell_values, round_color)
         round_name = cell_values[0]
-        if util.canonicalize(round_name) in canon_rounds:
-            row_index = last_index(canon_rounds, util.canonicalize(round_name)) + 1
+        round_key = util.canonicalize(round_name)
+        rounds = self._round_registry(round_key)
+        if round_key in rounds.rounds:
+            # Insert below the last row of this round.
+            place = rounds.rounds[round_key]
+            row_index = place.last_row + 1
             if not round_color:
                 # No color ought to be given for a round we've already seen... but if one *is*
                 # given, we won't overwrite it.
-                cell = rows[row_index - 1]['values'][0]
-                round_color = util.Color.from_dict(cell['effectiveFormat']['backgroundColor'])
+                round_color = place.color or PLAIN_BACKGROUND
             new_round = False
         else:
-            # If we've never seen this round before, insert at the bottom of the table. That is,
-            # before the first blank cell not in the header.
-            try:
-                row_index = round_names.index('', 2)
-            except ValueError:
-                # There are no blank round cells after the header? Insert it right above the Event
-                # puzzles.
-                try:
-                    row_index = round_names.index('Event')
-                except ValueError:
-                    # No blank round cells *and* no Event puzzles? Okay... just add it at the end.
-                    row_index = len(round_names)
+            row_index = rounds.new_round_row
             # If it's a new round, and no color was given, pick a preset color for the unlock.
             if not round_color:
-                round_color = ROUND_COLORS[len(set(canon_rounds)) % len(ROUND_COLORS)]
+                round_color = ROUND_COLORS[len(rounds.rounds) % len(ROUND_COLORS)]
             new_round = True
 
+        requests = self._insert_row_requests(self.puzzle_list_sheet_id, row_index, cell_values,
+                                             round_color, new_round)
+        self._update_tracker('Adding row to tracker', requests)
+        rounds.insert(round_key, row_index, round_color)
+
+        return row_index, round_color
+
+    def _round_registry(self, round_key: str) -> 'RoundRegistry':
+        # The registry, after checking the two cells it would place this round by. If they don't
+        # match (someone edited the tracker by hand, or another process added a row), or there's no
+        # registry yet, it's loaded from the sheet.
+        if self._rounds is not None:
+            row_index = self._rounds.check_row(round_key)
+            request = self.sheets.values().get(
+                spreadsheetId=self.puzzle_list_spreadsheet_id,
+                range=f'{PUZZLE_LIST}!A{row_index + 1}:A{row_index + 2}', majorDimension='COLUMNS')
+            response = self.client.log_and_send('Checking the Round column', request)
+            cells = (response['values'][0] if response.get('values') else []) + ['', '']
+            if self._rounds.matches(round_key, cells[0], cells[1]):
+                return self._rounds
+            log.info('Round registry is out of date; reloading it.')
+        request = self.sheets.get(spreadsheetId=self.puzzle_list_spreadsheet_id,
+                                  ranges=f'{PUZZLE_LIST}!A:A', includeGridData=True)
+        response = self.client.log_and_send('Looking up the Round column', request)
+        self._rounds = RoundRegistry.from_rows(response['sheets'][0]['data'][0]['rowData'])
+        return self._rounds
+
+    def _add_sharded_row(self, cell_values: Row,
+                         round_color: Optional[util.Color]) -> Tuple[int, util.Color]:
+        # Adds the row below the last one on its round's tab, or starts a new tab (and lists it on
+        # the index) for a new round. Either way, nothing on any other tab moves.
+        round_name = cell_values[0]
+        tab = self._round_tab(round_name, self._cached_index()[0])
+        if not tab:
+            # Before starting a new tab, make sure nobody else already has.
+            tab = self._round_tab(round_name, self._read_index()[0])
+        tabs, index_rows = self._cached_index()
+        if tab:
+            request = self.sheets.values().get(spreadsheetId=self.puzzle_list_spreadsheet_id,
+                                               range=tab.a1('A:A'), majorDimension='COLUMNS')
+            response = self.client.log_and_send('Looking up the Round column', request)
+            column = response['values'][0] if response.get('values') else []
+            canon_rounds = [util.canonicalize(cell) for cell in column]
+            if util.canonicalize(round_name) in canon_rounds:
+                tab_row_index = last_index(canon_rounds, util.canonicalize(round_name)) + 1
+            else:
+                # The tab's rows must have been cleared by hand. Start again below the header.
+                tab_row_index = tab.header_rows
+            if not round_color:
+                round_color = tab.color or PLAIN_BACKGROUND
+            requests = self._insert_row_requests(tab.sheet_id, tab_row_index, cell_values,
+                                                 round_color, new_round=False)
+        else:
+            if not round_color:
+                round_color = ROUND_COLORS[len(tabs) % len(ROUND_COLORS)]
+            # Sheet IDs only have to be unique within the spreadsheet, and we pick our own so the
+            # rest of the batch can refer to the new tab.
+            sheet_id = secrets.randbelow(2**31 - 1) + 1
+            tab = Tab(index_rows + 1, sheet_id, self._new_tab_title(round_name), 1, round_name,
+                      round_color)
+            tab_row_index = tab.header_rows
+            requests = [{
+                'addSheet': {
+                    'properties': {
+                        'sheetId': sheet_id,
+                        'title': tab.title,
+                        'gridProperties': {'frozenRowCount': tab.header_rows},
+                    },
+                },
+            }, {
+                'updateCells': {
+                    'rows': [row_data(SHARD_HEADER)],
+                    'fields': 'userEnteredValue',
+                    'start': {'sheetId': sheet_id, 'rowIndex': 0, 'columnIndex': 0},
+                },
+            }]
+            requests.extend(self._insert_row_requests(sheet_id, tab_row_index, cell_values,
+                                                      round_color, new_round=True))
+            # The index row goes right below the last one, so its place there is the tab's number.
+            title = tab.title.replace('"', '""')
+            index_row = row_data([round_name, f'=HYPERLINK("#gid={sheet_id}","{title}")',
+                                  str(sheet_id)])
+            index_row['values'][0]['userEnteredFormat'] = {
+                'backgroundColor': round_color.to_dict()}
+            requests.append({
+                'updateCells': {
+                    'rows': [index_row],
+                    'fields': 'userEnteredValue,userEnteredFormat.backgroundColor',
+                    'start': {
+                        'sheetId': self.puzzle_list_sheet_id,
+                        'rowIndex': 2 + index_rows,
+                        'columnIndex': 0,
+                    },
+                },
+            })
+
+        try:
+            self._update_tracker('Adding row to tracker', requests)
+        except Exception:
+            # If we were adding a tab, it may or may not be there now.
+            self._index = None
+            raise
+        if tab.number > index_rows:
+            self._index = (tabs + [tab], index_rows + 1)
+
+        return tab.row_index(tab_row_index), round_color
+
+    @staticmethod
+    def _round_tab(round_name: str, tabs: List[Tab]) -> Optional[Tab]:
+        round_key = util.canonicalize(round_name)
+        return next((tab for tab in tabs if util.canonicalize(tab.round_name) == round_key), None)
+
+    def _new_tab_title(self, round_name: str) -> str:
+        # The round's name, unless that's taken by another tab (the Puzzle List, say, or one someone
+        # made by hand), in which case it gets a number after it. Sheets won't add a tab with the
+        # same title as another, ignoring case.
+        request = self.sheets.get(spreadsheetId=self.puzzle_list_spreadsheet_id,
+                                  fields='sheets.properties.title')
+        response = self.client.log_and_send('Listing the tracker tabs', request)
+        taken = {sheet['properties']['title'].casefold() for sheet in response.get('sheets', [])}
+        title = round_name[:100]
+        n = 2
+        while title.casefold() in taken:
+            suffix = f' ({n})'
+            title = round_name[:100 - len(suffix)] + suffix
+            n += 1
+        return title
+
+    def _insert_row_requests(self, sheet_id: int, row_index: int, cell_values: Row,
+                             round_color: util.Color, new_round: bool) -> List[Dict[str, Any]]:
         # First insert a new row at that location...
         requests = [{
             'insertDimension': {
                 'range': {
-                    'sheetId': self.puzzle_list_sheet_id,
+                    'sheetId': sheet_id,
                     'dimension': 'ROWS',
                     'startIndex': row_index,
                     'endIndex': row_index + 1,
@@ -252,7 +746,7 @@ class Google:
                 'rows': [row_data(cell_values)],
                 'fields': 'userEnteredValue',
                 'start': {
-                    'sheetId': self.puzzle_list_sheet_id,
+                    'sheetId': sheet_id,
                     'rowIndex': row_index,
                     'columnIndex': 0,
                 },
@@ -265,7 +759,7 @@ class Google:
                 {
                     'updateBorders': {
                         'range': {
-                            'sheetId': self.puzzle_list_sheet_id,
+                            'sheetId': sheet_id,
                             'startRowIndex': row_index,
                             'endRowIndex': row_index + 1,
                         },
@@ -285,7 +779,7 @@ class Google:
                         }],
                         'fields': 'userEnteredFormat.backgroundColor',
                         'range': {
-                            'sheetId': self.puzzle_list_sheet_id,
+                            'sheetId': sheet_id,
                             'startRowIndex': row_index,
                             'endRowIndex': row_index + 1,
                             'startColumnIndex': 0,
@@ -301,7 +795,7 @@ class Google:
                 {
                     'updateBorders': {
                         'range': {
-                            'sheetId': self.puzzle_list_sheet_id,
+                            'sheetId': sheet_id,
                             'startRowIndex': row_index,
                             'endRowIndex': row_index + 1,
                         },
@@ -318,7 +812,7 @@ class Google:
                         }],
                         'fields': 'userEnteredFormat.backgroundColor',
                         'range': {
-                            'sheetId': self.puzzle_list_sheet_id,
+                            'sheetId': sheet_id,
                             'startRowIndex': row_index,
                             'endRowIndex': row_index + 1,
                             'startColumnIndex': 1,
@@ -328,68 +822,80 @@ class Google:
                 }
             ])
 
-        batch_request = self.sheets.batchUpdate(spreadsheetId=self.puzzle_list_spreadsheet_id,
-                                                body={'requests': requests})
-        self.client.log_and_send('Adding row to tracker', batch_request)
-
-        return round_color
+        return requests
 
     def set_doc_url(self, puzzle_name: str, doc_url: str) -> None:
-        lookup = self.lookup(puzzle_name)
+        lookup = self.lookup(puzzle_name, fresh=True)
         if lookup is None:
             raise KeyError(f'Puzzle "{puzzle_name}" not found.')
         row_index, doc_url_was, _ = lookup
         if 'http' in doc_url_was:
             raise UrlConflictError(found_url=doc_url_was, discarded_url=doc_url)
 
+        tab, tab_row_index = self._tab(row_index)
         requests = [{
             'updateCells': {
                 'rows': [row_data([doc_url])],
                 'fields': 'userEnteredValue',
                 'start': {
-                    'sheetId': self.puzzle_list_sheet_id,
-                    'rowIndex': row_index,
+                    'sheetId': tab.sheet_id,
+                    'rowIndex': tab_row_index,
                     'columnIndex': 4
                 }
             }
         }]
-        batch_request = self.sheets.batchUpdate(
-            spreadsheetId=self.puzzle_list_spreadsheet_id,
-            body={'requests': requests})
-        self.client.log_and_send('Updating tracker row', batch_request)
+        self._update_tracker('Updating tracker row', requests)
 
     def exists(self, puzzle_name: str) -> bool:
-        request = self.sheets.values().get(spreadsheetId=self.puzzle_list_spreadsheet_id,
-                                           range='Puzzle List!B:B', majorDimension='COLUMNS')
-        response = self.client.log_and_send('Checking tracking sheet for puzzle', request)
-        puzzle_name = util.canonicalize(puzzle_name)
-        column = response['values'][0]
-        for cell in column:
-            if puzzle_name in util.canonicalize(cell):
-                return True
-        return False
+        key = util.canonicalize(puzzle_name)
+        return any(key in puzzle.key
+                   for puzzle in self._read_puzzles('Checking tracking sheet for puzzle', 'B'))
 
-    def lookup(self, puzzle_name: str) -> Optional[Tuple[int, str, Optional[str]]]:
+    def row_matches(self, row_index: int, puzzle_name: str) -> bool:
+        # A cheap check that a row index we found earlier still points at the same puzzle, in case
+        # rows have been inserted or moved since.
+        try:
+            tab, tab_row_index = self._tab(row_index)
+        except KeyError:
+            return False
         request = self.sheets.values().get(spreadsheetId=self.puzzle_list_spreadsheet_id,
-                                           range='Puzzle List!A:G')
-        response = self.client.log_and_send('Fetching tracking sheet', request)
-        puzzle_name = util.canonicalize(puzzle_name)
-        matching_rows = []
-        for row_index, row in enumerate(response['values']):
-            if len(row) > 5 and puzzle_name in util.canonicalize(row[1]):
-                matching_rows.append((row_index, row[4], link_to_channel(row[5])))
-        if not matching_rows:
-            return None
-        elif len(matching_rows) == 1:
-            return matching_rows[0]
-        else:
-            raise KeyError(f'{len(matching_rows)} rows matching {puzzle_name}')
+                                           range=tab.a1(f'B{tab_row_index + 1}'))
+        response = self.client.log_and_send('Checking tracker row', request)
+        values = response.get('values', [])
+        cell = values[0][0] if values and values[0] else ''
+        return util.canonicalize(puzzle_name) in util.canonicalize(cell)
+
+    def lookup(self, puzzle_name: str, fresh: bool = False) -> Optional[Lookup]:
+        return self.lookup_all([puzzle_name], fresh)[puzzle_name]
+
+    def lookup_all(self, puzzle_names: Iterable[str],
+                   fresh: bool = False) -> Dict[str, Optional[Lookup]]:
+        # Looks up several puzzles with a single read of the tracker. If the rows found are about
+        # to be written to, pass fresh to read the tracker itself rather than what's cached, which
+        # can be behind on edits made by hand until Drive tells us about them.
+        read = self._fetch_puzzles if fresh else self._read_puzzles
+        # Only rows that reach the Channel column count, which leaves out rows like Hunt and notes
+        # added by hand.
+        puzzles = [puzzle for puzzle in read('Fetching tracking sheet', 'G') if puzzle.width > 5]
+        result = {}
+        for puzzle_name in puzzle_names:
+            key = util.canonicalize(puzzle_name)
+            matching = [puzzle.lookup() for puzzle in puzzles if key in puzzle.key]
+            if len(matching) > 1:
+                raise KeyError(f'{len(matching)} rows matching {key}')
+            result[puzzle_name] = matching[0] if matching else None
+        return result
 
     def all_rounds(self) -> List[str]:
-        request = self.sheets.values().get(spreadsheetId=self.puzzle_list_spreadsheet_id,
-                                           range='Puzzle List!A3:A', majorDimension='COLUMNS')
-        response = self.client.log_and_send('Fetching round names', request)
-        column = response['values'][0]
+        if self.sharded:
+            # The index has them all, without reading any round's tab.
+            column = [tab.round_name for tab in self._read_index()[0]]
+        else:
+            request = self.sheets.values().get(spreadsheetId=self.puzzle_list_spreadsheet_id,
+                                               range=f'{PUZZLE_LIST}!A3:A',
+                                               majorDimension='COLUMNS')
+            response = self.client.log_and_send('Fetching round names', request)
+            column = response['values'][0]
         result = []
         suppress = {'', 'Hunt', 'Meta'}
         for cell in column:
@@ -397,58 +903,114 @@ class Google:
                 result.append(cell)
         return result
 
+    def all_rows(self) -> List[Tuple[int, str, str, str, Optional[str], str, str]]:
+        # (row index, round, puzzle name, doc URL, channel name, status, answer) for every row
+        # after the headers, in order.
+        return [(puzzle.row_index, puzzle.round_name, puzzle.name, puzzle.doc_url, puzzle.channel,
+                 puzzle.status, puzzle.answer)
+                for puzzle in self._read_puzzles('Fetching the whole tracker', 'H')]
+
     def unsolved_puzzles_by_round(
             self, channel_name: str) -> Tuple[Dict[str, List[str]], Optional[str]]:
-        request = self.sheets.values().get(spreadsheetId=self.puzzle_list_spreadsheet_id,
-                                           range='Puzzle List!A3:G')
-        response = self.client.log_and_send('Fetching puzzle names', request)
         result: Dict[str, List[str]] = {}
         default_puzzle: Optional[str] = None
-        for row in response['values']:
-            if len(row) < 7:
-                continue
-            round, name, _, _, _, channel_link, status = row
-            if status not in {'Solved', 'Backsolved'} and name:
-                result.setdefault(round, []).append(name)
-            if channel_name and link_to_channel(channel_link) == channel_name:
-                default_puzzle = name
+        for puzzle in self._read_puzzles('Fetching puzzle names', 'G'):
+            if puzzle.name and puzzle.status and not puzzle.solved:
+                result.setdefault(puzzle.round_name, []).append(puzzle.name)
+            if channel_name and puzzle.channel == channel_name:
+                default_puzzle = puzzle.name
         return result, default_puzzle
 
-    def mark_doc_solved(self, doc_url: str) -> None:
-        # Find the file ID from its URL.
-        match = FILE_ID_PATTERN.search(doc_url)
-        if not match:
-            raise ValueError(f"Can't find a file ID in {doc_url}")
-        file_id = match.group(1)
-
-        # Get the current title.
+    def doc_name(self, file_id: str) -> str:
         request = self.files.get(fileId=file_id)
         response = self.client.log_and_send('Getting puzzle doc title', request)
-        name = response['name']
+        return response['name']
+
+    def solved_channels(self) -> List[str]:
+        # The names of the Slack channels for every solved puzzle.
+        return [puzzle.channel for puzzle in self._read_puzzles('Fetching solved puzzles', 'G')
+                if puzzle.solved and puzzle.channel]
+
+    def mark_doc_solved(self, doc_url: str, name: Optional[str] = None) -> None:
+        # If we already know the doc's current title (say, it was prefetched), pass it in and we'll
+        # skip looking it up.
+        file_id = doc_file_id(doc_url)
+        if name is None:
+            name = self.doc_name(file_id)
         if name.startswith('[SOLVED]'):
             # We must have done this already. No need to do it twice.
             return
 
-        # Update the title.
-        name = f'[SOLVED] {name}'
-        request = self.files.update(fileId=file_id, body={'name': name})
-        self.client.log_and_send('Updating puzzle doc title', request)
+        request = self._mark_doc_solved_request(file_id, name)
+        self.client.log_and_send('Updating puzzle doc title and folder', request)
+
+    def mark_docs_solved(self, doc_urls: Iterable[str]) -> Dict[str, BaseException]:
+        # Like mark_doc_solved for several docs, but with one Drive batch request for the titles
+        # and another for the updates. Returns the failures, by doc URL.
+        file_ids = {doc_file_id(doc_url): doc_url for doc_url in doc_urls}
+        names: Dict[str, str] = {}
+        failures: Dict[str, BaseException] = {}
+
+        def callback(results: Dict[str, Any]) -> Callable[[str, Any, Optional[Exception]], None]:
+            def on_response(file_id: str, response: Any, exception: Optional[Exception]) -> None:
+                if exception is None:
+                    results[file_id] = response
+                else:
+                    failures[file_ids[file_id]] = exception
+            return on_response
+
+        def send_batches(desc: str, requests: Dict[str, http.HttpRequest],
+                         results: Dict[str, Any]) -> None:
+            items = list(requests.items())
+            for start in range(0, len(items), DRIVE_BATCH_LIMIT):
+                batch = self.client.drive.new_batch_http_request(callback=callback(results))
+                for file_id, request in items[start:start + DRIVE_BATCH_LIMIT]:
+                    batch.add(request, request_id=file_id)
+                self.client.log_and_send(desc, batch)
+
+        send_batches('Getting puzzle doc titles',
+                     {file_id: self.files.get(fileId=file_id) for file_id in file_ids},
+                     names)
+        names = {file_id: response['name'] for file_id, response in names.items()
+                 if not response['name'].startswith('[SOLVED]')}
+        send_batches('Updating puzzle doc titles and folders',
+                     {file_id: self._mark_doc_solved_request(file_id, name)
+                      for file_id, name in names.items()}, {})
+        return failures
 
-        # Move it to the Solved folder. (Why do we mark it two ways? Changing the title gets the
-        # attention of solvers looking at the doc who may not realize the puzzle is solved. Moving
-        # to a separate folder keeps the Puzzles folder uncluttered, especially since all the
-        # "[SOLVED]" prefixes sort to the top.)
-        request = self.files.update(fileId=file_id, addParents=self.solved_folder_id,
-                                    removeParents=self.puzzles_folder_id)
-        self.client.log_and_send('Moving puzzle doc to Solved folder', request)
+    def _mark_doc_solved_request(self, file_id: str, name: str) -> http.HttpRequest:
+        # Update the title, and move it to the Solved folder, in one request. (Why do we mark it two
+        # ways? Changing the title gets the attention of solvers looking at the doc who may not
+        # realize the puzzle is solved. Moving to a separate folder keeps the Puzzles folder
+        # uncluttered, especially since all the "[SOLVED]" prefixes sort to the top.)
+        return self.files.update(fileId=file_id, body={'name': f'[SOLVED] {name}'},
+                                 addParents=self.solved_folder_id,
+                                 removeParents=self.puzzles_folder_id)
 
     def mark_row_solved(self, row_index: int, solution: str) -> None:
-        requests = [{
+        self.mark_rows_solved([(row_index, solution)])
+
+    def mark_rows_solved(self, solutions: Iterable[Tuple[int, str]]) -> None:
+        # Takes (row index, solution) pairs, and updates them all in one request.
+        solutions = list(solutions)
+        if not solutions:
+            # Sheets rejects a batchUpdate with no requests.
+            return
+        tabs = self._tabs()
+        requests = []
+        for row_index, solution in solutions:
+            tab, tab_row_index = self._tab(row_index, tabs)
+            requests.extend(self._mark_row_solved_requests(tab.sheet_id, tab_row_index, solution))
+        self._update_tracker('Updating tracker rows', requests)
+
+    def _mark_row_solved_requests(self, sheet_id: int, row_index: int,
+                                  solution: str) -> List[Dict[str, Any]]:
+        return [{
             'updateCells': {
                 'rows': [row_data(['-'])],
                 'fields': 'userEnteredValue',
                 'start': {
-                    'sheetId': self.puzzle_list_sheet_id,
+                    'sheetId': sheet_id,
                     'rowIndex': row_index,
                     'columnIndex': 2,  # priority
                 }
@@ -458,15 +1020,142 @@ class Google:
                 'rows': [row_data(['Solved', solution])],
                 'fields': 'userEnteredValue',
                 'start': {
-                    'sheetId': self.puzzle_list_sheet_id,
+                    'sheetId': sheet_id,
                     'rowIndex': row_index,
                     'columnIndex': 6,  # status, solution
                 }
             }
         }]
+
+    def _read_index(self) -> Tuple[List[Tab], int]:
+        # The rounds' tabs listed on a sharded tracker's index, and how many rows the index has.
+        request = self.sheets.get(spreadsheetId=self.puzzle_list_spreadsheet_id,
+                                  ranges=self._index_range(), includeGridData=True)
+        response = self.client.log_and_send('Reading the tracker index', request)
+        rows = response['sheets'][0]['data'][0].get('rowData', [])
+        tabs = []
+        for i, row in enumerate(rows):
+            cells = row.get('values', [])
+            values = [cell.get('formattedValue', '') for cell in cells]
+            if len(values) < 3 or not values[0] or not values[2].isdigit():
+                continue
+            round_name, title, sheet_id = values[:3]
+            color = cells[0].get('effectiveFormat', {}).get('backgroundColor')
+            tabs.append(Tab(i + 1, int(sheet_id), title, 1, round_name,
+                            util.Color.from_dict(color) if color else None))
+        self._index = (tabs, len(rows))
+        return self._index
+
+    def _cached_index(self) -> Tuple[List[Tab], int]:
+        if self._index is None:
+            return self._read_index()
+        return self._index
+
+    def _index_range(self) -> str:
+        main = self._main_tab()
+        return main.a1(f'A{main.header_rows + 1}:C')
+
+    def _index_matches(self, rows: List[List[str]]) -> bool:
+        # Whether the cached index lists the same tabs as these values of the index range.
+        tabs, _ = self._cached_index()
+        listed = [(i + 1, int(values[2]), values[1], values[0]) for i, values in enumerate(rows)
+                  if len(values) >= 3 and values[0] and values[2].isdigit()]
+        return listed == [(tab.number, tab.sheet_id, tab.title, tab.round_name) for tab in tabs]
+
+    def _main_tab(self) -> Tab:
+        return Tab(0, self.puzzle_list_sheet_id, PUZZLE_LIST, 2)
+
+    def _tabs(self) -> List[Tab]:
+        # The tabs with puzzles on them.
+        if self.sharded:
+            return self._cached_index()[0]
+        return [self._main_tab()]
+
+    def _tab(self, row_index: int, tabs: Optional[List[Tab]] = None) -> Tuple[Tab, int]:
+        # The tab a row index points into, and the row's index on that tab.
+        number, tab_row_index = divmod(row_index, db.ROWS_PER_TAB)
+        for tab in tabs if tabs is not None else self._tabs():
+            if tab.number == number:
+                return tab, tab_row_index
+        if tabs is None and self.sharded:
+            # Maybe the tab is newer than the cached index.
+            for tab in self._read_index()[0]:
+                if tab.number == number:
+                    return tab, tab_row_index
+        raise KeyError(f'No tab number {number} on the tracker')
+
+    def _read_puzzles(self, desc: str, last_column: str) -> List[Puzzle]:
+        # Reads the columns from Round through last_column of every row after the headers, on
+        # every tab with puzzles, in one request. Returns the rows in order.
+        #
+        # While Drive is notifying us of changes to the tracker, the whole thing is read once and
+        # kept until the next change.
+        version = self.db.tracker_version() if self.watch_url else None
+        if version is None:
+            return self._fetch_puzzles(desc, last_column)
+        cached = self._tracker_cache
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        puzzles = self._fetch_puzzles(desc, 'H')
+        self._tracker_cache = (version, puzzles)
+        return puzzles
+
+    def _fetch_puzzles(self, desc: str, last_column: str, reloaded: bool = False) -> List[Puzzle]:
+        tabs = self._tabs()
+        ranges = [tab.a1(f'A{tab.header_rows + 1}:{last_column}') for tab in tabs]
+        if self.sharded:
+            # The index comes along in the same request, to check the cached tabs are still right.
+            request = self.sheets.values().batchGet(
+                spreadsheetId=self.puzzle_list_spreadsheet_id,
+                ranges=[self._index_range()] + ranges)
+            index_range, *value_ranges = self.client.log_and_send(desc, request)['valueRanges']
+            if not reloaded and not self._index_matches(index_range.get('values', [])):
+                log.info('Tracker index is out of date; reloading it.')
+                self._read_index()
+                return self._fetch_puzzles(desc, last_column, reloaded=True)
+        elif len(ranges) == 1:
+            request = self.sheets.values().get(spreadsheetId=self.puzzle_list_spreadsheet_id,
+                                               range=ranges[0])
+            value_ranges = [self.client.log_and_send(desc, request)]
+        else:
+            value_ranges = []
+        result = []
+        for tab, value_range in zip(tabs, value_ranges):
+            first_row = tab.row_index(tab.header_rows)
+            result.extend(Puzzle(first_row + i, cells)
+                          for i, cells in enumerate(value_range.get('values', [])))
+        return result
+
+    def _update_tracker(self, desc: str, requests: List[Dict[str, Any]]) -> None:
         batch_request = self.sheets.batchUpdate(spreadsheetId=self.puzzle_list_spreadsheet_id,
                                                 body={'requests': requests})
-        self.client.log_and_send('Updating tracker row', batch_request)
+        try:
+            self.client.log_and_send(desc, batch_request)
+        finally:
+            # Drive will tell us about this change too, but not right away, so drop anything cached
+            # now. (Even if it failed: it may have been applied anyway.)
+            self._tracker_cache = None
+            if self.watch_url:
+                self.db.tracker_changed()
+
+    def watch_tracker(self, channel_id: str, address: str, token: str) -> Dict[str, Any]:
+        # Asks Drive to send a notification to address whenever the tracker changes, until the
+        # channel expires. Returns the channel, in the form db.drive_watch has it.
+        request = self.files.watch(fileId=self.puzzle_list_spreadsheet_id, body={
+            'id': channel_id,
+            'type': 'web_hook',
+            'address': address,
+            'token': token,
+            'expiration': int((time.time() + WATCH_SECONDS) * 1000),
+        })
+        response = self.client.log_and_send('Watching the tracker for changes', request)
+        return {'id': channel_id, 'resource_id': response['resourceId'], 'address': address,
+                'expiration': int(response['expiration']) / 1000}
+
+    def stop_watch(self, channel_id: str, resource_id: str) -> None:
+        request = self.client.drive.channels().stop(body={'id': channel_id,
+                                                          'resourceId': resource_id})
+        self.client.log_and_send('Stopping an old tracker watch', request)
 
 
 class UrlConflictError(BaseException):
@@ -493,6 +1182,13 @@ def row_data(cell_values: Iterable[str]):
     return {'values': values}
 
 
+def doc_file_id(doc_url: str) -> str:
+    match = FILE_ID_PATTERN.search(doc_url)
+    if not match:
+        raise ValueError(f"Can't find a file ID in {doc_url}")
+    return match.group(1)
+
+
 def channel_to_link(channel: str) -> str:
     return (f'=HYPERLINK("https://controlgroup.slack.com/app_redirect?channel={channel}",'
             f'"#{channel}")')
@@ -1,69 +1,379 @@
+import functools
 import logging
 import os
-import queue
+import secrets
 import threading
-from typing import Callable, Optional
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
 
-import requests
+import psycopg2
 
+import breaker
+import db
 import google_client
 import slack_client
+import tenants
+import timeline
 import util
+import webhooks
 
 logging.basicConfig(format='{asctime} {name} {levelname}: {message}', style='{')
 logging.getLogger('googleapiclient').setLevel(logging.ERROR)  # It's real noisy.
 log = logging.getLogger('placebo')
 log.setLevel(logging.DEBUG if os.getenv('PLACEBO_DEBUG_LOGS') == '1' else logging.INFO)
 
+# How long a prefetch from opening the /correct modal stays usable.
+PREFETCH_TTL_SECONDS = 300
+# How often to check whether the Google access token needs refreshing.
+TOKEN_CHECK_SECONDS = 60
+# How often, by default, to reconcile the puzzles mirror with the tracker.
+PUZZLE_SYNC_SECONDS = 300
+# By default, the admin gets a waterfall of any job that takes longer than this.
+SLOW_JOB_SECONDS = 30
+# While Drive is notifying us of changes to the tracker, the mirror is synced after each one, so the
+# periodic sync only needs to catch anything that slipped through.
+WATCHED_PUZZLE_SYNC_SECONDS = 60 * 60
+# After a change notification, wait this long before syncing, so a burst of edits costs one sync.
+CHANGE_SYNC_DELAY_SECONDS = 10
+# Renew the Drive notification channel once it has less than this left.
+WATCH_RENEW_SECONDS = 60 * 60
+
+
+@dataclass
+class SolvePrefetch:
+    row_index: int
+    doc_url: str
+    doc_name: Optional[str]
+    channel_name: Optional[str]
+    channel_id: Optional[str]
+
 
 class Placebo:
-    def __init__(self) -> None:
-        self.create_metas = os.getenv('PLACEBO_CREATE_METAS', '1') == '1'
+    def __init__(self, tenant: tenants.Tenant) -> None:
+        self.tenant = tenant
+        config = tenant.config
+        self.create_metas = config.get('PLACEBO_CREATE_METAS', '1') == '1'
         self.metas_have_names = (self.create_metas and
-                                 os.environ.get('PLACEBO_METAS_HAVE_NAMES') == '1')
-        self.google = google_client.Google()
-        self.slack = slack_client.Slack()
-        log.addHandler(slack_client.SlackLogHandler(self.slack, level=logging.ERROR))
-        self.queue: queue.Queue[Callable[[], None]] = queue.Queue()
-        # If set, it's the round in which the most recent puzzle was unlocked. It's used as the
-        # default round for the unlock dialog, to make repeated unlocks easier.
-        self.last_round: Optional[str] = None
-        threading.Thread(target=self._worker_thread, daemon=True).start()
+                                 config.get('PLACEBO_METAS_HAVE_NAMES') == '1')
+        self.puzzle_sync_seconds = float(
+            config.get('PLACEBO_PUZZLE_SYNC_SECONDS', PUZZLE_SYNC_SECONDS))
+        self.slow_job_seconds = float(config.get('PLACEBO_SLOW_JOB_SECONDS', SLOW_JOB_SECONDS))
+        self.db = db.Database(tenant.schema)
+        # Canonical puzzle name -> (when it was started, prefetch in progress or done).
+        self.prefetches: Dict[str, Tuple[float, util.Future[Optional[SolvePrefetch]]]] = {}
+        self.prefetches_lock = threading.Lock()
+        try:
+            self.google = google_client.Google(tenant, self.db)
+            self.slack = slack_client.Slack(self.db, tenant)
+            for circuit in self.google.breakers.values():
+                circuit.on_change = self._backend_changed
 
-        auth_url = self.google.start_oauth_if_necessary()
-        if auth_url:
-            self.slack.dm_admin(f'While logged in as the bot user, please visit {auth_url}')
+            auth_url = self.google.start_oauth_if_necessary()
+            if auth_url:
+                self.slack.dm_admin(f'While logged in as the bot user, please visit {auth_url}')
+            else:
+                if not self.db.puzzles_synced():
+                    self.db.enqueue_unless_pending('sync_puzzles')
+                if self.google.watch_url and self._watch_seconds_left() < WATCH_RENEW_SECONDS:
+                    self.db.enqueue_unless_pending('watch_tracker')
+            if self.db.pending_unlocks():
+                # Left over from before a restart, in case their job never made it into the queue.
+                self.db.enqueue_unless_pending('flush_unlocks')
+        except BaseException:
+            # Startup is retried with a new Placebo, so don't leave this one's connection open.
+            self.db.close()
+            raise
+        # Not until nothing else can fail, or each retry would add another handler, and the admin
+        # would hear about every error once for each.
+        log.addHandler(slack_client.SlackLogHandler(self.slack, tenant, level=logging.ERROR))
+        threading.Thread(target=self._worker_thread, daemon=True).start()
+        threading.Thread(target=self._token_thread, daemon=True).start()
+        threading.Thread(target=self._sync_thread, daemon=True).start()
 
-    # The public methods don't do any work -- they just enqueue a call to the corresponding private
-    # method, which the worker thread picks up. That accomplishes two things:
+    # The public methods don't do any work -- they just enqueue a job for the corresponding private
+    # method, which a worker thread picks up. That accomplishes two things:
     # - Ensures we always return a 200 for the incoming HTTP request promptly, without waiting for
     #   our API backends.
     # - Ensures we're never handling more than one request at a time.
+    # The jobs are kept in Postgres, and claimed under a lock, so that still holds when there are
+    # several gunicorn workers or dynos: any of them can take a request, and whichever one is the
+    # leader (see db.LEADER_LOCK_KEY) runs the job.
 
     def new_round(self, round_name: str, round_url: str, round_color: Optional[util.Color],
                   meta_name: Optional[str] = None) -> None:
-        self.queue.put(lambda: self._new_round(round_name, round_url, round_color, meta_name))
+        self.db.enqueue('new_round', {
+            'round_name': round_name,
+            'round_url': round_url,
+            'round_color': round_color.to_hex() if round_color else None,
+            'meta_name': meta_name,
+        })
 
     def new_puzzle(self, round_name: str, puzzle_name: str, puzzle_url: str,
                    response_url: Optional[str] = None) -> None:
-        self.queue.put(lambda: self._new_puzzle(round_name, puzzle_name, puzzle_url, response_url,
-                                                meta=False, round_color=None))
+        self.db.enqueue('new_puzzle', {
+            'round_name': round_name,
+            'puzzle_name': puzzle_name,
+            'puzzle_url': puzzle_url,
+            'response_url': response_url,
+            'meta': False,
+            'round_color': None,
+        })
 
     def solved_puzzle(
             self, puzzle_name: str, answer: str, response_url: Optional[str] = None) -> None:
-        self.queue.put(lambda: self._solved_puzzle(puzzle_name, answer, response_url))
+        self.db.enqueue('solved_puzzle', {
+            'puzzle_name': puzzle_name,
+            'answer': answer,
+            'response_url': response_url,
+        })
+
+    def solved_puzzles(self, solutions: List[Tuple[str, str]],
+                       response_url: Optional[str] = None) -> None:
+        self.db.enqueue('solved_puzzles', {
+            'solutions': solutions,
+            'response_url': response_url,
+        })
 
     def view_closed(self, view_id: str) -> None:
-        self.queue.put(lambda: self._view_closed(view_id))
+        self.db.enqueue('view_closed', {'view_id': view_id})
+
+    def sweep(self, response_url: Optional[str] = None) -> None:
+        self.db.enqueue('sweep', {'response_url': response_url})
+
+    def tracker_changed(self, token: str, resource_state: str) -> bool:
+        # Handles a notification from Drive that the tracker changed. Returns False if it wasn't
+        # from a channel we set up.
+        expected = self.db.get_state('drive_watch_token')
+        if not expected or not secrets.compare_digest(token, expected):
+            return False
+        # The first notification on a new channel just says it's working.
+        if resource_state != 'sync':
+            self.db.tracker_changed()
+            self.db.enqueue_unless_pending('sync_puzzles', delay_seconds=CHANGE_SYNC_DELAY_SECONDS)
+        return True
+
+    @property
+    def last_round(self) -> Optional[str]:
+        # If set, it's the round in which the most recent puzzle was unlocked. It's used as the
+        # default round for the unlock dialog, to make repeated unlocks easier.
+        return self.db.get_state('last_round')
+
+    @last_round.setter
+    def last_round(self, round_name: str) -> None:
+        self.db.set_state('last_round', round_name)
+
+    # These read from the puzzles mirror in Postgres, rather than the tracker, once it's been filled
+    # in.
+
+    def all_rounds(self) -> List[str]:
+        if self.db.puzzles_synced():
+            return self.db.all_rounds()
+        return self.google.all_rounds()
+
+    def unsolved_puzzles_by_round(
+            self, channel_name: str) -> Tuple[Dict[str, List[str]], Optional[str]]:
+        if self.db.puzzles_synced():
+            return self.db.unsolved_puzzles_by_round(channel_name)
+        return self.google.unsolved_puzzles_by_round(channel_name)
+
+    def correct_modal_options(
+            self, channel_name: str) -> Tuple[Dict[str, List[str]], Optional[str]]:
+        puzzles_by_round, default_puzzle = self.unsolved_puzzles_by_round(channel_name)
+        if default_puzzle:
+            # This is probably the puzzle that's about to be marked solved, so get a head start.
+            self.prefetch_solve(default_puzzle)
+        return puzzles_by_round, default_puzzle
+
+    def prefetch_solve(self, puzzle_name: str) -> None:
+        # Unlike the methods above, this doesn't go through the queue: it's read-only, and the point
+        # is to get it done while the QM is still typing the answer into the /correct modal. (It's
+        # kept in this process, so if another worker ends up running the solve, that one just does
+        # its own lookup as usual.)
+        key = util.canonicalize(puzzle_name)
+        now = time.monotonic()
+        with self.prefetches_lock:
+            for k, (started, _) in list(self.prefetches.items()):
+                if now - started > PREFETCH_TTL_SECONDS:
+                    del self.prefetches[k]
+            self.prefetches[key] = (now, util.future(self._prefetch_solve, [puzzle_name]))
 
     def _worker_thread(self) -> None:
+        tenants.current.set(self.tenant.id)
+        consumer = db.JobConsumer(self.db.worker_id, self.tenant.schema)
         while True:
-            func = self.queue.get()
             try:
-                func()
-            except BaseException:
+                if not consumer.leading:
+                    # Only one process runs jobs. The rest wait to take over if it goes away.
+                    if not consumer.lead():
+                        deposed = consumer.depose_if_stale()
+                        if deposed:
+                            log.warning('Took the job queue from %s, which stopped responding.',
+                                        deposed)
+                        time.sleep(db.LEADER_HEARTBEAT_SECONDS)
+                        continue
+                    log.info('Running the job queue as %s.', consumer.worker_id)
+                consumer.heartbeat_if_due()
+                if not consumer.leading:
+                    continue
+                job = consumer.claim()
+                if job is None:
+                    consumer.wait()
+                    continue
+            except psycopg2.Error:
+                log.exception('Database error in worker thread.')
+                consumer.reset()
+                time.sleep(db.POLL_SECONDS)
+                continue
+            error = None
+            job_timeline = timeline.Timeline(job.kind, job.queued_seconds,
+                                             functools.partial(self._record_timeline, job))
+            token = timeline.current.set(job_timeline)
+            try:
+                self._run_job(job)
+            except BaseException as e:
                 # TODO: Reply to the original command if we can.
                 log.exception('Error in worker thread.')
+                error = repr(e)
+            finally:
+                timeline.current.reset(token)
+                job_timeline.release()
+            try:
+                consumer.finish(job, error)
+            except psycopg2.Error:
+                log.exception('Database error finishing job %s.', job.id)
+                consumer.reset()
+
+    def _record_timeline(self, job: db.Job, job_timeline: timeline.Timeline) -> None:
+        try:
+            self.db.record_timeline(job.id, job.kind, job_timeline.queued_seconds,
+                                    job_timeline.seconds, job_timeline.spans_json())
+            if self.slow_job_seconds and job_timeline.seconds >= self.slow_job_seconds:
+                self.slack.dm_admin(job_timeline.waterfall())
+        except Exception:
+            log.exception('Error recording the timeline of job %s.', job.id)
+
+    def _backend_changed(self, circuit: breaker.CircuitBreaker) -> None:
+        # Let the QMs know when Sheets or Drive goes out or comes back, since it changes what
+        # Placebo does for them in the meantime. (This process's breakers are its own, so with
+        # several workers, each may post.)
+        try:
+            self.slack.post_backend_status(circuit.name, circuit.available())
+        except Exception:
+            log.exception('Error posting the %s status.', circuit.name)
+
+    def _token_thread(self) -> None:
+        # Keeps the Google access token fresh, so requests never stop to refresh it.
+        tenants.current.set(self.tenant.id)
+        failing = False
+        while True:
+            try:
+                seconds_left = self.google.refresh_token_if_expiring()
+            except Exception:
+                # Only report the first of a run of failures, instead of every minute.
+                if failing:
+                    log.warning('Still unable to refresh the Google access token.', exc_info=True)
+                else:
+                    log.exception('Error refreshing the Google access token.')
+                failing = True
+            else:
+                if seconds_left is not None:
+                    log.debug('Google access token good for %s.',
+                              util.format_duration(seconds_left))
+                failing = False
+            time.sleep(TOKEN_CHECK_SECONDS)
+
+    def _sync_thread(self) -> None:
+        # Every so often, have the mirror caught up with any changes people made to the tracker by
+        # hand. Every worker checks, but if one of them already did, the rest leave it be. The same
+        # goes for keeping Drive's change notifications coming, if they're set up.
+        tenants.current.set(self.tenant.id)
+        while True:
+            time.sleep(self.puzzle_sync_seconds)
+            try:
+                if not self.google.logged_in:
+                    continue
+                sync_seconds = self.puzzle_sync_seconds
+                if self.google.watch_url:
+                    if self._watch_seconds_left() < WATCH_RENEW_SECONDS:
+                        self.db.enqueue_unless_pending('watch_tracker')
+                    if self.db.tracker_version() is not None:
+                        sync_seconds = max(sync_seconds, WATCHED_PUZZLE_SYNC_SECONDS)
+                synced_ago = self.db.puzzles_synced_seconds_ago()
+                if synced_ago is None or synced_ago >= sync_seconds:
+                    self.db.enqueue_unless_pending('sync_puzzles')
+            except Exception:
+                log.exception('Error scheduling the tracker sync.')
+
+    def _watch_seconds_left(self) -> float:
+        watch = self.db.drive_watch()
+        if watch is None or watch['address'] != self.google.watch_url:
+            return 0.0
+        return watch['expiration'] - time.time()
+
+    def _watch_tracker(self) -> None:
+        # Sets up a channel for Drive to notify us of changes to the tracker on, replacing the old
+        # one. Drive needs a public HTTPS address, so for anything else (like a local server), this
+        # just records the channel, and drive_notify.py can stand in for Drive.
+        if self._watch_seconds_left() >= WATCH_RENEW_SECONDS:
+            return  # Someone else got to it.
+        old_watch = self.db.drive_watch()
+        token = self.db.get_state('drive_watch_token')
+        if not token:
+            # It starts with the tenant, so the notification can be routed to the right one.
+            token = f'{self.tenant.id}:{secrets.token_urlsafe(16)}'
+            self.db.set_state('drive_watch_token', token)
+        channel_id = str(uuid.uuid4())
+        address = self.google.watch_url
+        if address.startswith('https://'):
+            watch = self.google.watch_tracker(channel_id, address, token)
+        else:
+            log.info('Not asking Drive to notify %s; expecting a stand-in.', address)
+            watch = {'id': channel_id, 'resource_id': None, 'address': address,
+                     'expiration': time.time() + google_client.WATCH_SECONDS}
+        self.db.set_drive_watch(watch)
+        # Whatever anyone cached before the watch started may be out of date.
+        self.db.tracker_changed()
+        if old_watch and old_watch['resource_id'] and old_watch['expiration'] > time.time():
+            try:
+                self.google.stop_watch(old_watch['id'], old_watch['resource_id'])
+            except Exception:
+                # It'll expire on its own soon enough.
+                log.warning('Stopping the old tracker watch failed.', exc_info=True)
+
+    def _run_job(self, job: db.Job) -> None:
+        args = job.args
+        if job.kind == 'new_round':
+            if args['round_color']:
+                args['round_color'] = util.Color.from_hex(args['round_color'])
+            self._new_round(**args)
+        elif job.kind == 'new_puzzle':
+            self._new_puzzle(**args)
+        elif job.kind == 'finish_new_puzzle':
+            self._finish_new_puzzle(**args)
+        elif job.kind == 'replay_new_puzzle':
+            if args['round_color']:
+                args['round_color'] = util.Color.from_hex(args['round_color'])
+            self._replay_new_puzzle(**args)
+        elif job.kind == 'solved_puzzle':
+            self._solved_puzzle(**args)
+        elif job.kind == 'replay_solved_puzzle':
+            self._replay_solved_puzzle(**args)
+        elif job.kind == 'solved_puzzles':
+            self._solved_puzzles(**args)
+        elif job.kind == 'view_closed':
+            self._view_closed(**args)
+        elif job.kind == 'sweep':
+            self._sweep(**args)
+        elif job.kind == 'sync_puzzles':
+            self._sync_puzzles()
+        elif job.kind == 'watch_tracker':
+            self._watch_tracker()
+        elif job.kind == 'flush_unlocks':
+            self.slack.flush_unlocks()
+        else:
+            raise ValueError(f'Unexpected job kind {job.kind}')
 
     def _new_round(self, round_name: str, round_url: str, round_color: Optional[util.Color],
                    meta_name: Optional[str]) -> None:
@@ -74,7 +384,9 @@ class Placebo:
                              round_color=round_color)
         else:
             self.last_round = round_name
-            round_color = self.google.add_empty_row(round_name, round_color)
+            row_index, round_color = self.google.add_empty_row(round_name, round_color)
+            self.db.insert_puzzle(row_index, round_name, '', None, '')
+            self.db.record_round(round_name)
             self.slack.announce_round(round_name, round_url, round_color)
 
     def _new_puzzle(self, round_name: str, puzzle_name: str, puzzle_url: str,
@@ -85,11 +397,25 @@ class Placebo:
             full_puzzle_name = f'{puzzle_name} ({round_name} Meta)'
         else:
             full_puzzle_name = puzzle_name
-        if self.google.exists(full_puzzle_name):
+        # If Sheets or Drive is down or crawling, the Slack side still goes ahead, and the tracker
+        # row and the doc are left for a replay job to catch up on once it's back.
+        unavailable = self.google.unavailable()
+        if unavailable is None:
+            try:
+                exists = self.google.exists(full_puzzle_name)
+            except breaker.Unavailable as e:
+                # It went out between the check and the read.
+                unavailable = e
+        if unavailable is not None:
+            exists = bool(self.db.puzzles_synced() and self.db.lookup_puzzle(full_puzzle_name))
+        if exists:
             raise KeyError(f'Puzzle "{full_puzzle_name}" is already in the tracker.')
 
         # Creating the spreadsheet is super slow, so do it in parallel.
-        doc_url_future = util.future(self.google.create_puzzle_spreadsheet, [full_puzzle_name])
+        doc_url_future = None
+        if unavailable is None:
+            doc_url_future = util.future(self.google.create_puzzle_spreadsheet,
+                                         [full_puzzle_name])
 
         # Meanwhile, set up everything else...
         self.last_round = round_name
@@ -102,60 +428,392 @@ class Placebo:
         else:
             channel_name, channel_id = self.slack.create_channel(puzzle_url)
         priority = 'L' if meta else 'M'
-        round_color = self.google.add_row(round_name, full_puzzle_name, priority, puzzle_url,
-                                          channel_name, round_color)
+        replay_args = {
+            'round_name': round_name,
+            'full_puzzle_name': full_puzzle_name,
+            'priority': priority,
+            'puzzle_url': puzzle_url,
+            'channel_name': channel_name,
+            'channel_id': channel_id,
+            'round_color': round_color.to_hex() if round_color else None,
+        }
+        tracked = False
+        if unavailable is None:
+            try:
+                row_index, round_color = self.google.add_row(
+                    round_name, full_puzzle_name, priority, puzzle_url, channel_name, round_color)
+                tracked = True
+            except breaker.Unavailable as e:
+                log.warning('Adding %s to the tracker later: %s', full_puzzle_name, e)
+                unavailable = e
+        if tracked:
+            self.db.insert_puzzle(row_index, round_name, full_puzzle_name, channel_name,
+                                  'Not started')
+        else:
+            round_color = (round_color or self.google.cached_round_color(round_name) or
+                           google_client.PLAIN_BACKGROUND)
+        self.db.record_unlock(full_puzzle_name, round_name)
         if meta:
             self.slack.announce_round(round_name, puzzle_url, round_color)
         else:
             self.slack.announce_unlock(round_name, full_puzzle_name, puzzle_url, channel_name,
                                        channel_id, round_color)
+        if unavailable is not None:
+            _ephemeral_ack(f"*{puzzle_name}* has its channel, but {unavailable.name} isn't "
+                           "responding, so its tracker row and doc will be added once it's back.",
+                           response_url)
+        if doc_url_future is None:
+            self.db.enqueue('replay_new_puzzle', dict(replay_args, doc_url=None),
+                            delay_seconds=unavailable.retry_after)
+            return
 
         # ... then wait for the doc URL, and go back and fill it in. But don't hold up the worker
-        # thread in the meantime.
+        # thread in the meantime. (The job's timeline stays open until then, so the wait is on it.)
+        release_timeline = timeline.hold()
+
         def await_and_finish():
-            doc_url = doc_url_future.wait()
-            self.queue.put(
-                lambda: self._finish_new_puzzle(full_puzzle_name, puzzle_url, channel_id, doc_url))
-        threading.Thread(target=await_and_finish).start()
+            try:
+                with timeline.span('Waiting for the puzzle doc'):
+                    doc_url = doc_url_future.wait()
+                error = doc_url_future.exception()
+                if error is not None:
+                    # The row may be in, but the doc isn't, so the replay job makes it (and if the
+                    # row isn't in either, adds that too).
+                    log.warning('Creating the doc for %s later.', full_puzzle_name, exc_info=error)
+                    retry_after = (error.retry_after if isinstance(error, breaker.Unavailable)
+                                   else breaker.RESET_SECONDS)
+                    if unavailable is not None:
+                        retry_after = max(retry_after, unavailable.retry_after)
+                    self.db.enqueue('replay_new_puzzle', dict(replay_args, doc_url=None),
+                                    delay_seconds=retry_after)
+                elif tracked:
+                    self.db.enqueue('finish_new_puzzle', {
+                        'full_puzzle_name': full_puzzle_name,
+                        'puzzle_url': puzzle_url,
+                        'channel_id': channel_id,
+                        'doc_url': doc_url,
+                    })
+                else:
+                    self.db.enqueue('replay_new_puzzle', dict(replay_args, doc_url=doc_url),
+                                    delay_seconds=unavailable.retry_after)
+            finally:
+                release_timeline()
+        threading.Thread(target=util.in_current_context(await_and_finish)).start()
 
     def _finish_new_puzzle(
             self, full_puzzle_name: str, puzzle_url: str, channel_id: str, doc_url: str) -> None:
         try:
             self.google.set_doc_url(full_puzzle_name, doc_url)
+            self.db.set_puzzle_doc_url(full_puzzle_name, doc_url)
         except KeyError:
             log.exception('Tracker row went missing before we got to it -- puzzle name changed?')
         except google_client.UrlConflictError as e:
             log.exception('Doc URL was set before we got to it')
             doc_url = e.found_url
+            self.db.set_puzzle_doc_url(full_puzzle_name, doc_url)
         self.slack.set_topic(channel_id, puzzle_url, doc_url)
 
+    def _replay_new_puzzle(self, round_name: str, full_puzzle_name: str, priority: str,
+                           puzzle_url: str, channel_name: str, channel_id: str,
+                           round_color: Optional[util.Color], doc_url: Optional[str]) -> None:
+        # The tracker and Drive half of a puzzle unlocked while they were unavailable. Each step
+        # checks whether it's already been done, so if the backend goes out again partway through,
+        # the next try picks up where this one left off.
+        try:
+            lookup = self.google.lookup(full_puzzle_name, fresh=True)
+            if lookup is None:
+                row_index, _ = self.google.add_row(round_name, full_puzzle_name, priority,
+                                                   puzzle_url, channel_name, round_color)
+                self.db.insert_puzzle(row_index, round_name, full_puzzle_name, channel_name,
+                                      'Not started')
+            elif 'http' in lookup[1]:
+                # Someone filled in the doc by hand in the meantime.
+                self.slack.set_topic(channel_id, puzzle_url, lookup[1])
+                return
+            if not doc_url:
+                doc_url = self.google.create_puzzle_spreadsheet(full_puzzle_name)
+            self._finish_new_puzzle(full_puzzle_name, puzzle_url, channel_id, doc_url)
+        except breaker.Unavailable as e:
+            log.info('Still waiting to add %s to the tracker: %s', full_puzzle_name, e)
+            self.db.enqueue('replay_new_puzzle', {
+                'round_name': round_name,
+                'full_puzzle_name': full_puzzle_name,
+                'priority': priority,
+                'puzzle_url': puzzle_url,
+                'channel_name': channel_name,
+                'channel_id': channel_id,
+                'round_color': round_color.to_hex() if round_color else None,
+                'doc_url': doc_url,
+            }, delay_seconds=e.retry_after)
+
     def _solved_puzzle(self, puzzle_name: str, answer: str, response_url: Optional[str]) -> None:
         # It'll already be in caps if it was typed as a command arg, but it might not if it came
         # from the modal.
         answer = answer.upper()
         _ephemeral_ack(f'Marking *{puzzle_name}* correct...', response_url)
-        lookup = self.google.lookup(puzzle_name)
+        prefetch = self._take_prefetch(puzzle_name)
+        if prefetch:
+            log.info('Using prefetched lookup for %s.', puzzle_name)
+            row_index = prefetch.row_index
+            doc_url = prefetch.doc_url
+            doc_name = prefetch.doc_name
+            channel_name = prefetch.channel_name
+            channel_id = prefetch.channel_id
+        else:
+            lookup, fresh = self._lookup(puzzle_name)
+            if lookup is None:
+                raise KeyError(f'Puzzle "{puzzle_name}" not found.')
+            row_index, doc_url, channel_name = lookup
+            doc_name = None
+            channel_id = None
+
+        def mark_row_solved():
+            nonlocal row_index
+            if (prefetch or not fresh) and not self.google.row_matches(row_index, puzzle_name):
+                # The tracker has shifted since we looked, so look the row up again.
+                lookup = self.google.lookup(puzzle_name, fresh=True)
+                if lookup is None:
+                    raise KeyError(f'Puzzle "{puzzle_name}" not found.')
+                row_index = lookup[0]
+            self.google.mark_row_solved(row_index, answer)
+            self.db.mark_puzzle_solved(row_index, answer)
+            self.db.record_solve(puzzle_name)
+
+        # Once we have the row, none of the rest depends on anything else, so it all goes at once
+        # -- in particular, the announcement doesn't wait on Drive or the tracker. A failure in one
+        # step is reported on its own and doesn't stop the others.
+        steps: Dict[str, util.Step] = {
+            'mark_row_solved': ([], mark_row_solved),
+            'announce_solved': ([], lambda: self.slack.announce_solved(puzzle_name, answer)),
+        }
+        if doc_url:
+            steps['mark_doc_solved'] = ([], lambda: self.google.mark_doc_solved(doc_url, doc_name))
+        if channel_name:
+            steps['solved'] = ([], lambda: self.slack.solved(channel_name, answer, channel_id))
+        failures = util.run_graph(steps)
+        # If the tracker or the doc couldn't be marked because its backend is unavailable, that
+        # waits for a replay job instead of being lost.
+        waiting = {step: e for step, e in failures.items() if isinstance(e, breaker.Unavailable)}
+        if waiting:
+            self.db.enqueue('replay_solved_puzzle', {
+                'puzzle_name': puzzle_name,
+                'answer': answer,
+                'mark_row': 'mark_row_solved' in waiting,
+                'doc_url': doc_url if 'mark_doc_solved' in waiting else None,
+            }, delay_seconds=max(e.retry_after for e in waiting.values()))
+            _ephemeral_ack(f'*{puzzle_name}* is announced, but Google isn\'t responding, so the '
+                           "tracker and doc will be marked once it's back.", response_url)
+        for step, e in failures.items():
+            if step not in waiting:
+                log.error('Error in %s while marking %s solved.', step, puzzle_name, exc_info=e)
+
+    def _replay_solved_puzzle(self, puzzle_name: str, answer: str, mark_row: bool,
+                              doc_url: Optional[str]) -> None:
+        try:
+            if mark_row:
+                lookup = self.google.lookup(puzzle_name, fresh=True)
+                if lookup is None:
+                    raise KeyError(f'Puzzle "{puzzle_name}" not found.')
+                self.google.mark_row_solved(lookup[0], answer)
+                self.db.mark_puzzle_solved(lookup[0], answer)
+                self.db.record_solve(puzzle_name)
+                mark_row = False
+            if doc_url:
+                self.google.mark_doc_solved(doc_url)
+        except breaker.Unavailable as e:
+            log.info('Still waiting to mark %s solved: %s', puzzle_name, e)
+            self.db.enqueue('replay_solved_puzzle', {
+                'puzzle_name': puzzle_name,
+                'answer': answer,
+                'mark_row': mark_row,
+                'doc_url': doc_url,
+            }, delay_seconds=e.retry_after)
+
+    def _solved_puzzles(self, solutions: List[Tuple[str, str]],
+                        response_url: Optional[str]) -> None:
+        # Several puzzles at once, like at the end of a round when the rest get backsolved from the
+        # meta: one read and one write for the tracker, one batch for Drive, one channel list for
+        # Slack, and all the posts at once.
+        solutions = [(puzzle_name, answer.upper()) for puzzle_name, answer in solutions]
+        puzzle_names = [puzzle_name for puzzle_name, _ in solutions]
+        # If Sheets is out, the rows are found in the mirror instead. Those may be out of date, so
+        # they aren't written to: marking them waits for replay jobs, which look them up again.
+        sheets = self.google.breakers['sheets']
+        unavailable = (None if sheets.available()
+                       else breaker.Unavailable(sheets.name, sheets.retry_after()))
+        if unavailable is None:
+            try:
+                lookups = self.google.lookup_all(puzzle_names, fresh=True)
+            except breaker.Unavailable as e:
+                unavailable = e
+        if unavailable is not None:
+            if not self.db.puzzles_synced():
+                log.info('Marking puzzles solved later: %s', unavailable)
+                self.db.enqueue('solved_puzzles', {
+                    'solutions': solutions,
+                    'response_url': response_url,
+                }, delay_seconds=unavailable.retry_after)
+                _ephemeral_ack("Google isn't responding, so these will be marked solved once it's "
+                               'back.', response_url)
+                return
+            lookups = {puzzle_name: self.db.lookup_puzzle(puzzle_name)
+                       for puzzle_name in puzzle_names}
+        found = []
+        missing = []
+        for puzzle_name, answer in solutions:
+            lookup = lookups[puzzle_name]
+            if lookup is None:
+                missing.append(puzzle_name)
+            else:
+                found.append((puzzle_name, answer, lookup))
+        if missing:
+            log.warning('Puzzles not found: %s', ', '.join(missing))
+            names = ', '.join(f'*{name}*' for name in missing)
+            rest = ('The rest are still being marked solved.' if found
+                    else 'Nothing was marked solved.')
+            _ephemeral_ack(f"Couldn't find {names} in the tracker. {rest}", response_url)
+        if not found:
+            return
+        channel_ids: Dict[str, str] = {}
+        # Docs that couldn't be marked because Drive is unavailable, by URL.
+        waiting_docs: Dict[str, breaker.Unavailable] = {}
+
+        def mark_rows_solved():
+            if unavailable is not None:
+                raise unavailable
+            self.google.mark_rows_solved(
+                [(row_index, answer) for _, answer, (row_index, _, _) in found])
+            for puzzle_name, answer, (row_index, _, _) in found:
+                self.db.mark_puzzle_solved(row_index, answer)
+                self.db.record_solve(puzzle_name)
+
+        def mark_docs_solved():
+            failures = self.google.mark_docs_solved(
+                [doc_url for _, _, (_, doc_url, _) in found if doc_url])
+            for doc_url, e in failures.items():
+                if isinstance(e, breaker.Unavailable):
+                    waiting_docs[doc_url] = e
+                else:
+                    log.error('Error marking %s solved.', doc_url, exc_info=e)
+
+        def get_channel_ids():
+            try:
+                channel_ids.update(self.slack.channel_ids_by_name())
+            except Exception:
+                # Not the end of the world: each channel will be looked up on its own instead.
+                log.warning('Listing channels failed.', exc_info=True)
+
+        def solved(channel_name: str, answer: str):
+            self.slack.solved(channel_name, answer, channel_ids.get(channel_name))
+
+        steps: Dict[str, util.Step] = {
+            'mark_rows_solved': ([], mark_rows_solved),
+            'mark_docs_solved': ([], mark_docs_solved),
+            'channel_ids': ([], get_channel_ids),
+        }
+        for puzzle_name, answer, (_, _, channel_name) in found:
+            steps[f'announce_solved {puzzle_name}'] = (
+                [], functools.partial(self.slack.announce_solved, puzzle_name, answer))
+            if channel_name:
+                steps[f'solved {puzzle_name}'] = (
+                    ['channel_ids'], functools.partial(solved, channel_name, answer))
+        failures = util.run_graph(steps)
+        # As in _solved_puzzle, anything that couldn't be marked because its backend is unavailable
+        # waits for a replay job, one per puzzle.
+        waiting = {step: e for step, e in failures.items() if isinstance(e, breaker.Unavailable)}
+        if 'mark_docs_solved' in waiting:
+            waiting_docs.update((doc_url, waiting['mark_docs_solved'])
+                                for _, _, (_, doc_url, _) in found if doc_url)
+        if waiting or waiting_docs:
+            errors = list(waiting.values()) + list(waiting_docs.values())
+            for puzzle_name, answer, (_, doc_url, _) in found:
+                mark_row = 'mark_rows_solved' in waiting
+                if mark_row or doc_url in waiting_docs:
+                    self.db.enqueue('replay_solved_puzzle', {
+                        'puzzle_name': puzzle_name,
+                        'answer': answer,
+                        'mark_row': mark_row,
+                        'doc_url': doc_url if doc_url in waiting_docs else None,
+                    }, delay_seconds=max(e.retry_after for e in errors))
+            _ephemeral_ack("They're announced, but Google isn't responding, so the tracker and "
+                           "docs will be marked once it's back.", response_url)
+        for step, e in failures.items():
+            if step not in waiting:
+                log.error('Error in %s while marking puzzles solved.', step, exc_info=e)
+
+    def _lookup(self, puzzle_name: str) -> Tuple[Optional[Tuple[int, str, Optional[str]]], bool]:
+        # Returns the puzzle's row (like Google.lookup), and whether it came straight from the
+        # tracker, as opposed to the mirror, which may be out of date.
+        if self.db.puzzles_synced():
+            return self.db.lookup_puzzle(puzzle_name), False
+        return self.google.lookup(puzzle_name, fresh=True), True
+
+    def _prefetch_solve(self, puzzle_name: str) -> Optional[SolvePrefetch]:
+        lookup, _ = self._lookup(puzzle_name)
         if lookup is None:
-            raise KeyError(f'Puzzle "{puzzle_name}" not found.')
+            return None
         row_index, doc_url, channel_name = lookup
+        # These are each nice to have but not essential, so don't let one spoil the rest.
+        doc_name = None
         if doc_url:
-            self.google.mark_doc_solved(doc_url)
-        self.google.mark_row_solved(row_index, answer)
+            try:
+                doc_name = self.google.doc_name(google_client.doc_file_id(doc_url))
+            except Exception:
+                log.warning('Prefetching the doc title for %s failed.', puzzle_name, exc_info=True)
+        channel_id = None
         if channel_name:
-            self.slack.solved(channel_name, answer)
-        self.slack.announce_solved(puzzle_name, answer)
+            try:
+                channel_id = self.slack.get_channel_id_by_name(channel_name)
+            except Exception:
+                log.warning('Prefetching the channel for %s failed.', puzzle_name, exc_info=True)
+        return SolvePrefetch(row_index, doc_url, doc_name, channel_name, channel_id)
+
+    def _take_prefetch(self, puzzle_name: str) -> Optional[SolvePrefetch]:
+        with self.prefetches_lock:
+            entry = self.prefetches.pop(util.canonicalize(puzzle_name), None)
+        if entry is None:
+            return None
+        started, prefetch = entry
+        if time.monotonic() - started > PREFETCH_TTL_SECONDS:
+            return None
+        # If it's still running, waiting for it is still quicker than starting over. If it failed,
+        # this is None and we'll just do the lookup ourselves.
+        with timeline.span('Waiting for the prefetch'):
+            return prefetch.wait()
 
     def _view_closed(self, view_id: str) -> None:
         self.slack.delete_in_progress_message(view_id)
 
+    def _sync_puzzles(self) -> None:
+        # Replace the mirror with what's in the tracker now. The statistics pick up any puzzles
+        # that were added, or marked solved, by hand; otherwise they're kept up to date as we go.
+        rows = self.google.all_rows()
+        self.db.replace_puzzles(rows)
+        self.db.seed_stats([(round_name, name, status in google_client.SOLVED_STATUSES)
+                            for _, round_name, name, _, _, status, _ in rows
+                            if round_name not in {'', 'Hunt', 'Meta'}])
+
+    def _sweep(self, response_url: Optional[str]) -> None:
+        if self.db.puzzles_synced():
+            solved_channels = self.db.solved_channels()
+        else:
+            solved_channels = self.google.solved_channels()
+        archived, active, failed = self.slack.sweep(solved_channels)
+        lines = [f'Archived {len(archived)} idle solved-puzzle channels.']
+        if active:
+            lines.append(f"Left {len(active)} open because they've been active in the last half "
+                         f"hour: {', '.join(f'#{name}' for name in active)}")
+        if failed:
+            lines.append(f"Couldn't check or archive {len(failed)}: "
+                         f"{', '.join(f'#{name}' for name in failed)}")
+        _ephemeral_ack('\n'.join(lines), response_url)
+
 
 def _ephemeral_ack(message, response_url) -> None:
     if not response_url:
         return
-    log.info('Logging ephemeral acknowledgment...')
-    response = requests.post(response_url, json={
+    # This doesn't wait for the post to go through, so it never holds up the job itself.
+    webhooks.post_async('Logging ephemeral acknowledgment...', response_url, {
         'text': message,
         'response_type': 'ephemeral'
     })
-    if response.status_code != 200:
-        log.error(f"Couldn't log ephemeral acknowledgment: {response.status_code} {response.text}")
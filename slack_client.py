@@ -1,15 +1,22 @@
 import datetime
 import itertools
+import json
 import logging
-import os
 import pprint
 import random
-from typing import Any, Dict, List, Optional, Tuple, Union
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar, Union
 
 import requests
 from slackclient import SlackClient
 
+import db
+import tenants
+import timeline
 import util
+import webhooks
 
 log = logging.getLogger('placebo.slack_client')
 
@@ -19,20 +26,45 @@ SUCCESS_EMOJI = ['sunglasses', 'hugging_face', 'dancer', 'muscle', 'thumbsup', '
                  'stars', 'rainbow', 'fire', 'musical_note', 'notes', 'ballot_box_with_check',
                  '100', 'checkered_flag', 'awesome', 'bananadance', 'bb8', 'parrot', 'woo']
 
+# How many times to retry a request Slack rejects for going over its rate limit.
+RATE_LIMIT_RETRIES = 3
+# How many channels /sweep works on at once. Slack's rate limits are per method, and this keeps us
+# comfortably inside them while still being much faster than one at a time.
+SWEEP_THREADS = 4
+# By default, how long to hold an unlock announcement, so that puzzles unlocked together (like when
+# a round opens) are announced in one message. Zero posts each one right away.
+UNLOCK_WINDOW_SECONDS = 5.0
+# Unlocks announced this soon after the last unlock announcement are added to it, rather than posted
+# as a new message, as long as nothing else has been posted in the channel since.
+UNLOCK_EDIT_SECONDS = 60.0
+# Past this many puzzles, start a new message instead.
+MAX_UNLOCKS_PER_MESSAGE = 20
+
+T = TypeVar('T')
+
 
 class Slack:
-    def __init__(self):
-        self.client = SlackClient(os.environ['PLACEBO_SLACK_TOKEN'])
-        if os.environ.get('PLACEBO_TESTING') == '1':
-            self.qm_channel_id = os.environ['PLACEBO_QM_CHANNEL_ID_TESTING']
-            self.unlocks_channel_id = os.environ['PLACEBO_UNLOCKS_CHANNEL_ID_TESTING']
+    def __init__(self, database: db.Database, tenant: tenants.Tenant):
+        self.db = database
+        config = tenant.config
+        self.client = SlackClient(config['PLACEBO_SLACK_TOKEN'])
+        if config.get('PLACEBO_TESTING') == '1':
+            self.qm_channel_id = config['PLACEBO_QM_CHANNEL_ID_TESTING']
+            self.unlocks_channel_id = config['PLACEBO_UNLOCKS_CHANNEL_ID_TESTING']
         else:
-            self.qm_channel_id = os.environ['PLACEBO_QM_CHANNEL_ID']
-            self.unlocks_channel_id = os.environ['PLACEBO_UNLOCKS_CHANNEL_ID']
-        self.admin_user = os.environ['PLACEBO_ADMIN_SLACK_USER']
-        self.in_progress_messages: Dict[str, str] = {}
-        self.metas_have_names = (os.environ.get('PLACEBO_METAS_HAVE_NAMES') == '1' and
-                                 os.environ.get('PLACEBO_CREATE_METAS') == '1')
+            self.qm_channel_id = config['PLACEBO_QM_CHANNEL_ID']
+            self.unlocks_channel_id = config['PLACEBO_UNLOCKS_CHANNEL_ID']
+        self.admin_user = config['PLACEBO_ADMIN_SLACK_USER']
+        self.metas_have_names = (config.get('PLACEBO_METAS_HAVE_NAMES') == '1' and
+                                 config.get('PLACEBO_CREATE_METAS') == '1')
+        self.unlock_window_seconds = float(
+            config.get('PLACEBO_UNLOCK_WINDOW_SECONDS', UNLOCK_WINDOW_SECONDS))
+        self.progressive_modals = config.get('PLACEBO_PROGRESSIVE_MODALS') == '1'
+        # The options each progressive modal was last filled in with, by callback ID, to open the
+        # next one with.
+        self.modal_options: Dict[str, Any] = {}
+        # Held while announcing, so announcements go out in order.
+        self.announce_lock = threading.Lock()
 
     def dm_admin(self, message: str):
         self.log_and_send('DMing admin user', 'chat.postMessage', channel=self.admin_user,
@@ -94,15 +126,56 @@ class Slack:
                                      view=view)
         self.post_in_progress_message(response['view']['id'], user_id, 'is adding a round...')
 
-    def unlock_modal(self, trigger_id: str, user_id: str, rounds: List[str],
+    def unlock_modal(self, trigger_id: str, user_id: str, rounds: util.Future[List[str]],
                      last_round: Optional[str]) -> None:
-        view = {
+        def fill(rounds: List[str]) -> Dict[str, Any]:
+            self.modal_options['unlock'] = rounds
+            return self._unlock_view(rounds, last_round)
+
+        view_id = self._open_modal('Opening /unlock modal', trigger_id,
+                                   self._unlock_view(self.modal_options.get('unlock'), last_round),
+                                   rounds, fill)
+        self.post_in_progress_message(view_id, user_id, 'is adding an unlock...')
+
+    def _unlock_view(self, rounds: Optional[List[str]], last_round: Optional[str]) -> Dict[str, Any]:
+        if rounds is None:
+            # We don't know the rounds yet, so let them type one in for now.
+            round_block = {
+                'type': 'input',
+                'block_id': 'round_name_text',
+                'label': plain_text('Round'),
+                'element': {
+                    'type': 'plain_text_input',
+                    'action_id': 'round_name',
+                    'placeholder': plain_text('Lorem Ipsum'),
+                },
+                'hint': plain_text('Loading the list of rounds...'),
+            }
+        else:
+            round_block = {
+                'type': 'input',
+                'block_id': 'round_name',
+                'label': plain_text('Round'),
+                'element': {
+                    'type': 'static_select',
+                    'action_id': 'round_name',
+                    'options': [{'text': plain_text(r), 'value': r} for r in rounds],
+                    'placeholder': plain_text('Choose a round'),
+                }
+            }
+            if last_round in rounds:
+                round_block['element']['initial_option'] = {
+                    'text': plain_text(last_round),
+                    'value': last_round
+                }
+        return {
             'type': 'modal',
             'callback_id': 'unlock',
             'title': plain_text('Unlock new puzzle'),
             'blocks': [
                 {
                     'type': 'input',
+                    'block_id': 'puzzle_name',
                     'label': plain_text('Name'),
                     'element': {
                         'type': 'plain_text_input',
@@ -112,6 +185,7 @@ class Slack:
                 },
                 {
                     'type': 'input',
+                    'block_id': 'puzzle_url',
                     'label': plain_text('URL'),
                     'element': {
                         'type': 'plain_text_input',
@@ -119,54 +193,72 @@ class Slack:
                         'placeholder': plain_text('https://example.com/puzzle/lorem_ipsum'),
                     },
                 },
-                {
-                    'type': 'input',
-                    'label': plain_text('Round'),
-                    'element': {
-                        'type': 'static_select',
-                        'action_id': 'round_name',
-                        'options': [{'text': plain_text(r), 'value': r} for r in rounds],
-                        'placeholder': plain_text('Choose a round'),
-                    }
-                }
+                round_block,
             ],
             'close': plain_text('Cancel'),
             'submit': plain_text('Submit'),
             'notify_on_close': True,
         }
-        if last_round in rounds:
-            view['blocks'][2]['element']['initial_option'] = {
-                'text': plain_text(last_round),
-                'value': last_round
-            }
-        response = self.log_and_send('Opening /unlock modal', 'views.open', trigger_id=trigger_id,
-                                     view=view)
-        self.post_in_progress_message(response['view']['id'], user_id, 'is adding an unlock...')
 
-    def correct_modal(self, trigger_id: str, user_id: str, puzzles_by_round: Dict[str, List[str]],
-                      default_puzzle: Optional[str]) -> None:
-        view = {
+    def correct_modal(self, trigger_id: str, user_id: str,
+                      puzzles: util.Future[Tuple[Dict[str, List[str]], Optional[str]]]) -> None:
+        def fill(puzzles: Tuple[Dict[str, List[str]], Optional[str]]) -> Dict[str, Any]:
+            puzzles_by_round, default_puzzle = puzzles
+            self.modal_options['correct'] = puzzles_by_round
+            return self._correct_view(puzzles_by_round, default_puzzle)
+
+        # The default puzzle depends on the channel, so last time's isn't any use here.
+        view_id = self._open_modal('Opening /correct modal', trigger_id,
+                                   self._correct_view(self.modal_options.get('correct'), None),
+                                   puzzles, fill)
+        self.post_in_progress_message(view_id, user_id, 'is marking a puzzle solved...')
+
+    def _correct_view(self, puzzles_by_round: Optional[Dict[str, List[str]]],
+                     default_puzzle: Optional[str]) -> Dict[str, Any]:
+        if puzzles_by_round is None:
+            # We don't know the puzzles yet, so let them type one in for now.
+            puzzle_block = {
+                'type': 'input',
+                'block_id': 'puzzle_name_text',
+                'label': plain_text('Puzzle'),
+                'element': {
+                    'type': 'plain_text_input',
+                    'action_id': 'puzzle_name',
+                    'placeholder': plain_text('Lorem Ipsum'),
+                },
+                'hint': plain_text('Loading the list of puzzles...'),
+            }
+        else:
+            puzzle_block = {
+                'type': 'input',
+                'block_id': 'puzzle_name',
+                'label': plain_text('Puzzle'),
+                'element': {
+                    'type': 'static_select',
+                    'action_id': 'puzzle_name',
+                    'option_groups': [
+                        {
+                            'label': plain_text(round),
+                            'options': [{'text': plain_text(p), 'value': p} for p in puzzles]
+                        }
+                        for round, puzzles in puzzles_by_round.items()],
+                    'placeholder': plain_text('Choose a puzzle')
+                }
+            }
+            if default_puzzle in itertools.chain.from_iterable(puzzles_by_round.values()):
+                puzzle_block['element']['initial_option'] = {
+                    'text': plain_text(default_puzzle),
+                    'value': default_puzzle,
+                }
+        return {
             'type': 'modal',
             'callback_id': 'correct',
             'title': plain_text('Mark an answer correct'),
             'blocks': [
+                puzzle_block,
                 {
                     'type': 'input',
-                    'label': plain_text('Puzzle'),
-                    'element': {
-                        'type': 'static_select',
-                        'action_id': 'puzzle_name',
-                        'option_groups': [
-                            {
-                                'label': plain_text(round),
-                                'options': [{'text': plain_text(p), 'value': p} for p in puzzles]
-                            }
-                            for round, puzzles in puzzles_by_round.items()],
-                        'placeholder': plain_text('Choose a puzzle')
-                    }
-                },
-                {
-                    'type': 'input',
+                    'block_id': 'answer',
                     'label': plain_text('Answer'),
                     'element': {
                         'type': 'plain_text_input',
@@ -179,15 +271,41 @@ class Slack:
             'submit': plain_text('Submit'),
             'notify_on_close': True,
         }
-        if default_puzzle in itertools.chain.from_iterable(puzzles_by_round.values()):
-            view['blocks'][0]['element']['initial_option'] = {
-                'text': plain_text(default_puzzle),
-                'value': default_puzzle,
-            }
-        response = self.log_and_send('Opening /correct modal', 'views.open', trigger_id=trigger_id,
-                                     view=view)
-        self.post_in_progress_message(response['view']['id'], user_id,
-                                      'is marking a puzzle solved...')
+
+    def _open_modal(self, desc: str, trigger_id: str, skeleton: Dict[str, Any],
+                    options: util.Future[T], fill: Callable[[T], Dict[str, Any]]) -> str:
+        # Opens a modal whose options come from the tracker, and returns its view ID. Normally, that
+        # waits for the options. With progressive modals, the skeleton (built from the options we
+        # had last time, if any) opens right away instead, and the real view replaces it with
+        # views.update when the options arrive. Either way, the trigger ID is only good for three
+        # seconds, so opening first means a slow tracker read can't make us miss it.
+        if not self.progressive_modals:
+            if options.exception():
+                raise options.exception()
+            response = self.log_and_send(desc, 'views.open', trigger_id=trigger_id,
+                                         view=fill(options.wait()))
+            return response['view']['id']
+
+        response = self.log_and_send(desc, 'views.open', trigger_id=trigger_id, view=skeleton)
+        view_id = response['view']['id']
+        view_hash = response['view']['hash']
+
+        def update() -> None:
+            if options.exception():
+                log.error('Error fetching modal options.', exc_info=options.exception())
+                return
+            view = fill(options.wait())
+            if view == skeleton:
+                return
+            log.info('Filling in modal')
+            # Not log_and_send, since failing here is normal: the modal may have been submitted or
+            # closed already, or changed since (that's what the hash is for).
+            response = self.client.api_call('views.update', view_id=view_id, hash=view_hash,
+                                            view=view)
+            if not response['ok']:
+                log.info("Didn't fill in modal %s: %s", view_id, response.get('error'))
+        threading.Thread(target=util.in_current_context(update)).start()
+        return view_id
 
     def post_in_progress_message(self, view_id: str, user_id: str, message: str) -> None:
         response = self.log_and_send('Looking up username', 'users.info', user=user_id)
@@ -197,18 +315,32 @@ class Slack:
             username='Control Group', icon_emoji=':robot_face:',
             text=f'*{user_name}* {message}')
         message_ts = response['ts']
-        self.in_progress_messages[view_id] = message_ts
+        # The view may well be closed by a request to a different worker, so keep this in the
+        # database rather than in memory.
+        self.db.put_in_progress_message(view_id, message_ts)
         log.info('Storing: %s : %s', view_id, message_ts)
 
     def delete_in_progress_message(self, view_id: str) -> None:
-        try:
-            ts = self.in_progress_messages.pop(view_id)
-        except KeyError:
+        ts = self.db.pop_in_progress_message(view_id)
+        if ts is None:
             log.info(f'No in-progress message timestamp stored for view id {view_id}')
             return
         self.log_and_send('Removing in-progress message', 'chat.delete', channel=self.qm_channel_id,
                           ts=ts)
 
+    def post_backend_status(self, backend: str, available: bool) -> None:
+        name = {'sheets': 'Google Sheets', 'drive': 'Google Drive'}.get(backend, backend)
+        if available:
+            text = (f":white_check_mark: {name} is back. Anything that was waiting on it is "
+                    "being caught up now.")
+        else:
+            text = (f":warning: {name} is failing or slow, so Placebo is working around it: "
+                    "unlocks still get their channels and announcements, and solves are still "
+                    "announced, but tracker rows and docs will be filled in once it's back.")
+        self.log_and_send('Posting backend status in #qm', 'chat.postMessage',
+                          channel=self.qm_channel_id, username='Control Group',
+                          icon_emoji=':robot_face:', text=text)
+
     def create_channel(self, puzzle_url: str, prefix: Optional[str] = None,
                        alias: Optional[str] = None) -> Tuple[str, str]:
         puzzle_slug = puzzle_url.rstrip('/').split('/')[-1]
@@ -242,8 +374,69 @@ class Slack:
             'title_link': puzzle_url,
             'text': '\n'.join(lines),
         }
-        self.log_and_send('Announcing unlock', 'chat.postMessage', channel=self.unlocks_channel_id,
-                          username='Control Group', icon_emoji=':robot_face:', attachments=[attach])
+        # It waits in Postgres, so that a restart (or another process taking over the job queue)
+        # before it's announced doesn't lose it.
+        self.db.add_pending_unlock(attach)
+        if self.unlock_window_seconds <= 0:
+            self.flush_unlocks()
+        else:
+            # The first one starts the clock, and everything that comes in before it runs out goes
+            # in the same message: Placebo runs this job, which calls flush_unlocks, once the window
+            # is up.
+            self.db.enqueue_unless_pending('flush_unlocks', self.unlock_window_seconds)
+
+    def flush_unlocks(self) -> None:
+        with self.announce_lock:
+            self._flush_unlocks()
+
+    def _flush_unlocks(self) -> None:
+        # Announces any pending unlocks now: by adding them to the last unlock announcement, if it's
+        # recent enough and still the latest thing in the channel, or else in a new message. Either
+        # way, it's one call, however many there are (plus one to check the channel, when editing).
+        # Call it holding announce_lock. They're only removed from the pending ones once they're
+        # out, so if we fail partway, they're announced next time -- maybe twice, but never lost.
+        pending = self.db.pending_unlocks()
+        if not pending:
+            return
+        attachments = [attachment for _, attachment in pending]
+        last_json = self.db.get_state('unlock_announcement')
+        last = json.loads(last_json) if last_json else None
+        if (last and time.time() - last['posted_at'] < UNLOCK_EDIT_SECONDS and
+                len(last['attachments']) + len(attachments) <= MAX_UNLOCKS_PER_MESSAGE and
+                not self._posted_since(last['channel'], last['ts'])):
+            last['attachments'].extend(attachments)
+            try:
+                self.log_and_send(f'Adding {len(attachments)} unlocks to the last announcement',
+                                  'chat.update', channel=last['channel'], ts=last['ts'],
+                                  attachments=last['attachments'])
+                self.db.set_state('unlock_announcement', json.dumps(last))
+                self.db.remove_pending_unlocks(pending[-1][0])
+                return
+            except AssertionError:
+                # Probably someone deleted it. Just post a new one.
+                pass
+        response = self.log_and_send(
+            f'Announcing {len(attachments)} unlocks', 'chat.postMessage',
+            channel=self.unlocks_channel_id, username='Control Group', icon_emoji=':robot_face:',
+            attachments=attachments)
+        self.db.set_state('unlock_announcement', json.dumps({
+            'channel': response['channel'],
+            'ts': response['ts'],
+            'attachments': attachments,
+            'posted_at': time.time(),
+        }))
+        self.db.remove_pending_unlocks(pending[-1][0])
+
+    def _posted_since(self, channel_id: str, ts: str) -> bool:
+        # Whether anyone (not just us) has posted in the channel since the message at ts.
+        try:
+            response = self.log_and_send('Checking for posts since the last unlocks',
+                                         'conversations.history', channel=channel_id, oldest=ts,
+                                         limit=1)
+        except AssertionError:
+            # Just play it safe.
+            return True
+        return bool(response['messages'])
 
     def announce_round(self, round_name: str, round_url: str, round_color: util.Color):
         attach = {
@@ -253,18 +446,27 @@ class Slack:
             'text': '*New round unlocked!*',
             'mrkdwn_in': 'text',
         }
-        self.log_and_send('Announcing round unlock', 'chat.postMessage',
-                          channel=self.unlocks_channel_id, username='Control Group',
-                          icon_emoji=':robot_face:', attachments=[attach])
+        # Anything posted to the unlocks channel goes after the unlocks already waiting, and the
+        # next ones start a new message below it.
+        with self.announce_lock:
+            self._flush_unlocks()
+            self.log_and_send('Announcing round unlock', 'chat.postMessage',
+                              channel=self.unlocks_channel_id, username='Control Group',
+                              icon_emoji=':robot_face:', attachments=[attach])
+            self.db.delete_state('unlock_announcement')
 
     def announce_solved(self, puzzle_name: str, answer: str) -> None:
-        self.log_and_send('Announcing puzzle solved', 'chat.postMessage',
-                          channel=self.unlocks_channel_id,
-                          text=f'*{puzzle_name}* is solved! The answer was *{answer}*!',
-                          username='Control Group', icon_emoji=':robot_face:',)
+        with self.announce_lock:
+            self._flush_unlocks()
+            self.log_and_send('Announcing puzzle solved', 'chat.postMessage',
+                              channel=self.unlocks_channel_id,
+                              text=f'*{puzzle_name}* is solved! The answer was *{answer}*!',
+                              username='Control Group', icon_emoji=':robot_face:',)
+            self.db.delete_state('unlock_announcement')
 
-    def solved(self, channel_name: str, answer: str) -> None:
-        channel_id = self.get_channel_id_by_name(channel_name)
+    def solved(self, channel_name: str, answer: str, channel_id: Optional[str] = None) -> None:
+        if channel_id is None:
+            channel_id = self.get_channel_id_by_name(channel_name)
         archive = not self.is_channel_active(channel_id)
 
         num_emoji = random.choice([3, 4, 4, 5, 5, 6])
@@ -325,10 +527,11 @@ class Slack:
             }
         }
         message['replace_original'] = True
+        # This has to land before the channel is archived, or Slack won't take it, so it's not
+        # sent asynchronously.
+        log.debug(message)
         try:
-            log.debug(message)
-            response = requests.post(response_url, json=message)
-            response.raise_for_status()
+            webhooks.post(response_url, message)
         except requests.RequestException:
             # Log it but swallow it; we'll go ahead and archive the channel anyway.
             log.exception('HTTP error while updating the archive offer')
@@ -337,20 +540,59 @@ class Slack:
         self.log_and_send('Archiving puzzle channel', 'conversations.archive', channel=channel_id)
 
     def get_channel_id_by_name(self, channel_name: str) -> str:
+        for channel in self.list_channels():
+            if channel['name'] == channel_name:
+                return channel['id']
+        raise KeyError(f'Channel #{channel_name} not found.')
+
+    def channel_ids_by_name(self) -> Dict[str, str]:
+        return {channel['name']: channel['id'] for channel in self.list_channels()}
+
+    def list_channels(self) -> Iterator[Dict[str, Any]]:
+        # Only open (unarchived) public channels.
         cursor = None
         while True:
             response = self.log_and_send('Getting channel list', 'conversations.list',
                                          cursor=cursor, exclude_archived=True, limit=100,
                                          types='public_channel')
             assert response['ok']
-            for channel in response['channels']:
-                if channel['name'] == channel_name:
-                    return channel['id']
+            yield from response['channels']
             next_cursor = response['response_metadata'].get('next_cursor')
             if not next_cursor:
                 break
             cursor = next_cursor
-        raise KeyError(f'Channel #{channel_name} not found.')
+
+    def sweep(self, channel_names: Iterable[str]) -> Tuple[List[str], List[str], List[str]]:
+        # Archives each of these channels that's still open and hasn't been active recently. Returns
+        # the names of the channels archived, the ones left open because they're active, and any we
+        # couldn't check or archive.
+        open_channels = self.channel_ids_by_name()
+        candidates = [name for name in channel_names if name in open_channels]
+
+        def check(name: str) -> Optional[bool]:
+            try:
+                return self.is_channel_active(open_channels[name])
+            except Exception:
+                log.exception('Error checking #%s for activity', name)
+                return None
+
+        def archive(name: str) -> bool:
+            try:
+                self.archive(open_channels[name])
+                return True
+            except Exception:
+                log.exception('Error archiving #%s', name)
+                return False
+
+        with ThreadPoolExecutor(max_workers=SWEEP_THREADS) as pool:
+            activity = dict(zip(candidates, pool.map(util.in_current_context(check), candidates)))
+            idle = [name for name in candidates if activity[name] is False]
+            archive_results = dict(zip(idle, pool.map(util.in_current_context(archive), idle)))
+        archived = [name for name in idle if archive_results[name]]
+        active = [name for name in candidates if activity[name]]
+        failed = [name for name in candidates
+                  if activity[name] is None or archive_results.get(name) is False]
+        return archived, active, failed
 
     def is_channel_active(self, channel_id: str) -> bool:
         oldest = datetime.datetime.utcnow() - datetime.timedelta(minutes=30)
@@ -363,7 +605,14 @@ class Slack:
 
     def log_and_send(self, desc: str, request: str, **kwargs) -> dict:
         log.info(desc)
-        response = self.client.api_call(request, **kwargs)
+        with timeline.span(desc):
+            for attempt in range(RATE_LIMIT_RETRIES + 1):
+                response = self.client.api_call(request, **kwargs)
+                if response.get('error') != 'ratelimited' or attempt == RATE_LIMIT_RETRIES:
+                    break
+                delay = float(response.get('headers', {}).get('Retry-After', 1))
+                log.info('Rate limited on %s; retrying in %s seconds.', request, delay)
+                time.sleep(delay)
         level = logging.DEBUG if response['ok'] else logging.ERROR
         log.log(level, '%s\n%s', request, pprint.pformat(kwargs))
         log.log(level, pprint.pformat(response))
@@ -372,9 +621,20 @@ class Slack:
 
 
 class SlackLogHandler(logging.Handler):
-    def __init__(self, slack: Slack, *args, **kwargs):
+    def __init__(self, slack: Slack, tenant: tenants.Tenant, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.slack = slack
+        self.tenant = tenant
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # Each tenant's admin hears about their own tenant's errors, and the primary tenant's admin
+        # also hears about the ones outside of any tenant's work.
+        current = tenants.current.get()
+        if current is None:
+            mine = self.tenant.primary
+        else:
+            mine = current == self.tenant.id
+        return mine and bool(super().filter(record))
 
     def format(self, record: logging.LogRecord) -> str:
         message = super().format(record)
@@ -393,6 +653,35 @@ class SlackLogHandler(logging.Handler):
             self.handleError(record)
 
 
+def stats_text(stats: Dict[str, Any]) -> str:
+    def ago(when: Dict[str, Any]) -> str:
+        if when['seconds_ago'] is None:
+            return 'a while ago'
+        return f"{util.format_duration(when['seconds_ago'])} ago"
+
+    lines = []
+    for round_stats in stats['rounds']:
+        line = (f"*{round_stats['round']}*: {round_stats['open']} open, "
+                f"{round_stats['solved']} solved")
+        if round_stats['last_solved']['at']:
+            line += f", last solve {ago(round_stats['last_solved'])}"
+        lines.append(line)
+        open_puzzles = []
+        for puzzle in round_stats['open_puzzles']:
+            if puzzle['unlocked']['seconds_ago'] is None:
+                open_puzzles.append(puzzle['name'])
+            else:
+                age = util.format_duration(puzzle['unlocked']['seconds_ago'])
+                open_puzzles.append(f"{puzzle['name']} ({age})")
+        if open_puzzles:
+            lines.append(f"    Open: {', '.join(open_puzzles)}")
+    if stats['last_solved']['at']:
+        lines.append(f"Last solve: {ago(stats['last_solved'])}.")
+    if not lines:
+        return 'No puzzles yet.'
+    return '\n'.join(lines)
+
+
 def plain_text(text: str, emoji: bool = False) -> Dict[str, Union[str, bool]]:
     return {
         'type': 'plain_text',
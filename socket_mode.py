@@ -0,0 +1,122 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+import flask
+import websocket
+from slackclient import SlackClient
+
+import tenants
+import util
+
+log = logging.getLogger('placebo.socket_mode')
+
+# How many envelopes we handle at once. Handlers mostly just enqueue a job or open a modal, so this
+# only needs to cover a burst of commands arriving together.
+THREADS = 4
+# Slack pings us, but pinging back notices a dead connection sooner than waiting on a write to
+# fail.
+PING_INTERVAL_SECONDS = 30
+# After a connection fails, wait this long before reconnecting, doubling up to the maximum.
+RECONNECT_SECONDS = 1.0
+MAX_RECONNECT_SECONDS = 60.0
+
+
+class SocketMode:
+    # An alternative to Slack POSTing to our routes: with an app-level token (xapp-...), Slack sends
+    # slash commands and interactions over a websocket we open instead. Each one is run through the
+    # same Flask route it would have been POSTed to, and acknowledged over the socket with whatever
+    # the route returned. No public endpoint is involved, and there's no cold HTTP request to wake
+    # a sleeping dyno.
+
+    def __init__(self, app: flask.Flask, tenant: tenants.Tenant, app_token: str):
+        self.app = app
+        self.tenant = tenant
+        self.client = SlackClient(app_token)
+        self.ws: Optional[websocket.WebSocketApp] = None
+        self.executor = ThreadPoolExecutor(max_workers=THREADS,
+                                           thread_name_prefix=f'socket_mode{tenant.id}')
+        # The socket is written by whichever handler finishes first, so take turns.
+        self.send_lock = threading.Lock()
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self) -> None:
+        tenants.current.set(self.tenant.id)
+        delay = RECONNECT_SECONDS
+        while True:
+            try:
+                response = self.client.api_call('apps.connections.open')
+                if not response.get('ok'):
+                    raise RuntimeError(f"apps.connections.open: {response.get('error')}")
+                self.ws = websocket.WebSocketApp(response['url'], on_open=self._on_open,
+                                                 on_message=self._on_message,
+                                                 on_error=self._on_error)
+                self.ws.run_forever(ping_interval=PING_INTERVAL_SECONDS)
+                log.info('Socket Mode connection closed; reconnecting.')
+                delay = RECONNECT_SECONDS
+            except Exception:
+                log.warning('Socket Mode connection failed; retrying in %s seconds.', delay,
+                            exc_info=True)
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_SECONDS)
+
+    def _on_open(self) -> None:
+        log.info('Socket Mode connected.')
+
+    def _on_error(self, error: Exception) -> None:
+        log.warning('Socket Mode error: %r', error)
+
+    def _on_message(self, message: str) -> None:
+        envelope = json.loads(message)
+        type = envelope.get('type')
+        if type == 'disconnect':
+            # Slack is about to close this connection (e.g. to move us to another server), so start
+            # a new one now.
+            log.info('Socket Mode disconnect (%s).', envelope.get('reason'))
+            self.ws.close()
+        elif type in {'slash_commands', 'interactive'}:
+            self.executor.submit(util.in_current_context(self._handle), envelope)
+        elif type != 'hello':
+            log.info('Ignoring Socket Mode envelope of type %s.', type)
+            self._ack(envelope['envelope_id'])
+
+    def _handle(self, envelope: Dict[str, Any]) -> None:
+        envelope_id = envelope['envelope_id']
+        payload = envelope['payload']
+        if envelope['type'] == 'slash_commands':
+            # The payload has exactly the fields the command's POST would have had, and its
+            # command is the name of the route.
+            path = payload['command']
+            form = payload
+        else:
+            path = '/interact'
+            form = {'payload': json.dumps(payload)}
+        headers = {}
+        if envelope.get('retry_attempt'):
+            headers = {'X-Slack-Retry-Num': str(envelope['retry_attempt']),
+                       'X-Slack-Retry-Reason': envelope.get('retry_reason', '')}
+        body = None
+        try:
+            with self.app.test_request_context(path, method='POST', data=form, headers=headers):
+                response = self.app.full_dispatch_request()
+            if response.is_json and envelope.get('accepts_response_payload'):
+                body = response.get_json()
+        except Exception:
+            log.exception('Error handling %s over Socket Mode.', path)
+        self._ack(envelope_id, body)
+
+    def _ack(self, envelope_id: str, payload: Optional[Dict[str, Any]] = None) -> None:
+        ack: Dict[str, Any] = {'envelope_id': envelope_id}
+        if payload:
+            ack['payload'] = payload
+        try:
+            with self.send_lock:
+                self.ws.send(json.dumps(ack))
+        except websocket.WebSocketException:
+            # Slack will send it again, and the route's dedupe catches it if it got that far.
+            log.warning('Failed to acknowledge %s.', envelope_id, exc_info=True)
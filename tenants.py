@@ -0,0 +1,50 @@
+import contextvars
+import json
+import logging
+import os
+import re
+from collections import ChainMap
+from dataclasses import dataclass
+from typing import List, Mapping, Optional
+
+log = logging.getLogger('placebo.tenants')
+
+# The tenant when PLACEBO_TENANTS isn't set, and there's only the one, configured by the
+# environment.
+DEFAULT = ''
+SCHEMA_PATTERN = re.compile('[a-z_][a-z0-9_]*')
+
+# The tenant whose work the current thread is doing, if any. (It's a context variable, rather than a
+# thread-local, so that util.future can carry it over to the threads it starts.)
+current: 'contextvars.ContextVar[Optional[str]]' = contextvars.ContextVar('tenant', default=None)
+
+
+@dataclass
+class Tenant:
+    # The Slack team ID.
+    id: str
+    # The PLACEBO_* variables for this tenant: its own settings, falling back to the environment.
+    config: Mapping[str, str]
+    # The Postgres schema holding this tenant's tables, so tenants never see each other's state.
+    schema: str
+    # Errors that don't belong to any one tenant are reported to the primary tenant's admin.
+    primary: bool = True
+
+
+def load() -> List[Tenant]:
+    # PLACEBO_TENANTS is a JSON object mapping each Slack team ID to the variables to override for
+    # that team, for example:
+    #   {"T012345": {"PLACEBO_SLACK_TOKEN": "xoxb-...", "PLACEBO_SCHEMA": "public", ...},
+    #    "T067890": {"PLACEBO_SLACK_TOKEN": "xoxb-...", ...}}
+    tenants_json = os.environ.get('PLACEBO_TENANTS')
+    if not tenants_json:
+        return [Tenant(DEFAULT, os.environ, 'public')]
+    tenants = []
+    for team_id, overrides in json.loads(tenants_json).items():
+        config = ChainMap(overrides, os.environ)
+        schema = config.get('PLACEBO_SCHEMA', f'tenant_{team_id.lower()}')
+        if not SCHEMA_PATTERN.fullmatch(schema):
+            raise ValueError(f'Bad schema name "{schema}" for {team_id}')
+        tenants.append(Tenant(team_id, config, schema, primary=not tenants))
+    log.info('Serving %d tenants: %s', len(tenants), ', '.join(t.id for t in tenants))
+    return tenants
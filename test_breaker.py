@@ -0,0 +1,89 @@
+# Tests for breaker.CircuitBreaker, on a clock the tests move by hand.
+#
+#   python -m unittest test_breaker
+
+import unittest
+from typing import List
+from unittest import mock
+
+import breaker
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.now = 1000.0
+        patcher = mock.patch('time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.changes: List[str] = []
+        self.circuit = breaker.CircuitBreaker('sheets', slow_seconds=10.0,
+                                              on_change=lambda c: self.changes.append(c.state))
+
+    def fail(self, times: int = 1) -> None:
+        for _ in range(times):
+            self.circuit.check()
+            self.circuit.record(1.0, ok=False)
+
+    def trip(self) -> None:
+        self.fail(breaker.FAILURES_TO_TRIP)
+        self.assertEqual(self.circuit.state, breaker.OPEN)
+
+    def test_trips_after_failures_in_a_row(self) -> None:
+        self.fail(breaker.FAILURES_TO_TRIP - 1)
+        self.assertEqual(self.circuit.state, breaker.CLOSED)
+        self.circuit.check()
+        self.circuit.record(1.0, ok=True)
+        self.fail(breaker.FAILURES_TO_TRIP - 1)
+        self.assertEqual(self.circuit.state, breaker.CLOSED)
+        self.fail()
+        self.assertEqual(self.circuit.state, breaker.OPEN)
+        self.assertEqual(self.changes, [breaker.OPEN])
+
+    def test_slow_counts_as_failure(self) -> None:
+        for _ in range(breaker.FAILURES_TO_TRIP):
+            self.circuit.check()
+            self.circuit.record(11.0, ok=True)
+        self.assertEqual(self.circuit.state, breaker.OPEN)
+
+    def test_open_refuses_until_reset(self) -> None:
+        self.trip()
+        self.now += 15
+        with self.assertRaises(breaker.Unavailable) as raised:
+            self.circuit.check()
+        self.assertEqual(raised.exception.retry_after, breaker.RESET_SECONDS - 15)
+        self.assertEqual(self.circuit.retry_after(), breaker.RESET_SECONDS - 15)
+        self.assertFalse(self.circuit.available())
+
+    def test_trial_success_closes(self) -> None:
+        self.trip()
+        self.now += breaker.RESET_SECONDS
+        self.assertTrue(self.circuit.available())
+        self.circuit.check()
+        self.assertEqual(self.circuit.state, breaker.HALF_OPEN)
+        self.circuit.record(1.0, ok=True)
+        self.assertEqual(self.circuit.state, breaker.CLOSED)
+        self.assertEqual(self.changes, [breaker.OPEN, breaker.CLOSED])
+
+    def test_trial_failure_reopens(self) -> None:
+        self.trip()
+        self.now += breaker.RESET_SECONDS
+        self.fail()
+        self.assertEqual(self.circuit.state, breaker.OPEN)
+        self.assertEqual(self.circuit.retry_after(), breaker.RESET_SECONDS)
+        # Still open, so on_change wasn't called again.
+        self.assertEqual(self.changes, [breaker.OPEN])
+
+    def test_only_one_trial(self) -> None:
+        self.trip()
+        self.now += breaker.RESET_SECONDS
+        self.circuit.check()
+        # Anyone else asked to wait while the trial is out gets a real delay, so a job retrying on
+        # it doesn't spin.
+        with self.assertRaises(breaker.Unavailable) as raised:
+            self.circuit.check()
+        self.assertEqual(raised.exception.retry_after, breaker.RESET_SECONDS)
+
+
+if __name__ == '__main__':
+    unittest.main()
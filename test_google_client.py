@@ -0,0 +1,98 @@
+# Tests for placing new rows on the tracker from the round registry: it should only reload the Round
+# column when the two cells it checks show the tracker has shifted under it.
+#
+#   python -m unittest test_google_client
+
+import unittest
+from typing import List
+
+import benchmark
+import google_client
+
+
+class AddRowTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.google = benchmark.fake_google(
+            [list(row) + [''] * (8 - len(row)) for row in benchmark.tracker_rows(20, 4)],
+            apply_updates=True)
+        self.client = self.google._client
+        self.sent: List[str] = []
+        send = self.client.log_and_send
+
+        def log_and_send(desc, request):
+            self.sent.append(desc)
+            return send(desc, request)
+        self.client.log_and_send = log_and_send
+
+    def add(self, round_name: str, puzzle_name: str) -> int:
+        row_index, _ = self.google._add_row((round_name, puzzle_name, '', '', '', '', ''), None)
+        self.assertEqual(self.client.rows[row_index][:2], [round_name, puzzle_name])
+        return row_index
+
+    def edit(self, row_index: int, row: List[str]) -> None:
+        # Someone inserts a row by hand.
+        self.client.rows.insert(row_index, row + [''] * (8 - len(row)))
+        self.client.responses.clear()
+
+    def last_row(self, round_name: str) -> int:
+        return max(i for i, row in enumerate(self.client.rows) if row[0] == round_name)
+
+    def reloads(self) -> int:
+        return self.sent.count('Looking up the Round column')
+
+    def test_loads_once(self) -> None:
+        first = self.add('Round 1 of the Hunt', 'First')
+        second = self.add('Round 1 of the Hunt', 'Second')
+        self.add('Round 3 of the Hunt', 'Third')
+        self.assertEqual(second, first + 1)
+        self.assertEqual(self.reloads(), 1)
+        self.assertEqual(self.sent.count('Checking the Round column'), 2)
+
+    def test_row_inserted_above(self) -> None:
+        self.add('Round 2 of the Hunt', 'First')
+        self.edit(5, ['Round 0 of the Hunt', 'By Hand'])
+        row_index = self.add('Round 2 of the Hunt', 'Second')
+        self.assertEqual(row_index, self.last_row('Round 2 of the Hunt'))
+        self.assertEqual(self.client.rows[row_index - 1][1], 'First')
+        self.assertEqual(self.reloads(), 2)
+
+    def test_row_deleted_above(self) -> None:
+        self.add('Round 2 of the Hunt', 'First')
+        del self.client.rows[3]
+        self.client.responses.clear()
+        row_index = self.add('Round 2 of the Hunt', 'Second')
+        self.assertEqual(self.client.rows[row_index - 1][1], 'First')
+        self.assertEqual(self.reloads(), 2)
+
+    def test_row_added_to_round_elsewhere(self) -> None:
+        self.add('Round 2 of the Hunt', 'First')
+        self.edit(self.last_row('Round 2 of the Hunt') + 1, ['Round 2 of the Hunt', 'Elsewhere'])
+        row_index = self.add('Round 2 of the Hunt', 'Second')
+        self.assertEqual(self.client.rows[row_index - 1][1], 'Elsewhere')
+        self.assertEqual(self.reloads(), 2)
+
+    def test_new_round(self) -> None:
+        first = self.add('New Round', 'First')
+        self.assertEqual(self.client.rows[first - 1][0], 'Round 3 of the Hunt')
+        self.assertEqual(self.client.rows[first + 1][0], '')
+        self.add('Newer Round', 'Second')
+        self.assertEqual(self.reloads(), 1)
+
+    def test_round_added_elsewhere(self) -> None:
+        first = self.add('New Round', 'First')
+        self.edit(first + 1, ['Other Round', 'Elsewhere'])
+        second = self.add('Newer Round', 'Second')
+        self.assertEqual(self.client.rows[second - 1][0], 'Other Round')
+        self.assertEqual(self.reloads(), 2)
+
+    def test_round_color(self) -> None:
+        _, color = self.google._add_row(('New Round', 'First', '', '', '', '', ''), None)
+        self.assertEqual(self.google.cached_round_color('new round'), color)
+        _, again = self.google._add_row(('New Round', 'Second', '', '', '', '', ''), None)
+        self.assertEqual(again, color)
+        self.assertNotEqual(color, google_client.PLAIN_BACKGROUND)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import contextlib
+import contextvars
+import json
+import math
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Iterator, List, Optional
+
+# The timeline of the job the current thread is working on, if any. (It's a context variable, so
+# the threads a job starts with util.future or util.in_current_context record into it too.)
+current: 'contextvars.ContextVar[Optional[Timeline]]' = contextvars.ContextVar('timeline',
+                                                                               default=None)
+
+# How many characters wide the bars of a waterfall are.
+WATERFALL_WIDTH = 30
+# The most spans a waterfall shows. If there are more, only the longest ones are shown.
+WATERFALL_SPANS = 25
+
+
+@dataclass
+class Span:
+    desc: str
+    # Seconds since the job started.
+    start: float
+    end: float
+    thread: str
+
+
+class Timeline:
+    # Where one job's time went: every request it sent, and anything else it waited on, with when
+    # each started and ended. It's finished when the job is, or if the job started work that
+    # outlives it (see hold), when that's done too; then on_done gets it.
+
+    def __init__(self, kind: str, queued_seconds: float,
+                 on_done: Callable[['Timeline'], None]) -> None:
+        self.kind = kind
+        self.queued_seconds = queued_seconds
+        self.on_done = on_done
+        self.started = time.monotonic()
+        self.seconds: Optional[float] = None
+        self.spans: List[Span] = []
+        self.lock = threading.Lock()
+        # The job itself holds the timeline open until it's done.
+        self.holds = 1
+
+    def add(self, desc: str, start: float, end: float) -> None:
+        with self.lock:
+            if self.seconds is None:
+                self.spans.append(Span(desc, start - self.started, end - self.started,
+                                       threading.current_thread().name))
+
+    def hold(self) -> Callable[[], None]:
+        # Keeps the timeline open for work that carries on after the job returns. Call the result
+        # once that's done.
+        with self.lock:
+            self.holds += 1
+        return self.release
+
+    def release(self) -> None:
+        with self.lock:
+            self.holds -= 1
+            if self.holds:
+                return
+            self.seconds = time.monotonic() - self.started
+        self.on_done(self)
+
+    def spans_json(self) -> str:
+        return json.dumps([{'desc': span.desc, 'start': round(span.start, 3),
+                            'end': round(span.end, 3), 'thread': span.thread}
+                           for span in self.spans])
+
+    def waterfall(self) -> str:
+        # A compact summary for Slack: one bar per span, positioned within the job's duration.
+        total = max(self.seconds or 0.0, 1e-3)
+        spans = self.spans
+        omitted = len(spans) - WATERFALL_SPANS
+        if omitted > 0:
+            spans = sorted(spans, key=lambda span: span.end - span.start)[omitted:]
+        lines = []
+        for span in sorted(spans, key=lambda span: span.start):
+            first = min(int(span.start / total * WATERFALL_WIDTH), WATERFALL_WIDTH - 1)
+            last = max(first + 1, math.ceil(span.end / total * WATERFALL_WIDTH))
+            bar = ' ' * first + '█' * (last - first) + ' ' * (WATERFALL_WIDTH - last)
+            lines.append(f'|{bar}| {span.end - span.start:6.2f}s {span.desc}')
+        if omitted > 0:
+            lines.append(f'(and {omitted} shorter)')
+        if not lines:
+            lines.append('(no requests)')
+        return (f'Slow job: *{self.kind}* took {total:.1f}s, after {self.queued_seconds:.1f}s in '
+                'the queue.\n```' + '\n'.join(lines) + '```')
+
+
+@contextlib.contextmanager
+def span(desc: str) -> Iterator[None]:
+    # Records the time spent in the with block on the current job's timeline, if there is one.
+    timeline = current.get()
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        if timeline is not None:
+            timeline.add(desc, start, time.monotonic())
+
+
+def hold() -> Callable[[], None]:
+    # Timeline.hold for the current job's timeline, or if there isn't one, a no-op.
+    timeline = current.get()
+    if timeline is None:
+        return lambda: None
+    return timeline.hold()
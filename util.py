@@ -1,11 +1,18 @@
+import collections
+import contextvars
 import dataclasses
+import re
 import string
 import threading
 from dataclasses import dataclass
-from typing import Any, Callable, Dict, Generic, Iterable, Literal, Mapping, Optional, TypeVar
+from typing import (Any, Callable, Dict, Generic, Iterable, List, Literal, Mapping, Optional, Tuple,
+                    TypeVar)
 
 
 NAME_CHARACTERS = string.ascii_lowercase + string.digits + '_'
+# Everything canonicalize drops. (It's called on every row of every tracker read, and a regex is
+# several times faster than checking each character.)
+NOT_NAME_CHARACTERS = re.compile(f'[^{NAME_CHARACTERS}]')
 
 @dataclass
 class Color:
@@ -51,6 +58,10 @@ class Future(Generic[T]):
         self._event.wait()
         return self._value
 
+    def exception(self) -> Optional[BaseException]:
+        self._event.wait()
+        return self._exception
+
 
 def future(f: Callable[..., T], args: Optional[Iterable[Any]] = None,
            kwargs: Optional[Mapping[str, Any]] = None) -> Future[T]:
@@ -68,10 +79,132 @@ def future(f: Callable[..., T], args: Optional[Iterable[Any]] = None,
         else:
             future.set(result)
 
-    threading.Thread(target=do_f).start()
+    # Carry over context variables (like the current tenant) to the new thread.
+    threading.Thread(target=contextvars.copy_context().run, args=(do_f,)).start()
     return future
 
 
+def in_current_context(f: Callable[..., T]) -> Callable[..., T]:
+    # Wraps f to run with the calling thread's context variables, for handing off to a thread pool.
+    # Each call gets its own copy of the context, so it's safe to call from several threads at once.
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(f, *args, **kwargs)
+
+
+class LruCache:
+    # A thread-safe cache with the get/set/delete interface httplib2 wants, bounded by the total
+    # size of its values: once it's over max_bytes, the least recently used entries go first.
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: 'collections.OrderedDict[str, bytes]' = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes) -> None:
+        with self._lock:
+            self._remove(key)
+            if len(value) > self.max_bytes:
+                return
+            self._entries[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key: str) -> None:
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self._size -= len(value)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._size, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+class SkippedStep(Exception):
+    def __init__(self, step: str, dependency: str):
+        super().__init__(f'Skipped {step} because {dependency} failed')
+        self.step = step
+        self.dependency = dependency
+
+
+Step = Tuple[Iterable[str], Callable[[], Any]]
+
+
+def run_graph(steps: Mapping[str, Step]) -> Dict[str, BaseException]:
+    # Each step is (names of the steps it depends on, function to call). Every step runs on its own
+    # thread as soon as its dependencies have finished, so independent steps all run at once. If a
+    # step fails, the steps that depend on it are skipped, but everything else still runs. Returns
+    # the exception for each step that didn't succeed (empty if they all did).
+    dependencies = {name: list(deps) for name, (deps, _) in steps.items()}
+    order: List[str] = []
+    visiting = set()
+
+    def visit(name: str) -> None:
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f'Dependency cycle through {name}')
+        if name not in dependencies:
+            raise ValueError(f'Unknown step {name}')
+        visiting.add(name)
+        for dep in dependencies[name]:
+            visit(dep)
+        visiting.remove(name)
+        order.append(name)
+
+    for name in steps:
+        visit(name)
+
+    def run_step(name: str, func: Callable[[], Any], deps: List[Tuple[str, Future]]) -> None:
+        for dep_name, dep in deps:
+            if dep.exception() is not None:
+                raise SkippedStep(name, dep_name)
+        func()
+
+    # Start them in dependency order, so each step's dependencies already have futures to wait on.
+    futures: Dict[str, Future] = {}
+    for name in order:
+        _, func = steps[name]
+        deps = [(dep, futures[dep]) for dep in dependencies[name]]
+        futures[name] = future(run_step, [name, func, deps])
+    failures = {}
+    for name, f in futures.items():
+        e = f.exception()
+        if e is not None:
+            failures[name] = e
+    return failures
+
+
+def format_duration(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f'{minutes}m'
+    hours, minutes = divmod(minutes, 60)
+    if hours < 24:
+        return f'{hours}h {minutes}m'
+    days, hours = divmod(hours, 24)
+    return f'{days}d {hours}h'
+
+
 def canonicalize(name: str) -> str:
-    return ''.join(filter(lambda c: c in NAME_CHARACTERS,
-                          name.lower().replace('-', '_').replace(' ', '_')))
+    return NOT_NAME_CHARACTERS.sub('', name.lower().replace('-', '_').replace(' ', '_'))
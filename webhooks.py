@@ -0,0 +1,70 @@
+import collections
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import util
+
+log = logging.getLogger('placebo.webhooks')
+
+# (connect, read) timeouts, in seconds. Slack answers response_url posts right away, so anything
+# slower than this is hung, and not worth holding a thread for.
+TIMEOUT = (3.05, 10)
+# How many posts can be in flight at once. The rest wait their turn in the executor's queue.
+THREADS = 4
+
+# Posts to response_urls (and anything else that's a plain webhook) all go through this, so they
+# reuse kept-alive connections instead of doing a new TCP and TLS handshake every time. They're
+# almost all to hooks.slack.com, so one small pool covers it.
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=THREADS))
+_executor = ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix='webhooks')
+# Posts waiting for an earlier one to the same URL, by URL. A URL is in here as long as a post to it
+# is in flight.
+_waiting: Dict[str, Deque[Callable[[], None]]] = {}
+_waiting_lock = threading.Lock()
+
+
+def post(url: str, body: Dict[str, Any]) -> requests.Response:
+    response = _session.post(url, json=body, timeout=TIMEOUT)
+    response.raise_for_status()
+    return response
+
+
+def post_async(desc: str, url: str, body: Dict[str, Any]) -> None:
+    # Fire and forget, for acknowledgments nothing else waits on: errors are logged, not raised.
+    # Posts to the same URL go one at a time, in the order they were made, so that (say) "Marking
+    # it solved..." can't show up after the follow-up that says how that went.
+    def do_post() -> None:
+        log.info(desc)
+        log.debug(body)
+        try:
+            post(url, body)
+        except requests.RequestException:
+            log.exception('HTTP error: %s', desc)
+
+    send = util.in_current_context(do_post)
+    with _waiting_lock:
+        if url in _waiting:
+            _waiting[url].append(send)
+            return
+        _waiting[url] = collections.deque()
+    _executor.submit(_send_in_order, url, send)
+
+
+def _send_in_order(url: str, send: Callable[[], None]) -> None:
+    # Sends, then sends anything that was waiting on it, until there's nothing left for the URL.
+    while True:
+        try:
+            send()
+        except Exception:
+            log.exception('Error posting to a webhook.')
+        with _waiting_lock:
+            if not _waiting[url]:
+                del _waiting[url]
+                return
+            send = _waiting[url].popleft()